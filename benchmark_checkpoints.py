@@ -0,0 +1,269 @@
+"""
+Check that checkpointed BPE training (train_tokenizer --checkpoint_every) learns exactly the same
+merges as an uninterrupted run, also when it is interrupted and resumed, and measure what
+checkpointing costs.
+
+All runs train on the same word counts, in temporary directories that start from the same
+merges.txt (the first --num_inherit_merges merges of --merges_path, if given, as in stage 2). The
+checkpointed runs extend the merges.txt of their previous segment at every segment, so this
+exercises the extend path of the installed tokenizers. Upstream tokenizers ignore merges.txt and
+retrain from scratch each time, which would make the check pass trivially, so it refuses to run
+unless the installed tokenizers extends merges.txt (i.e. the SuperBPE fork is installed).
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+from pathlib import Path
+
+import click
+import numpy as np
+
+from utils import (
+    count_words,
+    ensure_dir,
+    get_files_with_num_bytes,
+    read_merges_txt,
+    train_or_extend_tokenizer,
+    TrainingTelemetry,
+)
+
+
+class Interrupted(Exception):
+    pass
+
+
+class InterruptingTelemetry(TrainingTelemetry):
+    """Telemetry that interrupts training right after the checkpoint of segment num_segments."""
+
+    def __init__(self, num_segments):
+        super().__init__()
+        self.num_segments = num_segments
+
+    def record_segment(self, *args):
+        super().record_segment(*args)
+        if len(self.stats["segments"]) == self.num_segments:
+            raise Interrupted()
+
+
+def extends_merges(tmp_dir):
+    """
+    Return whether the installed tokenizers extends the merges.txt in the cwd when training, by
+    training on words where the inherited merge would otherwise be learned last.
+    """
+    word_counts = (["ab", "cd"], np.array([1, 100], dtype=np.uint64))
+    merges, _ = train_in_dir(Path(tmp_dir) / "probe", ["a b"], word_counts, 6, True)
+    return merges[:1] == ["a b"]
+
+
+def train_in_dir(
+    output_dir,
+    initial_merges,
+    word_counts,
+    vocab_size,
+    do_whitespace_pretokenization,
+    telemetry=None,
+    **kwargs,
+):
+    """
+    Train in output_dir, starting from initial_merges (or resuming from the checkpoint in output_dir
+    if initial_merges is None), and return the merges and the telemetry.
+    """
+    cwd = os.getcwd()
+    ensure_dir(output_dir)
+    os.chdir(output_dir)
+    try:
+        if initial_merges:
+            with open("merges.txt", "w") as fout:
+                fout.write("#version: 0.2\n")
+                fout.writelines(f"{merge}\n" for merge in initial_merges)
+        telemetry = telemetry or TrainingTelemetry()
+        tokenizer = train_or_extend_tokenizer(
+            None,
+            vocab_size=vocab_size,
+            do_whitespace_pretokenization=do_whitespace_pretokenization,
+            word_counts=word_counts,
+            telemetry=telemetry,
+            **kwargs,
+        )
+        tokenizer.model.save(".")
+        return read_merges_txt("merges.txt"), telemetry
+    finally:
+        os.chdir(cwd)
+
+
+@click.command()
+@click.option(
+    "--corpus_dir",
+    type=str,
+    help="Directory of training text files.",
+)
+@click.option(
+    "--num_bytes",
+    type=int,
+    default=10**8,
+    help="Number of bytes of corpus_dir to train on.",
+)
+@click.option(
+    "--vocab_size",
+    type=int,
+    default=20000,
+    help="The number of tokens in the vocabulary.",
+)
+@click.option(
+    "--checkpoint_every",
+    type=int,
+    default=1000,
+    help="Length of the segments of the checkpointed runs, in merges.",
+)
+@click.option(
+    "--interrupt_after",
+    type=int,
+    default=2,
+    help="Number of segments after which to interrupt the interrupted run before resuming it.",
+)
+@click.option(
+    "--merges_path",
+    type=str,
+    default=None,
+    help="merges.txt of a stage 1 tokenizer to inherit merges from, to check stage 2.",
+)
+@click.option(
+    "--num_inherit_merges",
+    type=int,
+    default=0,
+    help="Number of merges of merges_path to inherit.",
+)
+@click.option(
+    "--do_whitespace_pretokenization",
+    type=bool,
+    default=True,
+    help="Whether to do whitespace pretokenization.",
+)
+@click.option(
+    "--output_path",
+    type=str,
+    default="benchmarks/checkpoint_results.json",
+    help="Where to save the benchmark results.",
+)
+def main(
+    corpus_dir: str,
+    num_bytes: int,
+    vocab_size: int,
+    checkpoint_every: int,
+    interrupt_after: int,
+    merges_path: str,
+    num_inherit_merges: int,
+    do_whitespace_pretokenization: bool,
+    output_path: str,
+):
+    files, _ = get_files_with_num_bytes(corpus_dir, num_bytes)
+    counter = count_words(files, do_whitespace_pretokenization)
+    word_counts = (list(counter), np.fromiter(counter.values(), dtype=np.uint64, count=len(counter)))
+    initial_merges = read_merges_txt(merges_path)[:num_inherit_merges] if merges_path else []
+
+    runs = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if not extends_merges(tmp_dir):
+            print(
+                "The installed tokenizers does not extend merges.txt, so every segment would retrain "
+                "from scratch and the merges would match trivially. Install the SuperBPE fork.",
+                flush=True,
+            )
+            sys.exit(2)
+
+        configs = [("uninterrupted", {}), ("checkpointed", {"checkpoint_every": checkpoint_every})]
+        for name, kwargs in configs:
+            start_time = time.time()
+            merges, telemetry = train_in_dir(
+                Path(tmp_dir) / name,
+                initial_merges,
+                word_counts,
+                vocab_size,
+                do_whitespace_pretokenization,
+                **kwargs,
+            )
+            runs[name] = {
+                "merges": merges,
+                "seconds": time.time() - start_time,
+                "segments": telemetry.stats["segments"],
+            }
+            print(f"{name}: {len(merges)} merges in {runs[name]['seconds']:.1f}s", flush=True)
+
+        # interrupt a checkpointed run after interrupt_after segments, then resume it from its
+        # checkpoint, as train_tokenizer --resume does
+        output_dir = Path(tmp_dir) / "resumed"
+        try:
+            train_in_dir(
+                output_dir,
+                initial_merges,
+                word_counts,
+                vocab_size,
+                do_whitespace_pretokenization,
+                telemetry=InterruptingTelemetry(interrupt_after),
+                checkpoint_every=checkpoint_every,
+            )
+            print(f"The run finished in fewer than {interrupt_after} segments", flush=True)
+            sys.exit(2)
+        except Interrupted:
+            num_interrupted_merges = len(read_merges_txt(output_dir / "merges.txt"))
+            print(f"Interrupted after {num_interrupted_merges} merges, resuming", flush=True)
+        merges, _ = train_in_dir(
+            output_dir,
+            None,
+            word_counts,
+            vocab_size,
+            do_whitespace_pretokenization,
+            checkpoint_every=checkpoint_every,
+        )
+        runs["resumed"] = {"merges": merges}
+
+    expected = runs["uninterrupted"]["merges"]
+    first_differences = {}
+    for name in ["checkpointed", "resumed"]:
+        actual = runs[name]["merges"]
+        first_differences[name] = next(
+            (i for i, (a, b) in enumerate(zip(expected, actual)) if a != b),
+            None if len(expected) == len(actual) else min(len(expected), len(actual)),
+        )
+    results = {
+        "corpus_dir": corpus_dir,
+        "num_bytes": num_bytes,
+        "vocab_size": vocab_size,
+        "checkpoint_every": checkpoint_every,
+        "num_inherit_merges": len(initial_merges),
+        "do_whitespace_pretokenization": do_whitespace_pretokenization,
+        "interrupt_after": interrupt_after,
+        "num_interrupted_merges": num_interrupted_merges,
+        "first_difference": first_differences["checkpointed"],
+        "first_difference_resumed": first_differences["resumed"],
+        "uninterrupted_seconds": runs["uninterrupted"]["seconds"],
+        "checkpointed_seconds": runs["checkpointed"]["seconds"],
+        "segments": runs["checkpointed"]["segments"],
+    }
+    ensure_dir(Path(output_path).parent)
+    with open(output_path, "w") as fout:
+        json.dump(results, fout, indent=5)
+    print(
+        f"{len(results['segments'])} segments took "
+        f"{results['checkpointed_seconds'] / results['uninterrupted_seconds']:.2f}x as long as one run",
+        flush=True,
+    )
+    failed = False
+    for name, i in first_differences.items():
+        if i is not None:
+            actual = runs[name]["merges"]
+            print(
+                f"The {name} merges differ from merge {i}: {expected[i : i + 1]} != {actual[i : i + 1]}",
+                flush=True,
+            )
+            failed = True
+    if failed:
+        sys.exit(1)
+    print(f"The merges are identical, saved results to {output_path}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""
+Benchmark the encoding speed of tokenizers (by default, all of those in tokenizer_json/) on a synthetic
+multi-domain corpus: prose, code, numbers and long unbroken lines. The last are the worst case for
+SuperBPE tokenizers, which do not split on whitespace, so a whole line is a single pretoken.
+
+For each tokenizer, batch size and domain we measure bytes/s, tokens/s and the p50/p99 latency of an
+encode call, and for each tokenizer the memory it needs. Results are saved as JSON, and can be
+compared against a saved baseline to catch regressions in the tokenizer or in our wrappers.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import resource
+import multiprocessing
+from pathlib import Path
+
+import click
+import numpy as np
+import tokenizers
+
+from utils import ensure_dir, get_rss_bytes, load_tokenizer
+
+RANDOM_SEED = 0
+DOMAINS = ["prose", "code", "numbers", "long_lines"]
+
+WORDS = """
+the of and to in is was for that on as with by he at from his it an were are which this be or has
+had not but first one their its new after who they have her she two been other when there all
+during into school time may years more most only over city some world would where later up such
+used many can state about national out known university united then made also under between
+government through american well each could own part system both people since year called
+because before high no while found three war what any these group however team family american
+began series music early until life number including area several second public form early day
+water light small large simple strong quickly slowly carefully model language token text data
+""".split()
+
+IDENTIFIERS = """
+data value result index count total items config path name size offset buffer token tokenizer
+model batch output input text line file chunk start end key args kwargs self node parent child
+""".split()
+
+
+def generate_prose(rng):
+    paragraphs = []
+    for _ in range(rng.randint(2, 8)):
+        sentences = []
+        for _ in range(rng.randint(3, 8)):
+            words = rng.choices(WORDS, k=rng.randint(5, 25))
+            words[0] = words[0].capitalize()
+            if rng.random() < 0.3:
+                words.insert(rng.randint(1, len(words) - 1), rng.choice(WORDS) + ",")
+            sentences.append(" ".join(words) + rng.choice([".", ".", ".", "?", "!", ":"]))
+        paragraphs.append(" ".join(sentences))
+    return "\n\n".join(paragraphs)
+
+
+def generate_code(rng):
+    lines = []
+    for _ in range(rng.randint(2, 6)):
+        name = "_".join(rng.choices(IDENTIFIERS, k=2))
+        args = ", ".join(rng.sample(IDENTIFIERS, rng.randint(1, 4)))
+        lines.append(f"def {name}({args}):")
+        lines.append(f'    """{" ".join(rng.choices(WORDS, k=rng.randint(4, 12))).capitalize()}."""')
+        for _ in range(rng.randint(3, 12)):
+            indent = "    " * rng.randint(1, 3)
+            a, b, c = rng.choices(IDENTIFIERS, k=3)
+            lines.append(
+                rng.choice(
+                    [
+                        f"{indent}{a} = {b}[{rng.randint(0, 99)}] + {c}",
+                        f"{indent}if {a} is not None and len({b}) > {rng.randint(0, 9)}:",
+                        f"{indent}for {a} in range({b}.{c}):",
+                        f'{indent}print(f"{{{a}}}: {{{b}:.{rng.randint(1, 4)}f}}")',
+                        f"{indent}return {{'{a}': {b}, '{c}': {rng.random():.3f}}}",
+                    ]
+                )
+            )
+        lines.append("")
+    return "\n".join(lines)
+
+
+def generate_numbers(rng):
+    header = ",".join(rng.sample(IDENTIFIERS, 5))
+    rows = [header]
+    for _ in range(rng.randint(20, 100)):
+        rows.append(
+            ",".join(
+                [
+                    f"{rng.randint(1900, 2030)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                    str(rng.randint(0, 10 ** rng.randint(1, 12))),
+                    f"{rng.uniform(-1000, 1000):.{rng.randint(1, 6)}f}",
+                    f"{rng.randint(0, 100)}%",
+                    f"${rng.randint(0, 10**6):,}",
+                ]
+            )
+        )
+    return "\n".join(rows)
+
+
+def generate_long_line(rng):
+    kind = rng.choice(["prose", "json", "hex"])
+    if kind == "prose":
+        return " ".join(rng.choices(WORDS, k=rng.randint(10000, 30000)))
+    elif kind == "json":
+        items = [
+            f'{{"{rng.choice(IDENTIFIERS)}":{rng.randint(0, 10**6)},"{rng.choice(IDENTIFIERS)}":"{rng.choice(WORDS)}"}}'
+            for _ in range(rng.randint(2000, 6000))
+        ]
+        return "[" + ",".join(items) + "]"
+    else:
+        return "".join(rng.choices("0123456789abcdef", k=rng.randint(50000, 150000)))
+
+
+GENERATORS = {
+    "prose": generate_prose,
+    "code": generate_code,
+    "numbers": generate_numbers,
+    "long_lines": generate_long_line,
+}
+
+
+def get_benchmark_corpus(corpus_path, num_docs, seed=RANDOM_SEED):
+    """
+    Load the benchmark corpus from corpus_path (a JSON lines file of {"domain": ..., "text": ...}), or
+    generate and save it if it does not exist. Returns a dict from domain to documents.
+    """
+    if not os.path.exists(corpus_path):
+        rng = random.Random(seed)
+        ensure_dir(Path(corpus_path).parent)
+        with open(corpus_path, "w") as fout:
+            for domain in DOMAINS:
+                # long lines are large, so fewer of them are enough
+                n = max(num_docs // 10, 1) if domain == "long_lines" else num_docs
+                for _ in range(n):
+                    fout.write(json.dumps({"domain": domain, "text": GENERATORS[domain](rng)}) + "\n")
+        print(f"Generated benchmark corpus in {corpus_path}", flush=True)
+
+    docs = {}
+    with open(corpus_path) as fin:
+        for line in fin:
+            doc = json.loads(line)
+            docs.setdefault(doc["domain"], []).append(doc["text"])
+    return docs
+
+
+def benchmark_tokenizer(tokenizer_path, docs, batch_sizes):
+    """
+    Encode docs (a dict from domain to documents) with each batch size, and return the throughput
+    and latency for each domain. Meant to run in a fresh process, so that peak memory is per tokenizer.
+    """
+    start_time = time.time()
+    tokenizer = load_tokenizer(tokenizer_path)
+    result = {"load_seconds": time.time() - start_time, "loaded_rss_bytes": get_rss_bytes()}
+    encode_batch = getattr(tokenizer, "encode_batch_fast", tokenizer.encode_batch)
+
+    result["runs"] = []
+    for batch_size in batch_sizes:
+        for domain, texts in docs.items():
+            batches = [texts[i : i + batch_size] for i in range(0, len(texts), batch_size)]
+            encode_batch(batches[0])  # warm up
+
+            latencies, num_tokens = [], 0
+            for batch in batches:
+                call_start = time.perf_counter()
+                if batch_size == 1:
+                    num_tokens += len(tokenizer.encode(batch[0]).ids)
+                else:
+                    num_tokens += sum(len(e.ids) for e in encode_batch(batch))
+                latencies.append(time.perf_counter() - call_start)
+
+            seconds = sum(latencies)
+            num_bytes = sum(len(text.encode("utf-8")) for text in texts)
+            result["runs"].append(
+                {
+                    "batch_size": batch_size,
+                    "domain": domain,
+                    "num_docs": len(texts),
+                    "num_bytes": num_bytes,
+                    "num_tokens": num_tokens,
+                    "seconds": seconds,
+                    "bytes_per_second": num_bytes / seconds,
+                    "tokens_per_second": num_tokens / seconds,
+                    "p50_latency_ms": float(np.percentile(latencies, 50) * 1000),
+                    "p99_latency_ms": float(np.percentile(latencies, 99) * 1000),
+                }
+            )
+            print(
+                f"{Path(tokenizer_path).name} batch_size={batch_size} {domain}: "
+                f"{num_bytes / seconds / 2**20:.2f} MiB/s",
+                flush=True,
+            )
+
+    result["peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return result
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Return a description of every run that is more than tolerance slower than in the baseline."""
+    regressions = []
+    for name, result in results["tokenizers"].items():
+        if name not in baseline["tokenizers"]:
+            continue
+        baseline_runs = {
+            (run["batch_size"], run["domain"]): run for run in baseline["tokenizers"][name]["runs"]
+        }
+        for run in result["runs"]:
+            baseline_run = baseline_runs.get((run["batch_size"], run["domain"]))
+            if baseline_run is None:
+                continue
+            ratio = run["bytes_per_second"] / baseline_run["bytes_per_second"]
+            if ratio < 1 - tolerance:
+                regressions.append(
+                    f"{name} batch_size={run['batch_size']} {run['domain']}: "
+                    f"{ratio:.2f}x the throughput of the baseline"
+                )
+    return regressions
+
+
+@click.command()
+@click.option(
+    "--tokenizer_paths",
+    type=str,
+    default=None,
+    help="Comma-separated tokenizer.json files or tokenizer directories. Defaults to all tokenizers in tokenizer_json/.",
+)
+@click.option(
+    "--corpus_path",
+    type=str,
+    default="benchmarks/encode_corpus.jsonl",
+    help="Benchmark corpus, generated if it does not exist.",
+)
+@click.option(
+    "--num_docs",
+    type=int,
+    default=200,
+    help="Number of documents per domain when generating the corpus.",
+)
+@click.option(
+    "--batch_sizes",
+    type=str,
+    default="1,16,256",
+    help="Comma-separated batch sizes to benchmark.",
+)
+@click.option(
+    "--num_threads",
+    type=int,
+    default=None,
+    help="Number of threads for batch encoding (RAYON_RS_NUM_CPUS). Defaults to all cores.",
+)
+@click.option(
+    "--output_path",
+    type=str,
+    default="benchmarks/encode_results.json",
+    help="Where to save the results.",
+)
+@click.option(
+    "--baseline_path",
+    type=str,
+    default=None,
+    help="Results of a previous run to compare against. Exits with an error if any run is slower.",
+)
+@click.option(
+    "--tolerance",
+    type=float,
+    default=0.1,
+    help="Allowed relative slowdown compared to the baseline.",
+)
+def main(
+    tokenizer_paths: str,
+    corpus_path: str,
+    num_docs: int,
+    batch_sizes: str,
+    num_threads: int,
+    output_path: str,
+    baseline_path: str,
+    tolerance: float,
+):
+    if tokenizer_paths:
+        tokenizer_paths = tokenizer_paths.split(",")
+    else:
+        tokenizer_paths = sorted(str(p) for p in Path("tokenizer_json").iterdir() if p.is_dir())
+    batch_sizes = [int(b) for b in batch_sizes.split(",")]
+    if num_threads:
+        os.environ["RAYON_RS_NUM_CPUS"] = str(num_threads)
+
+    docs = get_benchmark_corpus(corpus_path, num_docs)
+    results = {
+        "environment": {
+            "tokenizers_version": tokenizers.__version__,
+            "python_version": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "num_threads": num_threads or os.cpu_count(),
+        },
+        "corpus_path": corpus_path,
+        "tokenizers": {},
+    }
+
+    # every tokenizer is benchmarked in a new process, so that the peak memory is its own
+    ctx = multiprocessing.get_context("spawn")
+    for tokenizer_path in tokenizer_paths:
+        with ctx.Pool(1) as pool:
+            result = pool.apply(benchmark_tokenizer, (tokenizer_path, docs, batch_sizes))
+        results["tokenizers"][Path(tokenizer_path).name] = result
+
+    ensure_dir(Path(output_path).parent)
+    with open(output_path, "w") as fout:
+        json.dump(results, fout, indent=5)
+    print(f"Saved results to {output_path}", flush=True)
+
+    if baseline_path:
+        with open(baseline_path) as fin:
+            baseline = json.load(fin)
+        regressions = compare_to_baseline(results, baseline, tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", flush=True)
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions compared to {baseline_path}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Check that FastPretokenizer (see utils) splits texts into exactly the same words as the pretokenizer
+of get_pretokenizer, in stage 1 (digit grouping and the GPT-2 regex) and stage 2 (digit grouping
+only), and measure how much faster it is.
+
+The check compares both on random texts: characters drawn from a set of edge cases (Unicode digits
+and other numeric characters, every kind of whitespace, combining marks, emoji), code points drawn
+from all of Unicode and from the BMP, digit runs of every length next to such characters, and lines
+of the training corpus with such characters inserted. The benchmark pretokenizes the lines of the training corpus
+(read the way the trainer reads files) and counts the words, as count_words does.
+"""
+
+import sys
+import json
+import time
+import random
+from collections import Counter
+from pathlib import Path
+
+import click
+
+from utils import FastPretokenizer, ensure_dir, get_files_with_num_bytes, get_pretokenizer
+
+RANDOM_SEED = 0
+
+EDGE_CASES = (
+    list("0123456789 \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f\x85\xa0\u1680\u180e\u2000\u2007\u200a")
+    + list("\u200b\u2028\u2029\u202f\u205f\u3000\ufeff")  # more kinds of (non-)whitespace
+    + list("٠١٢٣٤٥٦٧٨٩०१२३４５６𝟙𝟚𝟛")  # digits of other scripts
+    + list("½²³¹¼ⅫⅣ①⑳〇〤𐄇")  # numeric characters that are not digits
+    + list("aZéßΩжא文字한\u0301\u0345\u200d\u0903")  # letters and marks
+    + list(".,;:!?'\"-_()[]{}<>/\\|@#$%^&*+=~`€£¥©®™°•…—–")
+    + ["😀", "👍🏽", "\U0010fffd", "\ue000", "\x00", "\x7f", "\u0378", "\U000e0001"]
+)
+
+
+def random_codepoint(rng, max_code_point=0x10FFFF):
+    while True:
+        c = rng.randint(0, max_code_point)
+        if not 0xD800 <= c <= 0xDFFF:  # surrogates cannot be encoded
+            return chr(c)
+
+
+def generate_edge_cases(rng):
+    return "".join(rng.choices(EDGE_CASES, k=rng.randint(0, 40)))
+
+
+def generate_codepoints(rng):
+    return "".join(random_codepoint(rng) for _ in range(rng.randint(0, 40)))
+
+
+def generate_bmp_codepoints(rng):
+    # most code points outside the BMP are unassigned, so texts with them go to the regex
+    return "".join(random_codepoint(rng, 0xFFFF) for _ in range(rng.randint(0, 40)))
+
+
+def generate_digit_runs(rng):
+    pieces = []
+    for _ in range(rng.randint(1, 8)):
+        digits = rng.choice(["0123456789", "٠١٢٣٤٥٦٧٨٩", "0123456789²½"])
+        pieces.append("".join(rng.choices(digits, k=rng.randint(0, 13))))
+        pieces.append("".join(rng.choices(EDGE_CASES, k=rng.randint(0, 3))))
+    return "".join(pieces)
+
+
+def mutate_line(rng, line):
+    chars = list(line)
+    for _ in range(rng.randint(1, 5)):
+        chars.insert(rng.randint(0, len(chars)), rng.choice(EDGE_CASES + [random_codepoint(rng)]))
+    return "".join(chars)
+
+
+def read_lines(files):
+    """Read files line by line, keeping the line endings, as the trainer does."""
+    lines = []
+    for file in files:
+        with open(file, "rb") as fin:
+            lines.extend(line.decode("utf-8") for line in fin)
+    return lines
+
+
+def check(lines, num_texts, seed=RANDOM_SEED):
+    """Return the texts (at most 10 per stage) on which FastPretokenizer differs."""
+    rng = random.Random(seed)
+    generators = [
+        generate_edge_cases,
+        generate_codepoints,
+        generate_bmp_codepoints,
+        generate_digit_runs,
+    ]
+    if lines:
+        generators.append(lambda rng: mutate_line(rng, rng.choice(lines)))
+    texts = [generators[i % len(generators)](rng) for i in range(num_texts)]
+
+    mismatches = []
+    for do_whitespace_pretokenization in [True, False]:
+        pretokenizer, _ = get_pretokenizer(do_whitespace_pretokenization)
+        fast_pretokenizer = FastPretokenizer(do_whitespace_pretokenization)
+        stage_mismatches = []
+        for text in texts + lines:
+            expected = [word for word, _ in pretokenizer.pre_tokenize_str(text)]
+            actual = fast_pretokenizer(text)
+            if actual != expected:
+                stage_mismatches.append(
+                    {
+                        "do_whitespace_pretokenization": do_whitespace_pretokenization,
+                        "text": text,
+                        "expected": expected,
+                        "actual": actual,
+                    }
+                )
+        print(
+            f"do_whitespace_pretokenization={do_whitespace_pretokenization}: "
+            f"{len(stage_mismatches)} mismatches in {len(texts) + len(lines):,} texts",
+            flush=True,
+        )
+        mismatches.extend(stage_mismatches[:10])
+    return mismatches
+
+
+def benchmark(lines, do_whitespace_pretokenization):
+    pretokenizer, _ = get_pretokenizer(do_whitespace_pretokenization)
+    fast_pretokenizer = FastPretokenizer(do_whitespace_pretokenization)
+    num_bytes = sum(len(line.encode("utf-8")) for line in lines)
+
+    start_time = time.perf_counter()
+    regex_counts = Counter()
+    for line in lines:
+        regex_counts.update(word for word, _ in pretokenizer.pre_tokenize_str(line))
+    regex_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    fast_counts = Counter()
+    for line in lines:
+        fast_counts.update(fast_pretokenizer(line))
+    fast_seconds = time.perf_counter() - start_time
+
+    if fast_counts != regex_counts:
+        raise SystemExit("The word counts of FastPretokenizer differ from the regex pretokenizer")
+    return {
+        "do_whitespace_pretokenization": do_whitespace_pretokenization,
+        "num_bytes": num_bytes,
+        "num_unique_words": len(fast_counts),
+        "regex_bytes_per_second": num_bytes / regex_seconds,
+        "fast_bytes_per_second": num_bytes / fast_seconds,
+        "speedup": regex_seconds / fast_seconds,
+    }
+
+
+@click.command()
+@click.option(
+    "--corpus_dir",
+    type=str,
+    default=None,
+    help="Directory of training text files, used for the benchmark and as a source of test lines.",
+)
+@click.option(
+    "--num_bytes",
+    type=int,
+    default=10**8,
+    help="Number of bytes of corpus_dir to use.",
+)
+@click.option(
+    "--num_texts",
+    type=int,
+    default=100000,
+    help="Number of random texts to check.",
+)
+@click.option(
+    "--output_path",
+    type=str,
+    default="benchmarks/pretokenizer_results.json",
+    help="Where to save the benchmark results.",
+)
+def main(corpus_dir: str, num_bytes: int, num_texts: int, output_path: str):
+    lines = []
+    if corpus_dir:
+        files, _ = get_files_with_num_bytes(corpus_dir, num_bytes)
+        lines = read_lines(files)
+
+    mismatches = check(lines, num_texts)
+    if mismatches:
+        for mismatch in mismatches:
+            print(json.dumps(mismatch, ensure_ascii=False), flush=True)
+        sys.exit(1)
+    if not lines:
+        return
+
+    results = {"corpus_dir": corpus_dir, "runs": []}
+    for do_whitespace_pretokenization in [True, False]:
+        run = benchmark(lines, do_whitespace_pretokenization)
+        results["runs"].append(run)
+        print(
+            f"do_whitespace_pretokenization={do_whitespace_pretokenization}: regex "
+            f"{run['regex_bytes_per_second'] / 2**20:.2f} MiB/s, fast "
+            f"{run['fast_bytes_per_second'] / 2**20:.2f} MiB/s ({run['speedup']:.2f}x)",
+            flush=True,
+        )
+    ensure_dir(Path(output_path).parent)
+    with open(output_path, "w") as fout:
+        json.dump(results, fout, indent=5)
+    print(f"Saved results to {output_path}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+Measure the throughput and latency of tokenize_server on one machine. The server is started in its
+own process on a unix socket, and for each concurrency level, that many requests are kept in flight
+(spread over num_connections client connections) for the given duration. For reference, we also
+measure calling Tokenizer.encode on one text at a time in-process, which is what the server replaces.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import tempfile
+import subprocess
+from pathlib import Path
+
+import click
+import numpy as np
+
+from benchmark_encode import get_benchmark_corpus
+from tokenize_server import TokenizerClient
+from utils import ensure_dir, load_tokenizer
+
+RANDOM_SEED = 0
+
+
+async def wait_for_server(socket_path, process, timeout=300):
+    start_time = time.time()
+    while time.time() - start_time < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        if os.path.exists(socket_path):
+            try:
+                client = await TokenizerClient.connect(socket_path)
+                await client.close()
+                return
+            except ConnectionError:
+                pass
+        await asyncio.sleep(0.1)
+    raise TimeoutError(f"Server did not start within {timeout} seconds")
+
+
+async def run_load(socket_path, texts, concurrency, num_connections, duration):
+    """
+    Keep concurrency encode requests in flight for duration seconds, and return the number of
+    requests, bytes and tokens encoded, the latency of every request and the mean batch size.
+    """
+    clients = [await TokenizerClient.connect(socket_path) for _ in range(num_connections)]
+    metrics_before = (await clients[0].metrics())["encode"]
+    rng = random.Random(RANDOM_SEED)
+    latencies, num_bytes, num_tokens = [], 0, 0
+    end_time = time.perf_counter() + duration
+
+    async def worker(client):
+        nonlocal num_bytes, num_tokens
+        while time.perf_counter() < end_time:
+            text = rng.choice(texts)
+            start_time = time.perf_counter()
+            ids = await client.encode(text)
+            latencies.append(time.perf_counter() - start_time)
+            num_bytes += len(text.encode("utf-8"))
+            num_tokens += len(ids)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[worker(clients[i % num_connections]) for i in range(concurrency)])
+    seconds = time.perf_counter() - start_time
+    metrics_after = (await clients[0].metrics())["encode"]
+    for client in clients:
+        await client.close()
+    return {
+        "seconds": seconds,
+        "num_requests": len(latencies),
+        "num_bytes": num_bytes,
+        "num_tokens": num_tokens,
+        "latencies": latencies,
+        # the server's counters are cumulative, so take the difference over this run
+        "mean_batch_size": (metrics_after["num_requests"] - metrics_before["num_requests"])
+        / max(metrics_after["num_batches"] - metrics_before["num_batches"], 1),
+    }
+
+
+def benchmark_direct(tokenizer_path, texts, duration):
+    """Encode one text at a time in-process, for duration seconds."""
+    tokenizer = load_tokenizer(tokenizer_path)
+    rng = random.Random(RANDOM_SEED)
+    latencies, num_bytes = [], 0
+    end_time = time.perf_counter() + duration
+    while time.perf_counter() < end_time:
+        text = rng.choice(texts)
+        start_time = time.perf_counter()
+        tokenizer.encode(text)
+        latencies.append(time.perf_counter() - start_time)
+        num_bytes += len(text.encode("utf-8"))
+    return summarize(len(latencies), num_bytes, sum(latencies), latencies)
+
+
+def summarize(num_requests, num_bytes, seconds, latencies):
+    return {
+        "requests_per_second": num_requests / seconds,
+        "bytes_per_second": num_bytes / seconds,
+        "p50_latency_ms": float(np.percentile(latencies, 50) * 1000),
+        "p99_latency_ms": float(np.percentile(latencies, 99) * 1000),
+    }
+
+
+@click.command()
+@click.option(
+    "--tokenizer_path",
+    type=str,
+    help="Path to tokenizer.json, or a tokenizer directory.",
+)
+@click.option(
+    "--corpus_path",
+    type=str,
+    default="benchmarks/encode_corpus.jsonl",
+    help="Benchmark corpus (see benchmark_encode), generated if it does not exist.",
+)
+@click.option(
+    "--domains",
+    type=str,
+    default="prose,code,numbers",
+    help="Comma-separated domains of the corpus to send as requests.",
+)
+@click.option(
+    "--concurrency",
+    type=str,
+    default="1,4,16,64,256",
+    help="Comma-separated numbers of requests in flight to measure.",
+)
+@click.option(
+    "--num_connections",
+    type=int,
+    default=8,
+    help="Number of client connections the requests are spread over.",
+)
+@click.option(
+    "--duration",
+    type=float,
+    default=10,
+    help="Seconds to run each concurrency level for.",
+)
+@click.option(
+    "--server_args",
+    type=str,
+    default="",
+    help="Extra arguments for tokenize_server, e.g. '--max_wait_ms 5 --num_threads 4'.",
+)
+@click.option(
+    "--output_path",
+    type=str,
+    default="benchmarks/server_results.json",
+    help="Where to save the results.",
+)
+def main(
+    tokenizer_path: str,
+    corpus_path: str,
+    domains: str,
+    concurrency: str,
+    num_connections: int,
+    duration: float,
+    server_args: str,
+    output_path: str,
+):
+    docs = get_benchmark_corpus(corpus_path, 200)
+    texts = [text for domain in domains.split(",") for text in docs[domain]]
+    results = {"tokenizer_path": tokenizer_path, "server_args": server_args, "runs": []}
+
+    results["direct"] = benchmark_direct(tokenizer_path, texts, duration)
+    print(
+        f"direct encode: {results['direct']['requests_per_second']:.0f} requests/s, "
+        f"p50 {results['direct']['p50_latency_ms']:.2f} ms",
+        flush=True,
+    )
+
+    socket_path = os.path.join(tempfile.mkdtemp(), "tokenize_server.sock")
+    cmd = [sys.executable, "-m", "tokenize_server", "--tokenizer_path", tokenizer_path]
+    cmd += ["--socket_path", socket_path] + server_args.split()
+    process = subprocess.Popen(cmd, cwd=Path(__file__).parent)
+    try:
+        asyncio.run(wait_for_server(socket_path, process))
+        for c in [int(c) for c in concurrency.split(",")]:
+            load = asyncio.run(run_load(socket_path, texts, c, num_connections, duration))
+            run = {
+                "concurrency": c,
+                **summarize(load["num_requests"], load["num_bytes"], load["seconds"], load["latencies"]),
+                "tokens_per_second": load["num_tokens"] / load["seconds"],
+                "mean_batch_size": load["mean_batch_size"],
+            }
+            results["runs"].append(run)
+            print(
+                f"concurrency={c}: {run['requests_per_second']:.0f} requests/s, "
+                f"{run['bytes_per_second'] / 2**20:.2f} MiB/s, p50 {run['p50_latency_ms']:.2f} ms, "
+                f"p99 {run['p99_latency_ms']:.2f} ms, mean batch size {run['mean_batch_size']:.1f}",
+                flush=True,
+            )
+    finally:
+        process.terminate()
+        process.wait()
+
+    ensure_dir(Path(output_path).parent)
+    with open(output_path, "w") as fout:
+        json.dump(results, fout, indent=5)
+    print(f"Saved results to {output_path}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
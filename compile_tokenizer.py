@@ -0,0 +1,73 @@
+"""
+Compile a tokenizer.json into packed arrays that load in milliseconds (see utils.compile_tokenizer),
+and check that the compiled tokenizer encodes and decodes a corpus exactly like the original.
+"""
+
+import time
+from pathlib import Path
+
+import click
+from tokenizers import Tokenizer
+
+from benchmark_encode import get_benchmark_corpus
+from utils import CompiledTokenizer, compile_tokenizer, load_compiled_tokenizer
+
+
+@click.command()
+@click.option(
+    "--tokenizer_path",
+    type=str,
+    help="Path to tokenizer.json.",
+)
+@click.option(
+    "--output_dir",
+    type=str,
+    default=None,
+    help="Where to save the compiled tokenizer. Defaults to compiled/ next to tokenizer.json.",
+)
+@click.option(
+    "--corpus_path",
+    type=str,
+    default="benchmarks/encode_corpus.jsonl",
+    help="Corpus to check the compiled tokenizer on (the benchmark_encode corpus, generated if it does not exist).",
+)
+def main(tokenizer_path: str, output_dir: str, corpus_path: str):
+    output_dir = Path(output_dir) if output_dir else Path(tokenizer_path).parent / "compiled"
+    compile_tokenizer(tokenizer_path, output_dir)
+    print(f"Compiled {tokenizer_path} to {output_dir}", flush=True)
+
+    start_time = time.time()
+    tokenizer = Tokenizer.from_file(tokenizer_path)
+    json_seconds = time.time() - start_time
+    start_time = time.time()
+    compiled_tokenizer = CompiledTokenizer(output_dir)
+    compiled_seconds = time.time() - start_time
+    start_time = time.time()
+    rebuilt_tokenizer = load_compiled_tokenizer(output_dir)
+    rebuilt_seconds = time.time() - start_time
+    print(
+        f"Load time: {json_seconds:.3f}s from tokenizer.json, {compiled_seconds:.3f}s compiled, "
+        f"{rebuilt_seconds:.3f}s rebuilding the tokenizers model from the compiled arrays",
+        flush=True,
+    )
+
+    texts = [text for domain_texts in get_benchmark_corpus(corpus_path, 200).values() for text in domain_texts]
+    expected = [e.ids for e in tokenizer.encode_batch(texts)]
+    start_time = time.time()
+    actual = compiled_tokenizer.encode_batch(texts)
+    compiled_seconds = time.time() - start_time
+    rebuilt = [e.ids for e in rebuilt_tokenizer.encode_batch(texts)]
+    for text, e, a, r in zip(texts, expected, actual, rebuilt):
+        if e != a or e != r:
+            raise SystemExit(f"Compiled tokenizer encodes differently: {text[:100]!r}")
+        if compiled_tokenizer.decode(a) != tokenizer.decode(e):
+            raise SystemExit(f"Compiled tokenizer decodes differently: {text[:100]!r}")
+    print(
+        f"Checked that {len(texts)} texts from {corpus_path} encode and decode identically "
+        f"(CompiledTokenizer encoded them in {compiled_seconds:.2f}s)",
+        flush=True,
+    )
+
+
+if __name__ == "__main__":
+    main()
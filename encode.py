@@ -3,6 +3,7 @@ Calculate encoding efficiency (in bytes per token) over a corpus of text.
 """
 
 import json
+from collections import Counter
 from pathlib import Path
 from tokenizers import Tokenizer
 import click
@@ -10,24 +11,282 @@ import random
 import regex as re
 
 import os
+import mmap
+import time
+import numpy as np
+from itertools import starmap
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 from tqdm import tqdm
-from collections import Counter
 from utils import (
-    get_files_with_num_bytes,
+    append_results,
+    get_manifest,
+    resolve_data_path,
     read_json,
     ensure_dir,
     get_pretokenization_regex,
+    get_utf8_boundary,
+    save_token_counts,
+    is_compiled_tokenizer,
+    read_compiled_tokenizer,
+    load_compiled_tokenizer,
+    COMPILED_HEADER_FILE,
+    RESULTS_DB,
 )
 
 RANDOM_SEED = 5
 NUM_BYTES = 10**9
+NUM_CHUNKS_PER_FILE = 20
+PRETOKEN_CONTEXT_BYTES = 64
+PARAGRAPHS_PER_BATCH_ITEM = 100
+
+# Set in each encoding process by init_worker
+_tokenizer = None
+
+
+def init_worker(tokenizer, dropout=None):
+    global _tokenizer
+    # forked workers inherit the tokenizer loaded by the parent process, so they do not load it again
+    _tokenizer = tokenizer
+    if dropout:
+        _tokenizer.model.dropout = dropout
+
+
+def get_vocab_size(tokenizer_json):
+    """
+    The vocab size (with added tokens) of the tokenizer described by tokenizer_json, which can also be
+    the header of a compiled tokenizer.
+    """
+    if "compiled" in tokenizer_json:
+        ids = set(range(tokenizer_json["compiled"]["num_tokens"]))
+    else:
+        ids = set(tokenizer_json["model"]["vocab"].values())
+    ids.update(token["id"] for token in tokenizer_json.get("added_tokens") or [])
+    return len(ids)
+
+
+def get_chunk_offsets(file, num_chunks=NUM_CHUNKS_PER_FILE, start=0, end=None):
+    """
+    Return the byte offsets that split bytes [start, end) of file into chunks of whole paragraphs
+    (separated by "\n\n"), with max(num_paragraphs // num_chunks, 100) paragraphs per chunk.
+    """
+    end = os.path.getsize(file) if end is None else end
+    if end == start:
+        return [start, end]
+
+    # "\n\n" never occurs inside a multi-byte UTF-8 character, so we can find paragraph
+    # boundaries on the raw bytes without reading the whole file into memory
+    separator_ends = []
+    with open(file, "rb") as fin, mmap.mmap(
+        fin.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mm:
+        pos = mm.find(b"\n\n", start, end)
+        while pos != -1:
+            separator_ends.append(pos + 2)
+            pos = mm.find(b"\n\n", pos + 2, end)
+
+    num_paragraphs = len(separator_ends) + 1
+    chunk_size = max(num_paragraphs // num_chunks, 100)
+    offsets = [start]
+    offsets += [separator_ends[i - 1] for i in range(chunk_size, num_paragraphs, chunk_size)]
+    offsets.append(end)
+    return offsets
+
+
+def get_block_offsets(file, block_size, start=0, end=None):
+    """
+    Return the byte offsets that split bytes [start, end) of file into blocks of roughly block_size
+    bytes, so that the file can be encoded in memory bounded by block_size instead of the file size.
+    Blocks are cut after the first paragraph separator following each block_size bytes, falling back
+    to a newline and then to any character boundary when the text has no line breaks.
+    """
+    end = os.path.getsize(file) if end is None else end
+    offsets = [start]
+    with open(file, "rb") as fin:
+        while end - offsets[-1] > block_size:
+            cut = offsets[-1] + block_size
+            fin.seek(cut)
+            window = fin.read(min(block_size, end - cut))
+            for sep in (b"\n\n", b"\n"):
+                pos = window.find(sep)
+                if pos != -1:
+                    pos += len(sep)
+                    break
+            else:
+                pos = get_utf8_boundary(window, 0)
+            offsets.append(min(cut + pos, end))
+    offsets.append(end)
+    return offsets
+
+
+def encode_batched(tokenizer, text, return_ids=False):
+    """
+    Encode text as a batch of paragraph groups, which the tokenizer encodes in parallel. Return the
+    token ids as a uint32 array if return_ids, otherwise only the token count.
+    """
+    pps = text.split("\n\n")
+    batch = [
+        "\n\n".join(pps[i : i + PARAGRAPHS_PER_BATCH_ITEM])
+        for i in range(0, len(pps), PARAGRAPHS_PER_BATCH_ITEM)
+    ]
+    batch = [item + "\n\n" for item in batch[:-1]] + [item for item in batch[-1:] if item]
+    # encode_batch_fast skips computing offsets, but is not available in older tokenizers versions
+    encode_batch = getattr(tokenizer, "encode_batch_fast", tokenizer.encode_batch)
+    encodings = encode_batch(batch)
+
+    if return_ids:
+        ids = [np.array(e.ids, dtype=np.uint32) for e in encodings]
+        return np.concatenate(ids) if ids else np.zeros(0, dtype=np.uint32)
+    return sum(len(e) for e in encodings)
+
+
+# The start of a whitespace run after non-whitespace, which is always a pretoken boundary
+PRETOKEN_BOUNDARY_PATTERN = re.compile(r"(?r)(?<=\S)\s")  # searched from the end
+
+
+def _count_matches(pattern, s, pos, end):
+    """
+    Count the matches of pattern that start in s[pos:end], scanning from pos, which must be a match
+    boundary. s may continue past end, so that the matches starting before end are complete.
+    """
+    boundary = PRETOKEN_BOUNDARY_PATTERN.search(s, pos, end + 1)
+    boundary = boundary.start() if boundary else pos
+
+    # concurrent=True releases the GIL, so we can count while the tokenizer encodes
+    num_matches = pattern.subn("", s, pos=pos, endpos=boundary, concurrent=True)[1]
+    for m in pattern.finditer(s, pos=boundary):
+        if m.start() >= end:
+            break
+        num_matches += 1
+    return num_matches
+
+
+def count_pretokens(pretok_regex, text, context="", prefix=""):
+    """
+    Count the matches of pretok_regex (from get_pretokenization_regex) that start inside text, when
+    text is preceded by prefix and followed by context, without creating a match object for every
+    pretoken. The counts of consecutive chunks of a text add up to the count of the whole text.
+
+    No pretoken continues from non-whitespace into whitespace, so the start of a whitespace run
+    after non-whitespace is always a match boundary. We resume matching at the last such boundary
+    in prefix (or at the start of prefix, which should then be the start of the text), so that a
+    match which started in the previous chunk and continues into text is not counted again. We
+    count everything before the last boundary in text with subn and only step through the short tail
+    match by match.
+    """
+    pattern = re.compile(pretok_regex)
+    s = prefix + text + context
+    start = PRETOKEN_BOUNDARY_PATTERN.search(s, 0, len(prefix) + 1)
+    start = start.start() if start else 0
+    return _count_matches(pattern, s, start, len(prefix) + len(text)) - _count_matches(
+        pattern, s, start, len(prefix)
+    )
+
+
+def read_pretoken_prefix(fin, start, range_start=0):
+    """
+    Return the text before byte start of fin that count_pretokens needs as prefix: back to a match
+    boundary, or to range_start (the start of the byte range being encoded).
+    """
+    num_bytes = PRETOKEN_CONTEXT_BYTES
+    while True:
+        prefix_start = max(start - num_bytes, range_start)
+        fin.seek(prefix_start)
+        # the prefix may start inside a multi-byte character
+        prefix = fin.read(start - prefix_start).decode("utf-8", errors="ignore")
+        if prefix_start == range_start or PRETOKEN_BOUNDARY_PATTERN.search(prefix):
+            return prefix
+        num_bytes *= 2
+
+
+def encode_chunk(
+    file, start, end, pretok_regex=None, return_token_counts=False, range_end=None, range_start=0
+):
+    """
+    Encode bytes [start, end) of file and return the number of tokens, the number of pretokens
+    (if pretok_regex is given), and the count of each token id (if return_token_counts). range_start
+    and range_end are the byte range of file being encoded (by default, the whole file).
+    """
+    range_end = os.path.getsize(file) if range_end is None else range_end
+    with open(file, "rb") as fin:
+        prefix = read_pretoken_prefix(fin, start, range_start) if pretok_regex else ""
+        fin.seek(start)
+        data = fin.read(min(end + PRETOKEN_CONTEXT_BYTES, range_end) - start)
+    text = data[: end - start].decode("utf-8")
+
+    # Note to self: num_pretokens will not be completely accurate for superword tokenizers because
+    # the tokenizers training library splits on newline (separately from pretokenization). However,
+    # the upper bound calculation is mainly for pretok tokenizers anyway, so we won't worry too
+    # much about this case.
+    # Whitespace runs at the end of the chunk match differently depending on what follows, and a
+    # match may have started before the chunk, so we look around the chunk and count the pretokens
+    # that start inside it
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        if pretok_regex:
+            context = data[end - start :].decode("utf-8", errors="ignore")
+            pretoken_future = executor.submit(
+                count_pretokens, pretok_regex, text, context, prefix
+            )
+
+        # Every chunk ends in a paragraph separator, as if the file were encoded in one go
+        chunk = text if end < range_end else text + "\n\n"
+        encoded = encode_batched(_tokenizer, chunk, return_ids=return_token_counts)
+        num_pretokens = pretoken_future.result() if pretok_regex else None
+    if return_token_counts:
+        token_counts = np.bincount(encoded, minlength=_tokenizer.get_vocab_size())
+        return len(encoded), num_pretokens, token_counts
+
+    return encoded, num_pretokens, None
+
+
+def _encode_chunk_task(args):
+    file_range, start, end, pretok_regex, return_token_counts = args
+    file, range_start, range_end = file_range
+    return file_range, encode_chunk(
+        file, start, end, pretok_regex, return_token_counts, range_end, range_start
+    )
+
+
+def get_truncated_token_counts(vocab, merges, token_counts, vocab_sizes):
+    """
+    Given the count of each token id from encoding with a full BPE tokenizer, return the number of
+    tokens we would get using only the top vocab_size merges, for each vocab_size in vocab_sizes.
+
+    A merge can only use tokens created by earlier merges, so BPE applies merges in increasing
+    order of rank. Encoding with the top N merges is therefore the same as encoding with all merges
+    and then undoing every merge of rank >= N, where undoing a merge adds one token.
+    """
+    merges = [m.split(" ") if isinstance(m, str) else m for m in merges]
+
+    # if a token can be created by more than one merge, attribute it to the first one
+    first_merge = {}
+    for rank, (left, right) in enumerate(merges):
+        first_merge.setdefault(left + right, rank)
+
+    # walk merges from last to first, pushing the number of times each token occurs in the merge
+    # trees of the encoded tokens down to its two parts
+    node_counts = token_counts.astype(np.int64)
+    merge_counts = np.zeros(len(merges) + 1, dtype=np.int64)
+    for rank in range(len(merges) - 1, -1, -1):
+        left, right = merges[rank]
+        if first_merge[left + right] != rank:
+            continue
+        count = node_counts[vocab[left + right]]
+        merge_counts[rank] = count
+        node_counts[vocab[left]] += count
+        node_counts[vocab[right]] += count
+
+    # number of tokens added by undoing all merges of rank >= N
+    undone_counts = np.cumsum(merge_counts[::-1])[::-1]
+    total = int(token_counts.sum())
+    return {v: total + int(undone_counts[min(v, len(merges))]) for v in vocab_sizes}
 
 
 @click.command()
 @click.option(
     "--tokenizer_path",
     type=str,
-    help="Path to tokenizer.json",
+    help="Path to tokenizer.json, or to a directory compiled from it by compile_tokenizer.py",
 )
 @click.option(
     "--corpus_dir",
@@ -53,13 +312,19 @@ NUM_BYTES = 10**9
     type=int,
     default=None,
 )
+@click.option(
+    "--vocab_sizes",
+    type=str,
+    default=None,
+    help="Comma-separated vocab sizes (e.g. 1000,10000,200000) to compute encoding efficiency for in a single pass.",
+)
 @click.option(
     "--dropout", type=float, help="Dropout rate for the tokenizer.", default=None
 )
 @click.option(
     "--save_token_stats",
     is_flag=True,
-    help="Save token counts for each file.",
+    help="Add the count of each token id (per file and in total) with per-token metrics to encoded/<tokenizer>/token_stats.npz.",
     default=False,
 )
 @click.option(
@@ -68,6 +333,30 @@ NUM_BYTES = 10**9
     help="Save bytes per token stats.",
     default=False,
 )
+@click.option(
+    "--num_workers",
+    type=int,
+    default=1,
+    help="Number of processes to encode with. Files are split into chunks which are spread across workers.",
+)
+@click.option(
+    "--num_chunks_per_file",
+    type=int,
+    default=NUM_CHUNKS_PER_FILE,
+    help="Number of chunks to split each file into. Use at least num_workers when encoding a single file.",
+)
+@click.option(
+    "--block_size",
+    type=int,
+    default=None,
+    help="If given, stream files in blocks of about this many bytes (instead of num_chunks_per_file chunks), so memory stays bounded regardless of file size.",
+)
+@click.option(
+    "--results_db",
+    type=str,
+    default=RESULTS_DB,
+    help="SQLite database to append the token and byte counts to (see utils.query_results). Pass an empty string to skip.",
+)
 def main(
     tokenizer_path: str,
     corpus_dir: str,
@@ -75,21 +364,63 @@ def main(
     output_dir: str,
     num_bytes: int,
     vocab_size: int,
+    vocab_sizes: str,
     dropout: float,
     save_token_stats: bool,
     save_bytes_per_token: bool,
+    num_workers: int,
+    num_chunks_per_file: int,
+    block_size: int,
+    results_db: str,
 ):
     random.seed(RANDOM_SEED)
     if corpus_dir:
         corpus_dir = Path(corpus_dir)
-    tokenizer = Tokenizer.from_file(tokenizer_path)
     tokenizer_name = os.path.basename(os.path.dirname(tokenizer_path))
-    tokenizer_json = read_json(tokenizer_path)
+    tokenizer_dir = Path(os.path.abspath(tokenizer_path)).parent
+    # a compiled tokenizer is in compiled/ next to its tokenizer.json, and is built from its arrays
+    # instead of tokenizer_json
+    compiled = is_compiled_tokenizer(tokenizer_path)
+    if compiled:
+        tokenizer_name = tokenizer_dir.name
+    # the tokenizer is built once from tokenizer_json, after truncating it if needed
+    with open(Path(tokenizer_path) / COMPILED_HEADER_FILE if compiled else tokenizer_path) as fin:
+        tokenizer_str = fin.read()
+    tokenizer_json = json.loads(tokenizer_str)
+    num_merges = None
+    full_vocab_size = get_vocab_size(tokenizer_json)
+
+    # if vocab_sizes is given, encode once with all merges and derive the counts for each vocab_size
+    if vocab_sizes:
+        vocab_sizes = [int(v) for v in vocab_sizes.split(",")]
+        if vocab_size or dropout:
+            raise ValueError("--vocab_sizes cannot be combined with --vocab_size or --dropout.")
+        if tokenizer_json["model"]["type"] != "BPE":
+            raise ValueError(
+                f"Tokenizer type {tokenizer_json['model']['type']} not supported for --vocab_sizes"
+            )
+        if max(vocab_sizes) > full_vocab_size:
+            raise ValueError(
+                f"Vocab size ({max(vocab_sizes)}) > tokenizer vocab size ({full_vocab_size})."
+            )
+        print(f"We will sweep over the top {vocab_sizes} merges in a single pass.", flush=True)
 
+        # truncated tokenizers do not ignore merges, so the full tokenizer should not either
+        tokenizer_json["model"]["ignore_merges"] = False
+        if compiled:
+            _, tokens, merge_ids = read_compiled_tokenizer(tokenizer_path)
+            vocab = dict(zip(tokens, range(len(tokens))))
+            merges = [(tokens[left], tokens[right]) for left, right in merge_ids.tolist()]
+            num_merges = len(merges)
+        else:
+            vocab, merges = tokenizer_json["model"]["vocab"], tokenizer_json["model"]["merges"]
+        count_pretokens = False
     # if vocab_size is given, construct tokenizer with the desired vocab_size
-    if vocab_size and vocab_size <= tokenizer.get_vocab_size():
+    elif vocab_size and vocab_size <= full_vocab_size:
         print(f"We will only use the top {vocab_size} merges for encoding.", flush=True)
-        if tokenizer_json["model"]["type"] == "BPE":
+        if compiled:
+            num_merges = vocab_size
+        elif tokenizer_json["model"]["type"] == "BPE":
             merges = tokenizer_json["model"]["merges"]
             tokenizer_json["model"]["merges"] = merges[:vocab_size]
             tokenizer_json["model"]["ignore_merges"] = False
@@ -100,89 +431,141 @@ def main(
             raise ValueError(
                 f"Tokenizer type {tokenizer_json['model']['type']} not supported"
             )
-
-        # create temporary new tokenizer file with truncated vocabulary
-        tokenizer_path = tokenizer_path.replace(
-            "tokenizer.json", f"tokenizer_{vocab_size}.json"
-        )
-        with open(tokenizer_path, "w") as fout:
-            json.dump(tokenizer_json, fout, indent=4, ensure_ascii=False)
-
-        tokenizer = Tokenizer.from_file(tokenizer_path)
         count_pretokens = False
     elif vocab_size:
         raise ValueError(
-            f"Vocab size ({vocab_size}) > tokenizer vocab size ({tokenizer.get_vocab_size()})."
+            f"Vocab size ({vocab_size}) > tokenizer vocab size ({full_vocab_size})."
         )
     else:
         count_pretokens = True
 
+    if compiled:
+        tokenizer = load_compiled_tokenizer(tokenizer_path, num_merges)
+    else:
+        if vocab_size or vocab_sizes:
+            tokenizer_str = json.dumps(tokenizer_json)
+        tokenizer = Tokenizer.from_str(tokenizer_str)
+    del tokenizer_str
     print(f"Using tokenizer from {tokenizer_path}", flush=True)
 
     if dropout:
         print(f"Setting dropout to {dropout}", flush=True)
-        tokenizer.model.dropout = dropout
 
+    pretok_regex = None
     if count_pretokens:
         pretok_regex = get_pretokenization_regex(tokenizer_json)
         print(f"Using pretokenization regex: {pretok_regex}", flush=True)
 
-    def encode_file(file, count_pretokens=False):
-        """
-        Encode file and return the number of tokens.
-        """
-        with open(file, "r") as fin:
-            text = fin.read()
-
-        # Split into chunks so we don't OOM
-        # This is ok bc tokenizer training splits on newline
-        tokens = []
-        pps = text.split("\n\n")
-        chunk_size = max(len(pps) // 20, 100)
-        for i in tqdm(range(0, len(pps), chunk_size), desc=os.path.basename(file)):
-            chunk = "\n\n".join(pps[i : i + chunk_size]) + "\n\n"
-            encoded = tokenizer.encode(chunk)
-            tokens.extend(encoded.ids)
-            # Note to self: num_pretokens will not be completely accurate for superword tokenizers because
-            # the tokenizers training library splits on newline (separately from pretokenization). However,
-            # the upper bound calculation is mainly for pretok tokenizers anyway, so we won't worry too
-            # much about this case.
-
-        num_pretokens = (
-            len([m.group() for m in re.finditer(pretok_regex, text)])
-            if count_pretokens
-            else None
-        )
-
-        return tokens, num_pretokens
-
-    # Collect list of files to be encoded
+    # Collect byte ranges of files to be encoded
     if corpus_dir:
         if num_bytes == -1:
             num_bytes = None
-        file_list, byte_count = get_files_with_num_bytes(
-            corpus_dir, num_bytes, loop_around=False
-        )
+        manifest = get_manifest(corpus_dir, num_bytes, loop_around=False, seed=RANDOM_SEED)
+        file_ranges = [
+            (resolve_data_path(path), start, end) for path, start, end in manifest["files"]
+        ]
+        byte_count = manifest["total_bytes"]
     elif file_path:
-        file_list = [file_path]
+        file_ranges = [(file_path, 0, os.path.getsize(file_path))]
         byte_count = os.path.getsize(file_path)
     else:
         raise ValueError("Either corpus_dir or file_path must be provided.")
 
-    # Count tokens in files
+    start_time = time.time()
+
+    # Count tokens in files. The serial path (num_workers=1) runs exactly the same chunks in-process,
+    # so totals do not depend on the number of workers.
+    if num_workers > 1:
+        # Split the cores between workers, since each one also encodes its batches in parallel
+        os.environ.setdefault(
+            "RAYON_RS_NUM_CPUS", str(max(os.cpu_count() // num_workers, 1))
+        )
+        pool = Pool(num_workers, initializer=init_worker, initargs=(tokenizer, dropout))
+        starmap_fn, imap_fn = pool.starmap, pool.imap_unordered
+    else:
+        pool = None
+        init_worker(tokenizer, dropout)
+        starmap_fn, imap_fn = starmap, map
+
+    if block_size:
+        file_offsets = list(
+            starmap_fn(
+                get_block_offsets,
+                [(file, block_size, start, end) for file, start, end in file_ranges],
+            )
+        )
+    else:
+        file_offsets = list(
+            starmap_fn(
+                get_chunk_offsets,
+                [(file, num_chunks_per_file, start, end) for file, start, end in file_ranges],
+            )
+        )
+    return_token_counts = save_token_stats or bool(vocab_sizes)
+    tasks = [
+        (file_range, start, end, pretok_regex, return_token_counts)
+        for file_range, offsets in zip(file_ranges, file_offsets)
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ]
+
     token_count = 0
     pretoken_count = 0
-    for file in file_list:
-        tokens, num_pretokens = encode_file(file, count_pretokens=count_pretokens)
-        token_count += len(tokens)
+    total_token_counts = None
+    # dense counts while a file is being encoded, then the (token_ids, counts) of its nonzero counts,
+    # so that memory does not grow with the vocab size times the number of files
+    file_token_counts = {}
+    num_chunks_left = Counter(file_range for file_range, *_ in tasks)
+    for file_range, (num_tokens, num_pretokens, token_counts) in tqdm(
+        imap_fn(_encode_chunk_task, tasks), total=len(tasks), desc="Encoding"
+    ):
+        token_count += num_tokens
         if count_pretokens:
             pretoken_count += num_pretokens
+        if return_token_counts:
+            if total_token_counts is None:
+                total_token_counts = token_counts.copy()
+            else:
+                total_token_counts += token_counts
         if save_token_stats:
+            if file_range in file_token_counts:
+                file_token_counts[file_range] += token_counts
+            else:
+                file_token_counts[file_range] = token_counts
+            num_chunks_left[file_range] -= 1
+            if num_chunks_left[file_range] == 0:
+                counts = file_token_counts[file_range]
+                token_ids = np.flatnonzero(counts)
+                file_token_counts[file_range] = (token_ids, counts[token_ids])
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    encode_seconds = time.time() - start_time
+
+    # the token count for each vocab size (None for the whole tokenizer)
+    if vocab_sizes:
+        token_counts = get_truncated_token_counts(vocab, merges, total_token_counts, vocab_sizes)
+    else:
+        token_counts = {vocab_size: token_count}
+
+    if save_token_stats:
+        filenames = []
+        for file, _, end in file_ranges:
             filename = os.path.basename(file).split(".txt")[0]
-            ensure_dir(f"encoded/{tokenizer_name}")
-            with open(f"encoded/{tokenizer_name}/{filename}.json", "w") as fout:
-                token_counter = Counter(tokens)
-                json.dump(token_counter, fout, indent=5)
+            if end < os.path.getsize(file):
+                filename += f"_truncated_{end}"
+            filenames.append(filename)
+        summary = save_token_counts(
+            f"encoded/{tokenizer_name}",
+            tokenizer,
+            [file_token_counts[file_range] for file_range in file_ranges],
+            filenames,
+        )
+        print(
+            f"Saved token stats to encoded/{tokenizer_name}/token_stats.npz "
+            f"(superword fraction {summary['superword_fraction']:.4f})",
+            flush=True,
+        )
 
     # Save encoding efficiency stats to output_dir
     if save_bytes_per_token:
@@ -190,23 +573,20 @@ def main(
         output_dir = Path(output_dir)
         ensure_dir(output_dir)
 
-        if vocab_size:
-            out_filename = f"token_byte_counts_{vocab_size}.json"
-        else:
-            out_filename = "token_byte_counts.json"
-
-        with open(output_dir / out_filename, "w") as fout:
-            d = {
-                "test_files": file_list,
-                "token_count": token_count,
-                "byte_count": byte_count,
-            }
-            json.dump(d, fout, indent=5)
+        for v, count in token_counts.items():
+            out_filename = f"token_byte_counts_{v}.json" if v else "token_byte_counts.json"
+            with open(output_dir / out_filename, "w") as fout:
+                d = {
+                    "test_files": [file for file, _, _ in file_ranges],
+                    "token_count": count,
+                    "byte_count": byte_count,
+                }
+                json.dump(d, fout, indent=5)
 
         if count_pretokens:
             with open(output_dir / "pretoken_byte_counts.json", "w") as fout:
                 d = {
-                    "test_files": file_list,
+                    "test_files": [file for file, _, _ in file_ranges],
                     "pretoken_count": pretoken_count,
                     "byte_count": byte_count,
                 }
@@ -214,8 +594,31 @@ def main(
 
         print(f"Saved to {output_dir / out_filename}", flush=True)
 
-    if vocab_size and vocab_size <= tokenizer.get_vocab_size():
-        os.remove(tokenizer_path)
+    if results_db:
+        meta = read_json(tokenizer_dir / "meta.json") if (tokenizer_dir / "meta.json").exists() else {}
+        if output_dir:
+            eval_dataset = Path(output_dir).name
+        else:
+            eval_dataset = corpus_dir.name if corpus_dir else os.path.basename(file_path)
+        rows = [
+            {
+                "tokenizer": tokenizer_name,
+                "tokenizer_dir": str(tokenizer_dir),
+                "eval_dataset": eval_dataset,
+                "num_inherit_merges": meta.get("num_initial_merges"),
+                "vocab_size": v or tokenizer.get_vocab_size(),
+                "dropout": dropout,
+                "token_count": count,
+                "pretoken_count": pretoken_count if count_pretokens else None,
+                "byte_count": byte_count,
+                "bytes_per_token": byte_count / max(count, 1),
+                "encode_seconds": encode_seconds,
+                "num_workers": num_workers,
+            }
+            for v, count in token_counts.items()
+        ]
+        append_results(results_db, "encode_results", rows, files=[file for file, _, _ in file_ranges])
+        print(f"Appended {len(rows)} results to {results_db}", flush=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,285 @@
+"""
+Memoize the token ids of repeated lines (system prompts, templates, boilerplate code headers) in front
+of a tokenizer, so they are not merged again on every call.
+
+Texts are cut into segments at line boundaries that no token can span, and the ids of each segment
+are kept in an LRU cache. Which boundaries are safe depends on the pretokenizer (see
+get_segment_pattern), so the result is always the same as encoding the whole text.
+
+The same boundaries let IncrementalEncoder extend the ids of a growing text (e.g. a chat
+conversation) by re-encoding only the text after the last boundary.
+
+Run as a script to check both on the benchmark corpus, and to compare the latency of encoding
+requests that share a long prefix with and without the cache, and of encoding a growing conversation
+turn by turn with and without IncrementalEncoder.
+"""
+
+import json
+import time
+import random
+import threading
+from collections import OrderedDict
+
+import click
+import numpy as np
+import regex as re
+
+from benchmark_encode import get_benchmark_corpus
+from utils import get_pretokenization_regex, get_pretokenizer, load_tokenizer
+
+MAX_ENTRIES = 100000
+MAX_SEGMENT_LENGTH = 4096
+RANDOM_SEED = 0
+
+
+def get_segment_pattern(tokenizer):
+    """
+    Return a regex matching the segments of a text that tokenizer encodes independently, so that
+    concatenating their ids gives the ids of the whole text. Raises ValueError if we cannot tell.
+
+    Without whitespace pretokenization (SuperBPE stage 2), a line is not split further by the
+    pretokenizer, since digit groups never contain a newline. A token spanning the end of a run of
+    newlines would have to contain a newline followed by another character, which never happens in
+    tokenizers trained on files, whose training words are lines (we check the vocab). So we cut after
+    every run of newlines.
+
+    With whitespace pretokenization (stage 1), the GPT-2 regex groups newlines with the whitespace
+    around them, so we only cut after a single newline between two non-whitespace characters, where
+    the newline is a pretoken of its own.
+    """
+    tokenizer_json = json.loads(tokenizer.to_str())
+    if tokenizer_json.get("normalizer") is not None:
+        raise ValueError("Segment caching does not support tokenizers with a normalizer")
+    if any("\n" in t["content"] for t in tokenizer_json.get("added_tokens", [])):
+        raise ValueError("Segment caching does not support added tokens containing newlines")
+    if tokenizer_json.get("post_processor") is not None:
+        raise ValueError("Segment caching does not support post-processors (special tokens per text)")
+    if tokenizer_json["model"].get("dropout"):
+        raise ValueError("Segment caching does not support BPE dropout")
+
+    regex_string = get_pretokenization_regex(tokenizer_json)
+    if regex_string == get_pretokenizer(do_whitespace_pretokenization=True)[1]:
+        return re.compile(r".+?(?:(?<=[^\p{White_Space}]\n)(?=[^\p{White_Space}])|\Z)", re.DOTALL)
+    if regex_string == get_pretokenizer(do_whitespace_pretokenization=False)[1]:
+        # "Ċ" is how the byte-level pretokenizer writes a newline
+        if any("Ċ" in t and re.search("Ċ[^Ċ]", t) for t in tokenizer.get_vocab()):
+            raise ValueError("Tokenizer has tokens that span newlines, so lines are not independent")
+        return re.compile(r"[^\n]+\n*|\n+")
+    raise ValueError(f"Unknown pretokenization regex {regex_string}, so we cannot cut texts safely")
+
+
+class CachedTokenizer:
+    """
+    Wrap tokenizer with an LRU cache of the ids of up to max_entries segments (see
+    get_segment_pattern). Segments longer than max_segment_length characters are encoded but not
+    cached. encode(text) returns the same ids as tokenizer.encode(text).ids.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, tokenizer, max_entries=MAX_ENTRIES, max_segment_length=MAX_SEGMENT_LENGTH):
+        self.tokenizer = tokenizer
+        self.segment_pattern = get_segment_pattern(tokenizer)
+        self.max_entries = max_entries
+        self.max_segment_length = max_segment_length
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def encode_batch(self, texts):
+        segments = [self.segment_pattern.findall(text) for text in texts]
+
+        ids = {}
+        with self.lock:
+            for segment in (s for text_segments in segments for s in text_segments):
+                if segment in ids:
+                    continue
+                cached = self.cache.get(segment)
+                if cached is None:
+                    self.misses += 1
+                    ids[segment] = None
+                else:
+                    self.hits += 1
+                    self.cache.move_to_end(segment)
+                    ids[segment] = cached
+
+        # encode the segments we have not seen in one batch
+        missing = [segment for segment, segment_ids in ids.items() if segment_ids is None]
+        if missing:
+            encodings = self.tokenizer.encode_batch(missing, add_special_tokens=False)
+            with self.lock:
+                for segment, encoding in zip(missing, encodings):
+                    ids[segment] = encoding.ids
+                    if len(segment) <= self.max_segment_length:
+                        self.cache[segment] = encoding.ids
+                while len(self.cache) > self.max_entries:
+                    self.cache.popitem(last=False)
+                    self.evictions += 1
+
+        return [[i for segment in text_segments for i in ids[segment]] for text_segments in segments]
+
+    def encode(self, text):
+        return self.encode_batch([text])[0]
+
+    def stats(self):
+        with self.lock:
+            num_lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / num_lookups if num_lookups else 0.0,
+                "evictions": self.evictions,
+                "num_entries": len(self.cache),
+            }
+
+
+class IncrementalEncoder:
+    """
+    Keep the ids of a text that only grows, such as a chat conversation. Everything before the last
+    segment boundary (see get_segment_pattern) is final, since text appended later cannot change how
+    it is encoded, so append only re-encodes the text after that boundary together with the new
+    text. The ids are always the same as tokenizer.encode(text).ids for the whole text so far.
+
+    Finding the boundaries of a tokenizer takes a moment, so when creating an encoder per
+    conversation, pass segment_pattern=get_segment_pattern(tokenizer) computed once.
+    """
+
+    def __init__(self, tokenizer, text="", segment_pattern=None):
+        self.tokenizer = tokenizer
+        self.segment_pattern = segment_pattern or get_segment_pattern(tokenizer)
+        self.final_ids = []
+        self.tail = ""  # the text after the last boundary
+        self.tail_ids = []
+        if text:
+            self.append(text)
+
+    def append(self, text):
+        """
+        Append text and return (num_retracted, new_ids): the last num_retracted ids returned so far
+        have to be replaced by new_ids.
+        """
+        segments = self.segment_pattern.findall(self.tail + text)
+        final_text, self.tail = "".join(segments[:-1]), segments[-1] if segments else ""
+        final_encoding, tail_encoding = self.tokenizer.encode_batch([final_text, self.tail])
+
+        num_retracted = len(self.tail_ids)
+        self.final_ids.extend(final_encoding.ids)
+        self.tail_ids = tail_encoding.ids
+        return num_retracted, final_encoding.ids + self.tail_ids
+
+    @property
+    def ids(self):
+        return self.final_ids + self.tail_ids
+
+
+def get_conversation(docs, num_turns, rng):
+    """A conversation of num_turns turns, each a document from the benchmark corpus."""
+    domains = [domain for domain in docs if domain != "long_lines"]
+    return [
+        f"\n\n{'User' if i % 2 == 0 else 'Assistant'}: {rng.choice(docs[rng.choice(domains)])}"
+        for i in range(num_turns)
+    ]
+
+
+@click.command()
+@click.option(
+    "--tokenizer_path",
+    type=str,
+    help="Path to tokenizer.json, or a tokenizer directory.",
+)
+@click.option(
+    "--corpus_path",
+    type=str,
+    default="benchmarks/encode_corpus.jsonl",
+    help="Benchmark corpus (see benchmark_encode), generated if it does not exist.",
+)
+@click.option(
+    "--num_requests",
+    type=int,
+    default=1000,
+    help="Number of requests with a shared prefix to time.",
+)
+@click.option(
+    "--num_turns",
+    type=int,
+    default=100,
+    help="Number of turns of the conversation to encode incrementally.",
+)
+@click.option(
+    "--max_entries",
+    type=int,
+    default=MAX_ENTRIES,
+    help="Maximum number of segments in the cache.",
+)
+def main(tokenizer_path: str, corpus_path: str, num_requests: int, num_turns: int, max_entries: int):
+    tokenizer = load_tokenizer(tokenizer_path)
+    cached_tokenizer = CachedTokenizer(tokenizer, max_entries)
+    docs = get_benchmark_corpus(corpus_path, 200)
+
+    # the cached ids must be the same as encoding the whole text, including when the cache is warm
+    texts = [text for domain_texts in docs.values() for text in domain_texts]
+    expected = [e.ids for e in tokenizer.encode_batch(texts)]
+    for _ in range(2):
+        for text, e, a in zip(texts, expected, cached_tokenizer.encode_batch(texts)):
+            if e != a:
+                raise SystemExit(f"Cached ids differ from encoding the whole text: {text[:100]!r}")
+    print(f"Checked that {len(texts)} texts from {corpus_path} encode identically", flush=True)
+
+    # requests that share a long prefix (a system prompt), followed by a short question
+    rng = random.Random(RANDOM_SEED)
+    prefix = "\n".join([docs["prose"][0], docs["code"][0], docs["numbers"][0]]) + "\n"
+    requests = [
+        prefix + " ".join(rng.choice(docs["prose"]).split()[:rng.randint(5, 30)]) + "?"
+        for _ in range(num_requests)
+    ]
+    cached_tokenizer = CachedTokenizer(tokenizer, max_entries)
+    results = {}
+    for name, encode in [
+        ("direct", lambda text: tokenizer.encode(text).ids),
+        ("cached", cached_tokenizer.encode),
+    ]:
+        latencies = []
+        for text in requests:
+            start_time = time.perf_counter()
+            encode(text)
+            latencies.append(time.perf_counter() - start_time)
+        results[name] = np.array(latencies) * 1000
+        print(
+            f"{name}: p50 {np.percentile(results[name], 50):.3f} ms, "
+            f"p99 {np.percentile(results[name], 99):.3f} ms",
+            flush=True,
+        )
+    print(f"Cache stats: {cached_tokenizer.stats()}", flush=True)
+    print(
+        f"Median speedup on a {len(prefix)} character shared prefix: "
+        f"{np.median(results['direct']) / np.median(results['cached']):.1f}x",
+        flush=True,
+    )
+
+    # a conversation encoded after every turn, from scratch and incrementally
+    turns = get_conversation(docs, num_turns, rng)
+    encoder = IncrementalEncoder(tokenizer)
+    ids = []
+    full_seconds, incremental_seconds = 0, 0
+    for i, turn in enumerate(turns):
+        start_time = time.perf_counter()
+        expected = tokenizer.encode("".join(turns[: i + 1])).ids
+        full_seconds += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        num_retracted, new_ids = encoder.append(turn)
+        incremental_seconds += time.perf_counter() - start_time
+
+        ids = ids[: len(ids) - num_retracted] + new_ids
+        if ids != expected or encoder.ids != expected:
+            raise SystemExit(f"Incremental ids differ from encoding the whole text after turn {i}")
+    print(
+        f"Encoded a {num_turns} turn conversation after every turn in {full_seconds:.3f}s from "
+        f"scratch and {incremental_seconds:.3f}s incrementally, with identical ids",
+        flush=True,
+    )
+
+
+if __name__ == "__main__":
+    main()
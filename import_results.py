@@ -0,0 +1,143 @@
+"""
+Import the results of earlier runs, saved as JSON files next to the tokenizers, into the results
+database (see utils.query_results), so that whole sweeps can be loaded without globbing files.
+
+For each tokenizer directory in tokenizer_dir (e.g. tokenizer_json/), this imports
+train_stats.json (written by train_tokenizer.py) and <eval_dataset>/token_byte_counts*.json
+(written by encode.py --save_bytes_per_token). Results are dated by the modification time of their
+file, and files that were imported before are skipped, so the import can be repeated as new results
+come in.
+"""
+
+import json
+from collections import defaultdict
+from pathlib import Path
+
+import click
+import regex as re
+from tqdm import tqdm
+
+from utils import RESULTS_DB, append_results, connect_results_db, read_json
+
+# directory names of SuperBPE tokenizers, e.g. olmo2_p99_truncate_10G_180K_extend_200K_mw4_colon
+TRANSITION_PATTERN = re.compile(r"_(\d+)K_extend_")
+
+
+def get_num_inherit_merges(tokenizer_dir, meta):
+    if "num_initial_merges" in meta:
+        return meta["num_initial_merges"]
+    if (tokenizer_dir / "initial_merges.txt").exists():
+        with open(tokenizer_dir / "initial_merges.txt") as fin:
+            return sum(1 for _ in fin) - 1
+    match = TRANSITION_PATTERN.search(tokenizer_dir.name)
+    return int(match.group(1)) * 1000 if match else None
+
+
+def get_vocab_size(tokenizer_dir):
+    if (tokenizer_dir / "vocab.json").exists():
+        return len(read_json(tokenizer_dir / "vocab.json"))
+    if (tokenizer_dir / "tokenizer.json").exists():
+        return len(read_json(tokenizer_dir / "tokenizer.json")["model"]["vocab"])
+    return None
+
+
+def is_imported(conn, table, tokenizer, created_at):
+    row = conn.execute(
+        f"SELECT 1 FROM {table} WHERE tokenizer = ? AND created_at = ? LIMIT 1",
+        (tokenizer, created_at),
+    ).fetchone()
+    return row is not None
+
+
+def import_tokenizer_dir(results_db, conn, tokenizer_dir):
+    """Import the results of tokenizer_dir that are not in the database yet, returning how many."""
+    meta = read_json(tokenizer_dir / "meta.json") if (tokenizer_dir / "meta.json").exists() else {}
+    num_inherit_merges = get_num_inherit_merges(tokenizer_dir, meta)
+    num_imported = 0
+
+    stats_path = tokenizer_dir / "train_stats.json"
+    created_at = stats_path.stat().st_mtime if stats_path.exists() else None
+    if created_at and not is_imported(conn, "train_results", tokenizer_dir.name, created_at):
+        stats = read_json(stats_path)
+        train_seconds = sum(stats["phases"].get(p, 0) for p in ["train", "read_count_train"])
+        row = {
+            "created_at": created_at,
+            "tokenizer": tokenizer_dir.name,
+            "output_dir": str(tokenizer_dir.resolve()),
+            "num_inherit_merges": num_inherit_merges,
+            "vocab_size": stats.get("vocab_size"),
+            "num_new_merges": stats.get("num_new_merges"),
+            "num_bytes": stats.get("num_bytes", meta.get("total_bytes")),
+            "do_whitespace_pretokenization": stats.get("do_whitespace_pretokenization"),
+            "num_unique_words": stats.get("num_unique_words"),
+            "train_seconds": train_seconds,
+            "total_seconds": stats.get("total_seconds"),
+            "merges_per_second": stats.get("merges_per_second"),
+            "peak_rss_bytes": stats.get("peak_rss_bytes"),
+            "phases": json.dumps(stats["phases"]),
+        }
+        append_results(results_db, "train_results", [row], files=meta.get("train_files"))
+        num_imported += 1
+
+    vocab_size = None
+    rows_by_files = defaultdict(list)
+    for counts_path in sorted(tokenizer_dir.glob("*/token_byte_counts*.json")):
+        created_at = counts_path.stat().st_mtime
+        if is_imported(conn, "encode_results", tokenizer_dir.name, created_at):
+            continue
+        counts = read_json(counts_path)
+        match = re.fullmatch(r"token_byte_counts_(\d+)\.json", counts_path.name)
+        pretoken_count = None
+        if match:
+            row_vocab_size = int(match.group(1))
+        else:
+            # the whole tokenizer, where encode.py also counts pretokens
+            vocab_size = vocab_size or get_vocab_size(tokenizer_dir)
+            row_vocab_size = vocab_size
+            pretokens_path = counts_path.parent / "pretoken_byte_counts.json"
+            if pretokens_path.exists():
+                pretoken_count = read_json(pretokens_path)["pretoken_count"]
+        row = {
+            "created_at": created_at,
+            "tokenizer": tokenizer_dir.name,
+            "tokenizer_dir": str(tokenizer_dir.resolve()),
+            "eval_dataset": counts_path.parent.name,
+            "num_inherit_merges": num_inherit_merges,
+            "vocab_size": row_vocab_size,
+            "token_count": counts["token_count"],
+            "pretoken_count": pretoken_count,
+            "byte_count": counts["byte_count"],
+            "bytes_per_token": counts["byte_count"] / max(counts["token_count"], 1),
+        }
+        rows_by_files[tuple(counts["test_files"])].append(row)
+    for files, rows in rows_by_files.items():
+        append_results(results_db, "encode_results", rows, files=files)
+        num_imported += len(rows)
+    return num_imported
+
+
+@click.command()
+@click.option(
+    "--tokenizer_dir",
+    type=str,
+    default="tokenizer_json",
+    help="Directory of tokenizer directories to import the results of.",
+)
+@click.option(
+    "--results_db",
+    type=str,
+    default=RESULTS_DB,
+    help="SQLite database to import the results into.",
+)
+def main(tokenizer_dir: str, results_db: str):
+    tokenizer_dirs = sorted(p for p in Path(tokenizer_dir).iterdir() if p.is_dir())
+    num_imported = 0
+    conn = connect_results_db(results_db)
+    for path in tqdm(tokenizer_dirs, desc="Importing"):
+        num_imported += import_tokenizer_dir(results_db, conn, path)
+    conn.close()
+    print(f"Imported {num_imported} results from {tokenizer_dir} into {results_db}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+"""
+Sweep SuperBPE transition points: extend a stage 1 tokenizer to the same vocab_size starting from
+several numbers of inherited merges, running the stage 2 jobs concurrently within a core and memory
+budget, and optionally evaluate the encoding efficiency of each result with encode.py.
+
+This does what scripts/extend_tokenizer.sh does for a single transition point. The pretoken counts
+of the stage 1 data are computed once up front (see utils.get_word_counts), so the stage 2 jobs only
+run the merge phase. Finished jobs are skipped, so the sweep can be rerun to resume.
+"""
+
+import os
+import sys
+import json
+import time
+import subprocess
+from pathlib import Path
+
+import click
+
+from train_tokenizer import apply_dedup, get_train_data_from_meta
+from utils import ensure_dir, get_pretokenizer, get_word_counts, read_json
+
+POLL_INTERVAL = 5
+
+
+def format_count(n):
+    """Turn e.g. 180000 into 180K, as in the names of the tokenizers in tokenizer_json/."""
+    return f"{n // 1000}K" if n >= 1000 else str(n)
+
+
+def get_total_memory_gb():
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2**30
+
+
+def get_memory_per_job_gb(stage1_dir):
+    """Return the peak memory of the stage 1 training run in GB, or None if it was not recorded."""
+    stats_path = stage1_dir / "train_stats.json"
+    if not os.path.exists(stats_path):
+        return None
+    return read_json(stats_path)["peak_rss_bytes"] / 2**30
+
+
+def prepare_stage2_dir(stage1_dir, output_dir, num_inherit_merges):
+    """Set up output_dir like scripts/extend_tokenizer.sh: inherit the merges and copy meta.json."""
+    ensure_dir(output_dir)
+    with open(stage1_dir / "merges.txt") as fin, open(output_dir / "merges.txt", "w") as fout:
+        for i, line in enumerate(fin):
+            if i >= num_inherit_merges:
+                break
+            fout.write(line)
+    with open(stage1_dir / "meta.json") as fin, open(output_dir / "meta.json", "w") as fout:
+        fout.write(fin.read())
+
+
+class Job:
+    def __init__(self, name, cmd, log_path, num_cores, memory_gb):
+        self.name = name
+        self.cmd = cmd
+        self.log_path = log_path
+        self.num_cores = num_cores
+        self.memory_gb = memory_gb
+        self.process = None
+
+    def start(self):
+        env = {**os.environ, "RAYON_RS_NUM_CPUS": str(self.num_cores)}
+        self.log = open(self.log_path, "w")
+        self.process = subprocess.Popen(
+            self.cmd,
+            cwd=Path(__file__).parent,
+            env=env,
+            stdout=self.log,
+            stderr=subprocess.STDOUT,
+        )
+        self.start_time = time.time()
+        print(f"Started {self.name} (log: {self.log_path})", flush=True)
+
+    def poll(self):
+        returncode = self.process.poll()
+        if returncode is not None:
+            self.log.close()
+            self.elapsed = time.time() - self.start_time
+        return returncode
+
+
+def run_jobs(jobs, num_cores, memory_gb, on_success=None):
+    """
+    Run jobs concurrently as long as their cores and memory fit in the budget. on_success(job) may
+    return a follow-up job (e.g. an evaluation), which is queued after the remaining jobs.
+    """
+    pending, running, failed = list(jobs), [], []
+    while pending or running:
+        while pending:
+            job = pending[0]
+            used_cores = sum(j.num_cores for j in running)
+            used_memory = sum(j.memory_gb for j in running)
+            fits = used_cores + job.num_cores <= num_cores and used_memory + job.memory_gb <= memory_gb
+            if running and not fits:
+                break
+            pending.pop(0).start()
+            running.append(job)
+
+        time.sleep(POLL_INTERVAL)
+        for job in list(running):
+            returncode = job.poll()
+            if returncode is None:
+                continue
+            running.remove(job)
+            if returncode != 0:
+                print(f"{job.name} failed with exit code {returncode}, see {job.log_path}", flush=True)
+                failed.append(job)
+                continue
+            print(f"Finished {job.name} in {job.elapsed / 60:.1f} minutes", flush=True)
+            next_job = on_success(job) if on_success else None
+            if next_job is not None:
+                pending.append(next_job)
+    return failed
+
+
+@click.command()
+@click.option(
+    "--stage1_dir",
+    type=str,
+    help="Directory of the stage 1 (whitespace-pretokenized) tokenizer, with merges.txt and meta.json.",
+)
+@click.option(
+    "--num_inherit_merges",
+    type=str,
+    help="Comma-separated transition points to sweep (e.g. 20000,40000,...,180000).",
+)
+@click.option(
+    "--vocab_size",
+    type=int,
+    default=200000,
+    help="The number of tokens in the vocabulary of every stage 2 tokenizer.",
+)
+@click.option(
+    "--output_root",
+    type=str,
+    default=None,
+    help="Where to save the stage 2 tokenizers. Defaults to the parent directory of stage1_dir.",
+)
+@click.option(
+    "--num_cores",
+    type=int,
+    default=os.cpu_count(),
+    help="Total number of cores the sweep may use.",
+)
+@click.option(
+    "--cores_per_job",
+    type=int,
+    default=16,
+    help="Number of cores for each training or evaluation job.",
+)
+@click.option(
+    "--memory_gb",
+    type=float,
+    default=None,
+    help="Total memory (in GB) the sweep may use. Defaults to 90% of the machine's memory.",
+)
+@click.option(
+    "--memory_per_job_gb",
+    type=float,
+    default=None,
+    help="Expected peak memory (in GB) of each job, used to decide how many run at once. Defaults to the peak memory recorded in the train_stats.json of stage1_dir.",
+)
+@click.option(
+    "--max_unique_words",
+    type=int,
+    default=None,
+    help="Bound the memory of counting the stage 2 words (see train_tokenizer --max_unique_words).",
+)
+@click.option(
+    "--eval_corpus_dir",
+    type=str,
+    default=None,
+    help="If given, measure the encoding efficiency of each tokenizer on this directory with encode.py.",
+)
+@click.option(
+    "--eval_num_bytes",
+    type=int,
+    default=10**9,
+    help="Number of bytes of eval_corpus_dir to encode.",
+)
+def main(
+    stage1_dir: str,
+    num_inherit_merges: str,
+    vocab_size: int,
+    output_root: str,
+    num_cores: int,
+    cores_per_job: int,
+    memory_gb: float,
+    memory_per_job_gb: float,
+    max_unique_words: int,
+    eval_corpus_dir: str,
+    eval_num_bytes: int,
+):
+    stage1_dir = Path(stage1_dir).absolute()
+    output_root = Path(output_root).absolute() if output_root else stage1_dir.parent
+    if memory_per_job_gb is None:
+        memory_per_job_gb = get_memory_per_job_gb(stage1_dir)
+        if memory_per_job_gb is not None:
+            print(f"Expecting {memory_per_job_gb:.1f} GB per job, as in stage 1", flush=True)
+        elif memory_gb:
+            raise click.UsageError(
+                f"{stage1_dir} has no train_stats.json, so --memory_gb needs --memory_per_job_gb"
+            )
+        else:
+            print("No train_stats.json in stage1_dir, so memory does not limit concurrency", flush=True)
+            memory_per_job_gb = 0
+    memory_gb = memory_gb or 0.9 * get_total_memory_gb()
+    transitions = [int(t) for t in num_inherit_merges.split(",")]
+    if eval_corpus_dir:
+        eval_corpus_dir = os.path.abspath(eval_corpus_dir)
+
+    # Count the pretokens of the stage 1 data once, so the stage 2 jobs all load them from the cache
+    meta = read_json(stage1_dir / "meta.json")
+    cwd = os.getcwd()
+    os.chdir(stage1_dir)  # train_files in meta.json may be relative to the tokenizer directory
+    train_data, _, data_key = get_train_data_from_meta(meta)
+    if "dedup" in meta:
+        train_data, data_key, _ = apply_dedup(
+            meta,
+            train_data,
+            data_key,
+            meta["dedup"]["capacity"],
+            do_whitespace_pretokenization=False,
+            num_bytes=meta.get("total_bytes"),
+        )
+    if data_key:
+        _, regex_string = get_pretokenizer(do_whitespace_pretokenization=False)
+        get_word_counts(
+            train_data,
+            data_key,
+            False,
+            regex_string,
+            num_workers=num_cores,
+            max_unique_words=max_unique_words,
+        )
+    else:
+        print("meta.json has no manifest or cached sample, so each job will count pretokens itself")
+    os.chdir(cwd)
+
+    output_dirs = {}
+    jobs = []
+    for t in transitions:
+        output_dir = output_root / f"{stage1_dir.name}_{format_count(t)}_extend_{format_count(vocab_size)}"
+        output_dirs[t] = output_dir
+        if os.path.exists(output_dir / "tokenizer.json"):
+            print(f"{output_dir} already has a tokenizer, skipping training", flush=True)
+            continue
+        prepare_stage2_dir(stage1_dir, output_dir, t)
+        cmd = [
+            sys.executable,
+            "-m",
+            "train_tokenizer",
+            "--output_dir",
+            str(output_dir),
+            "--vocab_size",
+            str(vocab_size),
+            "--do_whitespace_pretokenization",
+            "false",
+        ]
+        if max_unique_words:
+            cmd += ["--max_unique_words", str(max_unique_words)]
+        jobs.append(Job(f"t={t}", cmd, output_dir / "train.log", cores_per_job, memory_per_job_gb))
+
+    def get_eval_job(t):
+        output_dir = output_dirs[t]
+        if not eval_corpus_dir or os.path.exists(output_dir / "eval" / "token_byte_counts.json"):
+            return None
+        cmd = [
+            sys.executable,
+            "encode.py",
+            "--tokenizer_path",
+            str(output_dir / "tokenizer.json"),
+            "--corpus_dir",
+            eval_corpus_dir,
+            "--num_bytes",
+            str(eval_num_bytes),
+            "--output_dir",
+            str(output_dir / "eval"),
+            "--save_bytes_per_token",
+            "--num_workers",
+            str(cores_per_job),
+        ]
+        return Job(f"eval t={t}", cmd, output_dir / "eval.log", cores_per_job, memory_per_job_gb)
+
+    # evaluate the tokenizers that were trained by a previous run of the sweep
+    trained = [t for t in transitions if os.path.exists(output_dirs[t] / "tokenizer.json")]
+    jobs += [job for job in map(get_eval_job, trained) if job is not None]
+
+    def on_success(job):
+        if job.name.startswith("t="):
+            return get_eval_job(int(job.name[len("t=") :]))
+
+    failed = run_jobs(jobs, num_cores, memory_gb, on_success=on_success)
+
+    # Summarize the sweep
+    results = []
+    for t in transitions:
+        result = {"num_inherit_merges": t, "output_dir": str(output_dirs[t])}
+        eval_file = output_dirs[t] / "eval" / "token_byte_counts.json"
+        if os.path.exists(eval_file):
+            counts = read_json(eval_file)
+            result["token_count"] = counts["token_count"]
+            result["byte_count"] = counts["byte_count"]
+            result["bytes_per_token"] = counts["byte_count"] / counts["token_count"]
+        results.append(result)
+        print(
+            f"t={t}: {result.get('bytes_per_token', float('nan')):.4f} bytes per token",
+            flush=True,
+        )
+    with open(output_root / f"{stage1_dir.name}_sweep_{format_count(vocab_size)}.json", "w") as fout:
+        json.dump(results, fout, indent=5)
+
+    if failed:
+        raise SystemExit(f"{len(failed)} jobs failed: {', '.join(job.name for job in failed)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+from tokenizers import Tokenizer, decoders, models, trainers
+from tokenizers.pre_tokenizers import ByteLevel
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import get_pretokenizer  # noqa: E402
+
+TEXT = """The quick brown fox jumps over the lazy dog.
+The year 2024 had 366 days, and 1234567 is a big number.
+  Indented lines, tabs\tand trailing spaces   
+Héllo wörld! Ünïcödé text, 文字 and ٣٤٥ digits.
+
+The quick brown fox jumps over the lazy dog again and again.
+"""
+
+
+def train_tokenizer(do_whitespace_pretokenization, vocab_size=400):
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer, _ = get_pretokenizer(do_whitespace_pretokenization)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size, initial_alphabet=ByteLevel.alphabet(), show_progress=False
+    )
+    # train on lines, as the trainer reads files, so that no token spans a newline
+    tokenizer.train_from_iterator(TEXT.splitlines(keepends=True) * 20, trainer)
+    return tokenizer
+
+
+@pytest.fixture(scope="session")
+def tokenizer():
+    """A small stage 1 tokenizer (with whitespace pretokenization)."""
+    return train_tokenizer(do_whitespace_pretokenization=True)
+
+
+@pytest.fixture(scope="session")
+def superword_tokenizer():
+    """A small stage 2 tokenizer (without whitespace pretokenization)."""
+    return train_tokenizer(do_whitespace_pretokenization=False)
@@ -0,0 +1,67 @@
+import json
+
+import numpy as np
+import pytest
+import regex as re
+from tokenizers import Tokenizer
+
+from conftest import TEXT
+from encode import count_pretokens, get_truncated_token_counts
+from utils import get_pretokenizer
+
+CHUNK_TEXTS = [
+    TEXT,
+    "word    word\n\n\n   word  \t\t  1234567890  ",
+    "aaa   bbb   ccc   " * 5,
+    "12345678901234567890 ٣٤٥٦٧٨٩ 文字文字 😀😀",
+]
+
+
+@pytest.mark.parametrize("do_whitespace_pretokenization", [True, False])
+@pytest.mark.parametrize("text", CHUNK_TEXTS)
+def test_count_pretokens_across_chunk_boundaries(text, do_whitespace_pretokenization):
+    _, pretok_regex = get_pretokenizer(do_whitespace_pretokenization)
+    expected = len(re.findall(pretok_regex, text))
+    assert count_pretokens(pretok_regex, text) == expected
+
+    # cut at every position, including inside whitespace runs, digit groups, and words
+    for cut in range(len(text) + 1):
+        first = count_pretokens(pretok_regex, text[:cut], context=text[cut:])
+        second = count_pretokens(pretok_regex, text[cut:], prefix=text[:cut])
+        assert first + second == expected, cut
+
+    # three chunks
+    for cut in range(0, len(text) + 1, 7):
+        cut2 = min(cut + 5, len(text))
+        counts = [
+            count_pretokens(pretok_regex, text[:cut], context=text[cut:]),
+            count_pretokens(pretok_regex, text[cut:cut2], context=text[cut2:], prefix=text[:cut]),
+            count_pretokens(pretok_regex, text[cut2:], prefix=text[:cut2]),
+        ]
+        assert sum(counts) == expected, cut
+
+
+def truncate(tokenizer, num_merges):
+    """The tokenizer encode.py --vocab_size builds: the top num_merges merges, not ignoring any."""
+    tokenizer_json = json.loads(tokenizer.to_str())
+    tokenizer_json["model"]["merges"] = tokenizer_json["model"]["merges"][:num_merges]
+    tokenizer_json["model"]["ignore_merges"] = False
+    return Tokenizer.from_str(json.dumps(tokenizer_json))
+
+
+@pytest.mark.parametrize("tokenizer_name", ["tokenizer", "superword_tokenizer"])
+def test_truncated_token_counts_match_separate_runs(tokenizer_name, request):
+    tokenizer = request.getfixturevalue(tokenizer_name)
+    tokenizer_json = json.loads(tokenizer.to_str())
+    vocab, merges = tokenizer_json["model"]["vocab"], tokenizer_json["model"]["merges"]
+    texts = TEXT.split("\n\n") + ["The brown dog jumps quickly over 98765 foxes."]
+
+    full = truncate(tokenizer, len(merges))
+    ids = [i for encoding in full.encode_batch(texts) for i in encoding.ids]
+    token_counts = np.bincount(ids, minlength=tokenizer.get_vocab_size())
+
+    vocab_sizes = sorted({0, 1, 10, 50, 100, len(merges) // 2, len(merges) - 1, len(merges)})
+    token_counts = get_truncated_token_counts(vocab, merges, token_counts, vocab_sizes)
+    for v in vocab_sizes:
+        expected = sum(len(encoding) for encoding in truncate(tokenizer, v).encode_batch(texts))
+        assert token_counts[v] == expected, v
@@ -0,0 +1,50 @@
+import pytest
+
+from conftest import TEXT
+from encode_cache import CachedTokenizer, IncrementalEncoder, get_segment_pattern
+
+# pieces cutting the text inside words, whitespace runs, digit groups, and runs of newlines
+APPENDS = [
+    "The qu",
+    "ick brown fox",
+    " ",
+    " jumps\n",
+    "\n",
+    "\nThe year 20",
+    "24 had 366",
+    " days.  ",
+    "\n  Indented",
+    "",
+    " lines\n\n",
+    "Héllo wörld! 文",
+    "字\n",
+    TEXT,
+]
+
+
+@pytest.mark.parametrize("tokenizer_name", ["tokenizer", "superword_tokenizer"])
+def test_incremental_encoder_matches_full_encoding(tokenizer_name, request):
+    tokenizer = request.getfixturevalue(tokenizer_name)
+    encoder = IncrementalEncoder(tokenizer, segment_pattern=get_segment_pattern(tokenizer))
+    ids = []
+    text = ""
+    for piece in APPENDS:
+        text += piece
+        num_retracted, new_ids = encoder.append(piece)
+        assert num_retracted <= len(ids)
+        ids = ids[: len(ids) - num_retracted] + new_ids
+        expected = tokenizer.encode(text).ids
+        assert encoder.ids == expected, text
+        assert ids == expected, text
+
+    assert IncrementalEncoder(tokenizer, text).ids == tokenizer.encode(text).ids
+
+
+@pytest.mark.parametrize("tokenizer_name", ["tokenizer", "superword_tokenizer"])
+def test_cached_tokenizer_matches_tokenizer(tokenizer_name, request):
+    tokenizer = request.getfixturevalue(tokenizer_name)
+    cached = CachedTokenizer(tokenizer, max_entries=4)
+    texts = [TEXT, TEXT[:50], "", TEXT + "\n\n" + TEXT, "no newline at all"]
+    for _ in range(2):
+        assert cached.encode_batch(texts) == [e.ids for e in tokenizer.encode_batch(texts)]
+    assert cached.stats()["num_entries"] <= 4
@@ -0,0 +1,53 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from tokenize_server import MicroBatcher
+
+
+def square_all(items):
+    if any(not isinstance(item, int) for item in items):
+        raise TypeError("not an int")
+    return [item * item for item in items]
+
+
+def test_micro_batcher_fails_only_invalid_requests():
+    async def run():
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            batcher = MicroBatcher(
+                square_all, executor, max_batch_size=8, max_wait_ms=50, max_concurrent_batches=1
+            )
+            runner = asyncio.get_running_loop().create_task(batcher.run())
+            items = [1, 2, "three", 4]
+            results = await asyncio.gather(
+                *(batcher.submit(item) for item in items), return_exceptions=True
+            )
+            runner.cancel()
+            return results, batcher.metrics()
+
+    results, metrics = asyncio.run(run())
+    assert results[:2] == [1, 4]
+    assert isinstance(results[2], TypeError)
+    assert results[3] == 16
+    assert metrics["num_requests"] == 4
+    assert metrics["num_errors"] == 1
+    # the failed batch is retried one request at a time
+    assert metrics["num_batches"] == 1
+    assert metrics["mean_batch_size"] == 4
+
+
+def test_micro_batcher_respects_max_batch_size():
+    async def run():
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            batcher = MicroBatcher(
+                square_all, executor, max_batch_size=3, max_wait_ms=50, max_concurrent_batches=2
+            )
+            runner = asyncio.get_running_loop().create_task(batcher.run())
+            results = await asyncio.gather(*(batcher.submit(i) for i in range(10)))
+            runner.cancel()
+            return results, batcher.metrics()
+
+    results, metrics = asyncio.run(run())
+    assert results == [i * i for i in range(10)]
+    assert metrics["num_errors"] == 0
+    assert metrics["num_batches"] >= 4
+
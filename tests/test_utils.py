@@ -0,0 +1,123 @@
+from collections import Counter
+
+import pytest
+
+from conftest import TEXT
+from utils import (
+    CompiledTokenizer,
+    DedupFilter,
+    FastPretokenizer,
+    _get_min_count,
+    compile_tokenizer,
+    dedup_files,
+    dedup_texts,
+    get_first_digests,
+    get_pretokenizer,
+    hash_texts,
+    load_compiled_tokenizer,
+    prune_word_counts,
+)
+
+
+@pytest.mark.parametrize("tokenizer_name", ["tokenizer", "superword_tokenizer"])
+def test_compiled_tokenizer_matches_tokenizer(tokenizer_name, request, tmp_path):
+    tokenizer = request.getfixturevalue(tokenizer_name)
+    tokenizer.save(str(tmp_path / "tokenizer.json"))
+    compile_tokenizer(str(tmp_path / "tokenizer.json"), str(tmp_path / "compiled"))
+
+    texts = TEXT.split("\n\n") + ["", "unseen wörds 😀 and 9876543210"]
+    expected = [encoding.ids for encoding in tokenizer.encode_batch(texts)]
+    loaded = load_compiled_tokenizer(tmp_path / "compiled")
+    assert [encoding.ids for encoding in loaded.encode_batch(texts)] == expected
+    compiled = CompiledTokenizer(tmp_path / "compiled")
+    assert compiled.encode_batch(texts) == expected
+    assert [compiled.decode(ids) for ids in expected] == texts
+
+
+
+def test_prune_word_counts_keeps_first_ties_in_word_order():
+    items = [("a", 3), ("b", 1), ("c", 2), ("d", 2), ("e", 5), ("f", 2)]
+    assert prune_word_counts(items, 2, num_tied=2) == Counter({"a": 3, "c": 2, "d": 2, "e": 5})
+    assert prune_word_counts(items, 2) == Counter({"a": 3, "e": 5})
+
+
+def test_get_min_count_breaks_ties():
+    words = Counter({"a": 5, "b": 3, "c": 3, "d": 3, "e": 1})
+    histogram = Counter(words.values())
+    min_count, num_tied = _get_min_count(histogram, max_unique_words=3)
+    assert (min_count, num_tied) == (3, 2)
+    pruned = prune_word_counts(sorted(words.items()), min_count, num_tied)
+    assert pruned == Counter({"a": 5, "b": 3, "c": 3})
+
+    # everything fits
+    assert _get_min_count(histogram, max_unique_words=10) == (1, 1)
+
+
+def test_dedup_filter_drops_repeats():
+    dedup_filter = DedupFilter(capacity=100)
+    assert dedup_filter.filter(["a", "b", "a", "c"]) == ["a", "b", "c"]
+    assert dedup_filter.filter(["c", "d", "b", "d"]) == ["d"]
+    assert dedup_filter.filter([]) == []
+    stats = dedup_filter.stats()
+    assert stats["num_texts"] == 8
+    assert stats["num_dropped"] == 4
+    assert stats["num_bytes"] == 8
+    assert stats["num_dropped_bytes"] == 4
+
+
+def test_dedup_filter_digests_with_first_found_elsewhere():
+    texts = ["x", "y", "x"]
+    digests, num_bytes = hash_texts(texts)
+    is_first = get_first_digests(digests)
+    assert is_first.tolist() == [True, True, False]
+    dedup_filter = DedupFilter(capacity=100)
+    assert dedup_filter.filter_digests(digests, num_bytes, is_first).tolist() == [True, True, False]
+    assert dedup_filter.filter_digests(digests, num_bytes).tolist() == [False, False, False]
+
+
+def test_dedup_texts_across_batches():
+    texts = ["a", "b", "a", "c", "b", "d", "d", "e"]
+    deduped = dedup_texts(texts, DedupFilter(capacity=100), batch_size=3)
+    assert list(deduped) == ["a", "b", "c", "d", "e"]
+
+
+def test_dedup_files_by_contents(tmp_path):
+    files = []
+    for name, contents in [("a", "x\n"), ("b", "y\n"), ("c", "x\n"), ("d", "")]:
+        (tmp_path / name).write_text(contents)
+        files.append(str(tmp_path / name))
+    dedup_filter = DedupFilter(capacity=100)
+    assert dedup_files(files, dedup_filter) == files[:2] + files[3:]
+    assert dedup_files(files[1:], dedup_filter) == []
+
+
+FAST_PRETOKENIZER_TEXTS = [
+    "",
+    "Hello world!",
+    "  leading and trailing spaces  ",
+    "tabs\tand\nnewlines\n\n\nand\r\nwindows",
+    "1234567 and 12 and 1234 and 0001",
+    "٣٤٥٦٧ Arabic-Indic digits and ２０２４ fullwidth digits",
+    "½ ² ³ ① Ⅻ numeric characters that are not digits",
+    "Héllo wörld, ß, Ω, жук, א, 文字, 한국어",
+    "combining é and zero‍width joiners",
+    "emoji 😀👍🏽 and symbols €£¥©®™°•…—–",
+    "punctuation... !!! ??? (parens) [brackets] {braces}",
+    "mixed123abc456def 7,890.12",
+    "\x00 control \x7f characters",
+    "a" * 100 + " " + "9" * 50,
+]
+
+
+@pytest.mark.parametrize("do_whitespace_pretokenization", [True, False])
+@pytest.mark.parametrize("text", FAST_PRETOKENIZER_TEXTS)
+def test_fast_pretokenizer_matches_regex(text, do_whitespace_pretokenization):
+    pretokenizer, _ = get_pretokenizer(do_whitespace_pretokenization)
+    expected = [word for word, _ in pretokenizer.pre_tokenize_str(text)]
+    assert FastPretokenizer(do_whitespace_pretokenization)(text) == expected
+
+
+def test_fast_pretokenizer_matches_regex_on_random_texts():
+    from benchmark_pretokenizer import check
+
+    assert check(lines=[], num_texts=2000) == []
@@ -0,0 +1,374 @@
+"""
+Tokenize a corpus into memory-mapped uint32 token shards for pretraining.
+
+Each shard is a raw array of token ids (readable with np.memmap(path, dtype=np.uint32)), as expected
+by the OLMo data paths in configs/. Next to each shard we save an offsets index with the end position
+of every document in the shard, and index.json records the shards written so far so that an
+interrupted run can be resumed.
+"""
+
+import os
+import json
+import hashlib
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool, get_start_method
+from pathlib import Path
+
+import click
+import numpy as np
+from tqdm import tqdm
+
+from encode import encode_batched, get_block_offsets
+from utils import (
+    DedupFilter,
+    dedup_files,
+    dedup_texts,
+    ensure_dir,
+    get_dedup_capacity,
+    get_files_with_num_bytes,
+    get_hf_dataset_iterator,
+    load_tokenizer,
+)
+
+BLOCK_SIZE = 2**24
+SHARD_NUM_TOKENS = 2**28
+DOCS_PER_BATCH = 1000
+NUM_READERS = 8
+
+# Set in each tokenization process by init_worker, so the tokenizer is loaded once per process
+_tokenizer = None
+
+
+def init_worker(tokenizer_path, tokenizer=None):
+    global _tokenizer
+    # forked workers are given the tokenizer already loaded by the parent process
+    _tokenizer = tokenizer if tokenizer is not None else load_tokenizer(tokenizer_path)
+
+
+def tokenize_block(file, start, end, eos_token_id):
+    """
+    Tokenize bytes [start, end) of file, appending eos_token_id if the block ends the file (each file
+    is one document). Return the token ids and the end positions of documents within them.
+    """
+    with open(file, "rb") as fin:
+        fin.seek(start)
+        text = fin.read(end - start).decode("utf-8")
+
+    ids = encode_batched(_tokenizer, text, return_ids=True)
+    if end < os.path.getsize(file):
+        return ids, np.zeros(0, dtype=np.uint64)
+    ids = np.append(ids, np.uint32(eos_token_id))
+    return ids, np.array([len(ids)], dtype=np.uint64)
+
+
+def tokenize_documents(texts, eos_token_id):
+    """
+    Tokenize a batch of documents, appending eos_token_id to each. Return the token ids and the end
+    positions of documents within them.
+    """
+    encode_batch = getattr(_tokenizer, "encode_batch_fast", _tokenizer.encode_batch)
+    ids = [np.array(e.ids + [eos_token_id], dtype=np.uint32) for e in encode_batch(texts)]
+    doc_ends = np.cumsum([len(doc_ids) for doc_ids in ids], dtype=np.uint64)
+    return np.concatenate(ids), doc_ends
+
+
+def _tokenize_task(args):
+    fn, fn_args = args
+    return fn(*fn_args)
+
+
+def imap_bounded(pool, fn, iterable, max_pending):
+    """
+    Like pool.imap, but only keeps max_pending tasks in flight, so that a lazy iterable (e.g. a
+    streaming dataset) is not read faster than it is tokenized.
+    """
+    pending = deque()
+    for args in iterable:
+        pending.append(pool.apply_async(fn, (args,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class ShardWriter:
+    """
+    Appends token ids to numbered shards in output_dir and keeps index.json up to date. A shard is
+    written to a temporary file and only added to the index once it is complete, together with
+    the number of work units it covers, so a resumed run restarts from the end of the last shard.
+    """
+
+    def __init__(self, output_dir, index, shard_num_tokens):
+        self.output_dir = Path(output_dir)
+        self.index = index
+        self.shard_num_tokens = shard_num_tokens
+        self.fout = None
+
+    def _shard_name(self):
+        return f"part-{len(self.index['shards']):05d}"
+
+    def write(self, ids, doc_ends):
+        if self.fout is None:
+            self.tmp_path = self.output_dir / f"{self._shard_name()}.npy.tmp"
+            self.fout = open(self.tmp_path, "wb")
+            self.num_tokens, self.num_units, self.doc_ends = 0, 0, []
+
+        self.fout.write(ids.tobytes())
+        self.doc_ends.append(doc_ends + self.num_tokens)
+        self.num_tokens += len(ids)
+        self.num_units += 1
+        if self.num_tokens >= self.shard_num_tokens:
+            self.close_shard()
+
+    def close_shard(self):
+        if self.fout is None:
+            return
+        self.fout.close()
+        self.fout = None
+        if self.num_tokens == 0:
+            os.remove(self.tmp_path)
+            return
+
+        name = self._shard_name()
+        np.save(self.output_dir / f"{name}.offsets.npy", np.concatenate(self.doc_ends))
+        os.replace(self.tmp_path, self.output_dir / f"{name}.npy")
+        self.index["shards"].append(
+            {
+                "path": f"{name}.npy",
+                "num_tokens": self.num_tokens,
+                "num_documents": int(sum(len(d) for d in self.doc_ends)),
+            }
+        )
+        self.index["num_units_done"] += self.num_units
+        save_index(self.output_dir, self.index)
+
+
+def save_index(output_dir, index):
+    tmp_path = Path(output_dir) / "index.json.tmp"
+    with open(tmp_path, "w") as fout:
+        json.dump(index, fout, indent=5)
+    os.replace(tmp_path, Path(output_dir) / "index.json")
+
+
+def load_index(output_dir, config):
+    """
+    Return the index of a previous run with the same config, or a fresh index. The config has
+    everything that determines the order of the work units (such as the files and their sizes), so a
+    run is only resumed if it would skip exactly the units already written.
+    """
+    index_path = Path(output_dir) / "index.json"
+    if not os.path.exists(index_path):
+        return {**config, "num_units_done": 0, "shards": []}
+
+    index = json.load(open(index_path))
+    for key, value in config.items():
+        if index.get(key) != value:
+            raise ValueError(
+                f"{output_dir} was tokenized with {key}={index.get(key)}, not {value}. Use a new output_dir."
+            )
+    print(
+        f"Resuming after {len(index['shards'])} shards ({index['num_units_done']} work units)",
+        flush=True,
+    )
+    return index
+
+
+@click.command()
+@click.option(
+    "--tokenizer_path",
+    type=str,
+    help="Path to tokenizer.json, or a tokenizer directory (including one compiled by compile_tokenizer.py).",
+)
+@click.option(
+    "--output_dir",
+    type=str,
+    help="Where to save the token shards and index.",
+)
+@click.option(
+    "--corpus_dir",
+    type=str,
+    default=None,
+    help="Directory of text files to tokenize. Each file is treated as one document.",
+)
+@click.option(
+    "--hf_dataset",
+    type=str,
+    default=None,
+    help="Hugging Face dataset (or local directory of .parquet/.arrow files) to stream instead of corpus_dir. Each example is one document.",
+)
+@click.option(
+    "--text_column",
+    type=str,
+    default="text",
+    help="Column name containing text in the HF dataset.",
+)
+@click.option(
+    "--num_bytes",
+    type=int,
+    default=None,
+    help="Maximum number of bytes to read from the HF dataset.",
+)
+@click.option(
+    "--dedup",
+    type=bool,
+    default=False,
+    help="Whether to skip exact repeats of documents (files of corpus_dir, or examples of the HF dataset), using a Bloom filter.",
+)
+@click.option(
+    "--dedup_capacity",
+    type=int,
+    default=None,
+    help="Number of unique documents the dedup filter is sized for (1.8 bytes each). Defaults to the number of files of corpus_dir, or one document per 256 bytes of --num_bytes for HF datasets.",
+)
+@click.option(
+    "--eos_token",
+    type=str,
+    default="<|endoftext|>",
+    help="Token appended to the end of every document.",
+)
+@click.option(
+    "--num_workers",
+    type=int,
+    default=os.cpu_count(),
+    help="Number of processes to tokenize with.",
+)
+@click.option(
+    "--block_size",
+    type=int,
+    default=BLOCK_SIZE,
+    help="Files are read in blocks of about this many bytes.",
+)
+@click.option(
+    "--shard_num_tokens",
+    type=int,
+    default=SHARD_NUM_TOKENS,
+    help="Approximate number of tokens per shard.",
+)
+def main(
+    tokenizer_path: str,
+    output_dir: str,
+    corpus_dir: str,
+    hf_dataset: str,
+    text_column: str,
+    num_bytes: int,
+    dedup: bool,
+    dedup_capacity: int,
+    eos_token: str,
+    num_workers: int,
+    block_size: int,
+    shard_num_tokens: int,
+):
+    ensure_dir(output_dir)
+    tokenizer = load_tokenizer(tokenizer_path)
+    eos_token_id = tokenizer.token_to_id(eos_token)
+    if eos_token_id is None:
+        raise ValueError(f"{eos_token} is not in the vocabulary of {tokenizer_path}")
+
+    if corpus_dir:
+        file_list, byte_count = get_files_with_num_bytes(corpus_dir)
+        file_list = sorted(file_list)
+        # a resumed run skips the work units already written, so it must see the same files
+        listing = [[os.path.basename(file), os.path.getsize(file)] for file in file_list]
+        files_sha256 = hashlib.sha256(json.dumps(listing).encode()).hexdigest()
+    else:
+        files_sha256 = None
+
+    config = {
+        "tokenizer_path": os.path.abspath(tokenizer_path),
+        "source": os.path.abspath(corpus_dir) if corpus_dir else hf_dataset,
+        "files_sha256": files_sha256,
+        "num_bytes": num_bytes,
+        "eos_token_id": eos_token_id,
+        "dtype": "uint32",
+        "block_size": block_size,
+        "docs_per_batch": DOCS_PER_BATCH if hf_dataset else None,
+        "num_readers": NUM_READERS if hf_dataset else None,
+    }
+    if dedup:
+        if dedup_capacity is None:
+            dedup_capacity = get_dedup_capacity(
+                num_texts=len(file_list) if corpus_dir else None, num_bytes=num_bytes
+            )
+        config["dedup_capacity"] = dedup_capacity
+    index = load_index(output_dir, config)
+    for f in os.listdir(output_dir):
+        if f.endswith(".tmp"):
+            os.remove(Path(output_dir) / f)
+
+    if num_workers > 1:
+        # Split the cores between workers, since each one also encodes its batches in parallel
+        os.environ.setdefault(
+            "RAYON_RS_NUM_CPUS", str(max(os.cpu_count() // num_workers, 1))
+        )
+        shared_tokenizer = tokenizer if get_start_method() == "fork" else None
+        pool = Pool(num_workers, initializer=init_worker, initargs=(tokenizer_path, shared_tokenizer))
+        results_fn = lambda tasks: imap_bounded(pool, _tokenize_task, tasks, 2 * num_workers)
+    else:
+        pool = None
+        init_worker(tokenizer_path, tokenizer)
+        results_fn = lambda tasks: map(_tokenize_task, tasks)
+
+    # Work units are processed in a fixed order, so a resumed run can skip the ones already written
+    if corpus_dir:
+        if dedup:
+            # repeated files are dropped before the work units are made, so resuming skips the same ones
+            dedup_filter = DedupFilter(dedup_capacity)
+            file_list = dedup_files(file_list, dedup_filter, pool)
+            byte_count = sum(os.path.getsize(file) for file in file_list)
+        print(f"Tokenizing {len(file_list)} files ({byte_count:,} bytes)", flush=True)
+        file_offsets = [get_block_offsets(file, block_size) for file in file_list]
+        tasks = [
+            (tokenize_block, (file, start, end, eos_token_id))
+            for file, offsets in zip(file_list, file_offsets)
+            for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+        num_tasks = len(tasks)
+        tasks = tasks[index["num_units_done"] :]
+    elif hf_dataset:
+        texts = get_hf_dataset_iterator(
+            dataset_name=hf_dataset,
+            num_bytes=num_bytes,
+            text_column=text_column,
+            streaming=True,
+            num_readers=NUM_READERS,
+        )
+        if dedup:
+            # a resumed run passes the documents it skips through the filter again
+            dedup_filter = DedupFilter(dedup_capacity)
+            texts = dedup_texts(texts, dedup_filter)
+        texts = islice(texts, index["num_units_done"] * DOCS_PER_BATCH, None)
+        batches = iter(lambda: list(islice(texts, DOCS_PER_BATCH)), [])
+        tasks = ((tokenize_documents, (batch, eos_token_id)) for batch in batches)
+        num_tasks = None
+    else:
+        raise ValueError("Either corpus_dir or hf_dataset must be provided.")
+
+    writer = ShardWriter(output_dir, index, shard_num_tokens)
+    for ids, doc_ends in tqdm(
+        results_fn(tasks), total=num_tasks, initial=index["num_units_done"], desc="Tokenizing"
+    ):
+        writer.write(ids, doc_ends)
+    writer.close_shard()
+    if dedup:
+        index["dedup"] = dedup_filter.stats()
+        save_index(output_dir, index)
+        print(
+            f"Skipped {index['dedup']['num_dropped']:,} repeated documents "
+            f"({index['dedup']['dropped_byte_fraction']:.2%} of the bytes)",
+            flush=True,
+        )
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    num_tokens = sum(shard["num_tokens"] for shard in index["shards"])
+    print(
+        f"Saved {num_tokens:,} tokens in {len(index['shards'])} shards to {output_dir}",
+        flush=True,
+    )
+
+
+if __name__ == "__main__":
+    main()
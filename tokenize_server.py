@@ -0,0 +1,356 @@
+"""
+Serve a tokenizer to local clients over a unix socket (or TCP), batching concurrent requests.
+
+Requests are gathered into micro-batches of at most max_batch_size, waiting at most max_wait_ms after
+the first request of a batch, and each batch is run with encode_batch or decode_batch in a thread
+pool (the Rust side releases the GIL and encodes the batch in parallel). While all threads are busy,
+new requests queue up, so batches grow with the load.
+
+The protocol is one JSON object per line in each direction. A request has an "id" (echoed in the
+response) and an "op":
+    {"id": 1, "op": "encode", "text": "..."}  ->  {"id": 1, "ids": [...]}
+    {"id": 2, "op": "decode", "ids": [...]}   ->  {"id": 2, "text": "..."}
+    {"id": 3, "op": "metrics"}                ->  {"id": 3, "metrics": {...}}
+Failed requests get {"id": ..., "error": "..."}, with "id": null if the request could not be parsed.
+Responses on a connection may come out of order, so a client can send many requests without waiting
+(see TokenizerClient).
+"""
+
+import os
+import json
+import time
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import numpy as np
+
+from encode_cache import CachedTokenizer
+from utils import load_tokenizer
+
+MAX_BATCH_SIZE = 256
+MAX_WAIT_MS = 2
+NUM_THREADS = 2
+LATENCY_WINDOW = 10000
+STREAM_LIMIT = 2**28  # longest request or response line, in bytes
+
+
+class MicroBatcher:
+    """
+    Run fn (a function from a list of inputs to a list of outputs) on batches of submitted inputs.
+    A batch is started as soon as one of max_concurrent_batches slots is free and a first input has
+    arrived, and takes everything that arrives within max_wait_ms after that, up to max_batch_size.
+    """
+
+    def __init__(self, fn, executor, max_batch_size, max_wait_ms, max_concurrent_batches):
+        self.fn = fn
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.slots = asyncio.Semaphore(max_concurrent_batches)
+        self.queue = asyncio.Queue()
+        self.running = set()  # references to the batch tasks, so they are not garbage collected
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_errors = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.batch_sizes = deque(maxlen=LATENCY_WINDOW)
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((item, future, time.perf_counter()))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.slots.acquire()
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            task = loop.create_task(self._run_batch(batch))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def _run_batch(self, batch):
+        try:
+            await self._run(batch)
+        finally:
+            self.num_batches += 1
+            self.batch_sizes.append(len(batch))
+            self.slots.release()
+
+    async def _run(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            outputs = await loop.run_in_executor(self.executor, self.fn, [item for item, _, _ in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                # run the requests one at a time, so that only the invalid ones fail
+                for request in batch:
+                    await self._run([request])
+                return
+            self.num_requests += 1
+            self.num_errors += 1
+            _, future, _ = batch[0]
+            if not future.done():
+                future.set_exception(e)
+        else:
+            self.num_requests += len(batch)
+            end_time = time.perf_counter()
+            for (_, future, start_time), output in zip(batch, outputs):
+                self.latencies.append(end_time - start_time)
+                if not future.done():
+                    future.set_result(output)
+
+    def metrics(self):
+        latencies_ms = np.array(self.latencies) * 1000
+        return {
+            "queue_depth": self.queue.qsize(),
+            "running_batches": len(self.running),
+            "num_requests": self.num_requests,
+            "num_batches": self.num_batches,
+            "num_errors": self.num_errors,
+            "mean_batch_size": float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+            "p50_latency_ms": float(np.percentile(latencies_ms, 50)) if len(latencies_ms) else 0.0,
+            "p99_latency_ms": float(np.percentile(latencies_ms, 99)) if len(latencies_ms) else 0.0,
+        }
+
+
+class TokenizationServer:
+    def __init__(
+        self,
+        tokenizer,
+        num_threads=NUM_THREADS,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_wait_ms=MAX_WAIT_MS,
+        cache_entries=0,
+    ):
+        self.executor = ThreadPoolExecutor(num_threads)
+        self.cache = CachedTokenizer(tokenizer, cache_entries) if cache_entries else None
+        if self.cache is not None:
+            encode_fn = self.cache.encode_batch
+        else:
+            encode_batch = getattr(tokenizer, "encode_batch_fast", tokenizer.encode_batch)
+            encode_fn = lambda texts: [e.ids for e in encode_batch(texts)]
+        self.batchers = {
+            "encode": MicroBatcher(
+                encode_fn,
+                self.executor,
+                max_batch_size,
+                max_wait_ms,
+                num_threads,
+            ),
+            "decode": MicroBatcher(
+                tokenizer.decode_batch, self.executor, max_batch_size, max_wait_ms, num_threads
+            ),
+        }
+        self.start_time = time.time()
+        self.num_connections = 0
+
+    def metrics(self):
+        metrics = {
+            "uptime_seconds": time.time() - self.start_time,
+            "num_connections": self.num_connections,
+            **{op: batcher.metrics() for op, batcher in self.batchers.items()},
+        }
+        if self.cache is not None:
+            metrics["cache"] = self.cache.stats()
+        return metrics
+
+    async def respond(self, line, writer):
+        # replies to requests that cannot be parsed have "id": None
+        response = {"id": None}
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("A request must be a JSON object")
+            response["id"] = request.get("id")
+            if request["op"] == "encode":
+                response["ids"] = await self.batchers["encode"].submit(request["text"])
+            elif request["op"] == "decode":
+                response["text"] = await self.batchers["decode"].submit(request["ids"])
+            elif request["op"] == "metrics":
+                response["metrics"] = self.metrics()
+            else:
+                raise ValueError(f"Unknown op {request['op']}")
+        except Exception as e:
+            response["error"] = f"{type(e).__name__}: {e}"
+        if not writer.is_closing():
+            writer.write((json.dumps(response) + "\n").encode())
+            await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+        self.num_connections += 1
+        tasks = set()
+        try:
+            while line := await reader.readline():
+                task = asyncio.create_task(self.respond(line, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks, return_exceptions=True)
+        except ConnectionError:
+            pass
+        finally:
+            self.num_connections -= 1
+            writer.close()
+
+    async def serve(self, socket_path=None, host="127.0.0.1", port=None):
+        batcher_tasks = [asyncio.create_task(batcher.run()) for batcher in self.batchers.values()]
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = await asyncio.start_unix_server(
+                self.handle_connection, socket_path, limit=STREAM_LIMIT
+            )
+        else:
+            server = await asyncio.start_server(
+                self.handle_connection, host, port, limit=STREAM_LIMIT
+            )
+        print(f"Serving on {socket_path or f'{host}:{port}'}", flush=True)
+        async with server:
+            await server.serve_forever()
+        for task in batcher_tasks:
+            task.cancel()
+
+
+class TokenizerClient:
+    """
+    Client for TokenizationServer. Requests are pipelined on one connection, so concurrent calls
+    (e.g. from asyncio.gather) can be batched together by the server.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.next_id = 0
+        self.pending = {}
+        self.read_task = asyncio.create_task(self._read_responses())
+
+    @classmethod
+    async def connect(cls, socket_path=None, host="127.0.0.1", port=None):
+        if socket_path:
+            reader, writer = await asyncio.open_unix_connection(socket_path, limit=STREAM_LIMIT)
+        else:
+            reader, writer = await asyncio.open_connection(host, port, limit=STREAM_LIMIT)
+        return cls(reader, writer)
+
+    async def _read_responses(self):
+        try:
+            while line := await self.reader.readline():
+                response = json.loads(line)
+                if response.get("id") is None:
+                    # the server could not tell which request this answers
+                    print(f"Ignoring a response without an id: {response}", flush=True)
+                    continue
+                future = self.pending.pop(response["id"], None)
+                if future is None or future.done():
+                    continue
+                if "error" in response:
+                    future.set_exception(RuntimeError(response["error"]))
+                else:
+                    future.set_result(response)
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection to the server closed"))
+            self.pending.clear()
+
+    async def request(self, op, **kwargs):
+        if self.read_task.done():
+            raise ConnectionError("Connection to the server closed")
+        request_id = self.next_id
+        self.next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.writer.write((json.dumps({"id": request_id, "op": op, **kwargs}) + "\n").encode())
+        await self.writer.drain()
+        return await future
+
+    async def encode(self, text):
+        return (await self.request("encode", text=text))["ids"]
+
+    async def encode_batch(self, texts):
+        return await asyncio.gather(*[self.encode(text) for text in texts])
+
+    async def decode(self, ids):
+        return (await self.request("decode", ids=ids))["text"]
+
+    async def decode_batch(self, ids_list):
+        return await asyncio.gather(*[self.decode(ids) for ids in ids_list])
+
+    async def metrics(self):
+        return (await self.request("metrics"))["metrics"]
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+        await self.read_task
+
+
+@click.command()
+@click.option(
+    "--tokenizer_path",
+    type=str,
+    help="Path to tokenizer.json, or a tokenizer directory.",
+)
+@click.option(
+    "--socket_path",
+    type=str,
+    default=None,
+    help="Unix socket to listen on. If not given, listen on --host and --port instead.",
+)
+@click.option("--host", type=str, default="127.0.0.1", help="Host to listen on.")
+@click.option("--port", type=int, default=8765, help="Port to listen on.")
+@click.option(
+    "--num_threads",
+    type=int,
+    default=NUM_THREADS,
+    help="Number of batches run at once. Each batch is also encoded in parallel (RAYON_RS_NUM_CPUS).",
+)
+@click.option(
+    "--max_batch_size",
+    type=int,
+    default=MAX_BATCH_SIZE,
+    help="Maximum number of requests in a batch.",
+)
+@click.option(
+    "--max_wait_ms",
+    type=float,
+    default=MAX_WAIT_MS,
+    help="How long a batch waits for more requests after the first one arrives.",
+)
+@click.option(
+    "--cache_entries",
+    type=int,
+    default=0,
+    help="If given, cache the ids of up to this many repeated lines (see encode_cache).",
+)
+def main(
+    tokenizer_path: str,
+    socket_path: str,
+    host: str,
+    port: int,
+    num_threads: int,
+    max_batch_size: int,
+    max_wait_ms: float,
+    cache_entries: int,
+):
+    tokenizer = load_tokenizer(tokenizer_path)
+    server = TokenizationServer(tokenizer, num_threads, max_batch_size, max_wait_ms, cache_entries)
+    asyncio.run(server.serve(socket_path, host, port))
+
+
+if __name__ == "__main__":
+    main()
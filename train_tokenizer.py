@@ -10,14 +10,117 @@ import re
 import random
 import click
 from utils import (
+    CHECKPOINT_FILE,
+    RESULTS_DB,
+    append_results,
+    count_lines,
+    DedupFilter,
+    DedupedLines,
+    dedup_texts,
+    get_dedup_capacity,
     ensure_dir,
-    get_files_with_num_bytes,
+    get_manifest,
+    get_manifest_files,
     get_truncated_file,
+    resolve_data_path,
     train_or_extend_tokenizer,
     get_hf_dataset_iterator,
+    get_hf_dataset_sample,
+    get_hf_sample_dir,
+    read_json,
+    read_merges_txt,
+    TrainingTelemetry,
 )
 
-random.seed(0)
+RANDOM_SEED = 0
+random.seed(RANDOM_SEED)
+
+
+def get_train_data_from_meta(meta):
+    """
+    Return the training data described by a meta.json written by a previous stage, its size in
+    bytes, and the key under which its word counts can be cached (None if it cannot be cached).
+    """
+    # Check if it's a HF dataset meta file
+    if meta.get("dataset_type") == "huggingface" and "sample" in meta:
+        # read the texts cached by the previous stage (or stream them again if the cache is
+        # not on this machine), checking that they are the same
+        train_data = get_hf_dataset_sample(
+            dataset_name=meta["dataset_name"],
+            num_bytes=meta.get("total_bytes"),
+            text_column=meta.get("text_column", "text"),
+            split="train",
+            num_readers=meta["num_readers"],
+            checksum=meta["sample"]["checksum"],
+        )
+        data_key = "hf:" + Path(meta["sample"]["dir"]).name
+        actual_num_bytes = meta["total_bytes"]
+    elif meta.get("dataset_type") == "huggingface":
+        train_data = get_hf_dataset_iterator(
+            dataset_name=meta["dataset_name"],
+            num_bytes=meta.get("total_bytes"),
+            text_column=meta.get("text_column", "text"),
+            split="train",
+            streaming=True,
+            # older runs read the dataset serially
+            num_readers=meta.get("num_readers", 1),
+        )
+        data_key = None  # not cached, so the data could change between runs
+        actual_num_bytes = meta["total_bytes"]
+    elif "manifest" in meta:
+        # byte ranges relative to $SUPERBPE_DATA_ROOT, so this also works on other machines
+        train_files = get_manifest_files(meta["manifest"])
+        actual_num_bytes = meta["total_bytes"]
+        train_data = train_files
+        data_key = "manifest:" + meta["manifest"]["manifest_id"]
+    else:
+        train_files, actual_num_bytes = meta["train_files"], meta["total_bytes"]
+        for file in train_files:
+            if not os.path.exists(file):
+                assert "truncated" in file, f"{file} not found"
+                wanted_filesize = int(re.search(r"_truncated_(\d+)", file).group(1))
+                file = re.sub(r"_truncated_\d+", "", file)
+                get_truncated_file(file, wanted_filesize)
+        train_data = train_files
+        data_key = None  # no manifest to key the cache on
+    return train_data, actual_num_bytes, data_key
+
+
+def apply_dedup(
+    meta, train_data, data_key, capacity=None, do_whitespace_pretokenization=True, num_bytes=None
+):
+    """
+    Drop exact repeats from train_data: repeated documents of a HF dataset, or repeated lines of
+    files in stage 2 (whose words are lines). Lines are not deduplicated in stage 1, where common
+    short lines (blank lines, closing braces) are legitimately repeated and dropping them would skew
+    the counts of their words, but the configuration is still recorded so that stage 2 applies it.
+    Records the configuration in meta["dedup"] and returns the deduplicated data, the key of its word
+    counts, and the DedupFilter (None if nothing is dropped), whose stats are known once the data
+    has been read. If capacity is None, the filter is sized for the number of lines of the files, or
+    for the num_bytes of the HF dataset (see get_dedup_capacity).
+    """
+    if isinstance(train_data, list):
+        unit = "lines"
+        if do_whitespace_pretokenization:
+            print("Repeated lines are only dropped in stage 2, so stage 1 uses all lines", flush=True)
+            dedup_filter = None
+        else:
+            if capacity is None:
+                capacity = get_dedup_capacity(num_texts=count_lines(train_data))
+            dedup_filter = DedupFilter(capacity)
+            train_data = DedupedLines(train_data, dedup_filter)
+    else:
+        if capacity is None:
+            capacity = get_dedup_capacity(num_bytes=num_bytes)
+        dedup_filter = DedupFilter(capacity)
+        unit, train_data = "documents", dedup_texts(train_data, dedup_filter)
+    previous = meta.get("dedup", {})
+    if previous.get("unit") != unit or previous.get("capacity") != capacity:
+        previous = {}  # the stats of a previous stage only apply to the same configuration
+    meta["dedup"] = {**previous, "unit": unit, "capacity": capacity}
+    if data_key and dedup_filter is not None:
+        data_key = f"{data_key}:dedup-{unit}-{capacity}"
+    return train_data, data_key, dedup_filter
 
 
 @click.command()
@@ -50,6 +153,78 @@ random.seed(0)
     default="text",
     help="Column name containing text in the HF dataset.",
 )
+@click.option(
+    "--num_readers",
+    type=int,
+    default=8,
+    help="Number of threads streaming shards of the HF dataset. This determines the order of the texts, so stage 2 reuses the value from meta.json.",
+)
+@click.option(
+    "--cache_hf_sample",
+    type=bool,
+    default=True,
+    help="Whether to cache the streamed HF dataset sample on disk ($SUPERBPE_CACHE_DIR/samples), so that later stages read it from there.",
+)
+@click.option(
+    "--cache_word_counts",
+    type=bool,
+    default=True,
+    help="Whether to cache the pretoken counts of the training data ($SUPERBPE_CACHE_DIR/word_counts), so that runs on the same data with the same pretokenization skip counting.",
+)
+@click.option(
+    "--checkpoint_every",
+    type=int,
+    default=None,
+    help="Save merges.txt every this many merges, so that training can be resumed with --resume. Each segment replays all pretoken counts and reapplies the merges learned so far, and segments grow to at least a quarter of the merges learned so far, so this costs up to about 5x the merge work of an uninterrupted run plus one pass over the pretoken counts per segment.",
+)
+@click.option(
+    "--checkpoint_minutes",
+    type=float,
+    default=None,
+    help="Save merges.txt about every this many minutes, so that training can be resumed with --resume. Costs the same as --checkpoint_every.",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help="Continue from the last checkpoint in output_dir.",
+)
+@click.option(
+    "--stream_stats",
+    is_flag=True,
+    default=False,
+    help="Stream training events and memory samples to train_stats.jsonl during the run.",
+)
+@click.option(
+    "--stats_interval",
+    type=float,
+    default=30,
+    help="Seconds between memory samples in train_stats.jsonl.",
+)
+@click.option(
+    "--max_unique_words",
+    type=int,
+    default=None,
+    help="Keep at most this many unique words in memory while counting, spilling the rest to disk, and drop the rarest words if there are more in total. Bounds the memory of stage 2, where words are whole lines.",
+)
+@click.option(
+    "--dedup",
+    type=bool,
+    default=False,
+    help="Whether to drop exact repeats of lines (for local files, in stage 2 only) or documents (for HF datasets) from the training data, using a Bloom filter. Later stages reading meta.json do the same.",
+)
+@click.option(
+    "--dedup_capacity",
+    type=int,
+    default=None,
+    help="Number of unique lines or documents the dedup filter is sized for (1.8 bytes each). Defaults to the number of lines of the files, or one document per 256 bytes of --num_bytes for HF datasets.",
+)
+@click.option(
+    "--results_db",
+    type=str,
+    default=RESULTS_DB,
+    help="SQLite database to append the training statistics to (see utils.query_results). Pass an empty string to skip.",
+)
 @click.option(
     "--vocab_size",
     type=int,
@@ -70,42 +245,78 @@ def main(
     do_whitespace_pretokenization: bool,
     hf_dataset: str,
     text_column: str,
+    num_readers: int,
+    cache_hf_sample: bool,
+    cache_word_counts: bool,
+    checkpoint_every: int,
+    checkpoint_minutes: float,
+    resume: bool,
+    stream_stats: bool,
+    stats_interval: float,
+    max_unique_words: int,
+    dedup: bool,
+    dedup_capacity: int,
+    results_db: str,
 ):
     output_dir = Path(output_dir)
     ensure_dir(output_dir)
+    if corpus_dir:
+        corpus_dir = os.path.abspath(resolve_data_path(corpus_dir))
+    if results_db:
+        results_db = os.path.abspath(results_db)
     print(f"We are training a tokenizer for {output_dir}", flush=True)
 
     # We look for merges.txt in the current dir to determine whether we are extending
     # the tokenizer or training from scratch, so we need to cd into the output directory.
     os.chdir(output_dir)
 
+    # A checkpoint's merges.txt would otherwise be mistaken for inherited merges
+    if os.path.exists(CHECKPOINT_FILE) and not resume:
+        raise ValueError(
+            f"{output_dir} contains a checkpoint of an interrupted run. Use --resume to continue it."
+        )
+    resuming = resume and os.path.exists(CHECKPOINT_FILE)
+    if resume and not resuming:
+        print(f"No checkpoint found in {output_dir}, starting from scratch", flush=True)
+
+    telemetry = TrainingTelemetry("train_stats.jsonl" if stream_stats else None, stats_interval)
+    prepare_start_time = time.time()
+
     # Check if we're using HF dataset or local files
     if hf_dataset:
         print(f"Using Hugging Face dataset: {hf_dataset}")
         # For HF datasets, we'll use an iterator
-        train_data = get_hf_dataset_iterator(
+        get_iterator = get_hf_dataset_sample if cache_hf_sample else get_hf_dataset_iterator
+        train_data = get_iterator(
             dataset_name=hf_dataset,
             num_bytes=num_bytes,
             text_column=text_column,
             split="train",
-            streaming=True,
+            num_readers=num_readers,
         )
+        data_key = None
+        if cache_hf_sample:
+            data_key = "hf:" + get_hf_sample_dir(hf_dataset, num_bytes, text_column, "train", num_readers).name
         actual_num_bytes = num_bytes  # Will be updated by the iterator
         
         # Write metadata for HF dataset
-        with open("meta.json", "w") as fo:
-            meta = {
-                "dataset_type": "huggingface",
-                "dataset_name": hf_dataset,
-                "text_column": text_column,
-                "total_bytes": actual_num_bytes,
-            }
-            if os.path.exists("merges.txt"):
-                os.system("cp merges.txt initial_merges.txt")
-                meta["num_initial_merges"] = (
-                    sum(1 for line in open("initial_merges.txt")) - 1
-                )
-            json.dump(meta, fo, indent=5)
+        if resuming:
+            meta = json.load(open("meta.json"))  # keep the metadata of the interrupted run
+        else:
+            with open("meta.json", "w") as fo:
+                meta = {
+                    "dataset_type": "huggingface",
+                    "dataset_name": hf_dataset,
+                    "text_column": text_column,
+                    "total_bytes": actual_num_bytes,
+                    "num_readers": num_readers,
+                }
+                if os.path.exists("merges.txt"):
+                    os.system("cp merges.txt initial_merges.txt")
+                    meta["num_initial_merges"] = (
+                        sum(1 for line in open("initial_merges.txt")) - 1
+                    )
+                json.dump(meta, fo, indent=5)
     else:
         if os.path.exists("meta.json"):
             print(
@@ -113,30 +324,20 @@ def main(
             )
             meta = json.load(open("meta.json"))
             
-            # Check if it's a HF dataset meta file
-            if meta.get("dataset_type") == "huggingface":
-                train_data = get_hf_dataset_iterator(
-                    dataset_name=meta["dataset_name"],
-                    num_bytes=meta.get("total_bytes"),
-                    text_column=meta.get("text_column", "text"),
-                    split="train",
-                    streaming=True,
-                )
-                actual_num_bytes = meta["total_bytes"]
-            else:
-                train_files, actual_num_bytes = meta["train_files"], meta["total_bytes"]
-                for file in train_files:
-                    if not os.path.exists(file):
-                        assert "truncated" in file, f"{file} not found"
-                        wanted_filesize = int(re.search(r"_truncated_(\d+)", file).group(1))
-                        file = re.sub(r"_truncated_\d+", "", file)
-                        get_truncated_file(file, wanted_filesize)
-                train_data = train_files
+            train_data, actual_num_bytes, data_key = get_train_data_from_meta(meta)
+            # meta.json copied from stage 1, so record the transition point like a new run does
+            if os.path.exists("merges.txt") and "num_initial_merges" not in meta and not resuming:
+                os.system("cp merges.txt initial_merges.txt")
+                meta["num_initial_merges"] = sum(1 for line in open("initial_merges.txt")) - 1
+                with open("meta.json", "w") as fo:
+                    json.dump(meta, fo, indent=5)
         else:
             if not corpus_dir:
                 raise ValueError("Either --corpus_dir or --hf_dataset must be provided")
-            train_files, actual_num_bytes = get_files_with_num_bytes(corpus_dir, num_bytes)
+            manifest = get_manifest(corpus_dir, num_bytes, seed=RANDOM_SEED)
+            train_files, actual_num_bytes = get_manifest_files(manifest), manifest["total_bytes"]
             train_data = train_files
+            data_key = "manifest:" + manifest["manifest_id"]
 
             # Write metadata for file-based training
             with open("meta.json", "w") as fo:
@@ -144,6 +345,7 @@ def main(
                     "dataset_type": "files",
                     "total_bytes": actual_num_bytes,
                     "train_files": train_files,
+                    "manifest": manifest,
                 }
                 if os.path.exists("merges.txt"):
                     os.system("cp merges.txt initial_merges.txt")
@@ -152,6 +354,25 @@ def main(
                     )
                 json.dump(meta, fo, indent=5)
 
+    dedup_filter = None
+    if dedup or "dedup" in meta:
+        dedup_capacity = meta["dedup"]["capacity"] if "dedup" in meta else dedup_capacity
+        train_data, data_key, dedup_filter = apply_dedup(
+            meta, train_data, data_key, dedup_capacity, do_whitespace_pretokenization, actual_num_bytes
+        )
+        with open("meta.json", "w") as fo:
+            json.dump(meta, fo, indent=5)
+
+    telemetry.add_phase_time("prepare_data", time.time() - prepare_start_time)
+    num_merges_at_start = len(read_merges_txt("merges.txt")) if os.path.exists("merges.txt") else 0
+    telemetry.record(
+        vocab_size=vocab_size,
+        num_bytes=actual_num_bytes,
+        do_whitespace_pretokenization=do_whitespace_pretokenization,
+        num_merges_at_start=num_merges_at_start,
+        resumed=resuming,
+    )
+
     # Train tokenizer
     start_time = time.time()
 
@@ -160,11 +381,72 @@ def main(
         train_data,
         vocab_size=vocab_size,
         do_whitespace_pretokenization=do_whitespace_pretokenization,
+        data_key=data_key if cache_word_counts else None,
+        checkpoint_every=checkpoint_every,
+        checkpoint_minutes=checkpoint_minutes,
+        telemetry=telemetry,
+        max_unique_words=max_unique_words,
     )
-    tokenizer.model.save(".")  # saves merges.txt and vocab.json
-    tokenizer.save("tokenizer.json")
+    with telemetry.phase("save"):
+        tokenizer.model.save(".")  # saves merges.txt and vocab.json
+        tokenizer.save("tokenizer.json")
 
     print(f"Train time: {time.time() - start_time}", flush=True)
+
+    # the filter only saw the data if the word counts were not loaded from the cache
+    if dedup_filter is not None and dedup_filter.num_texts:
+        meta["dedup"].update(dedup_filter.stats())
+        telemetry.record(dedup=meta["dedup"])
+        with open("meta.json", "w") as fo:
+            json.dump(meta, fo, indent=5)
+        print(
+            f"Dropped {meta['dedup']['num_dropped']:,} repeated {meta['dedup']['unit']} "
+            f"({meta['dedup']['dropped_byte_fraction']:.2%} of the bytes)",
+            flush=True,
+        )
+
+    # Save training statistics next to meta.json
+    num_new_merges = len(read_merges_txt("merges.txt")) - num_merges_at_start
+    train_seconds = sum(
+        telemetry.stats["phases"].get(phase, 0) for phase in ["train", "read_count_train"]
+    )
+    telemetry.record(
+        num_new_merges=num_new_merges,
+        merges_per_second=num_new_merges / max(train_seconds, 1e-3),
+    )
+    telemetry.save("train_stats.json")
+    telemetry.close()
+
+    if results_db:
+        stats = read_json("train_stats.json")
+        row = {
+            "tokenizer": output_dir.name,
+            "output_dir": os.getcwd(),
+            "num_inherit_merges": meta.get("num_initial_merges"),
+            "vocab_size": vocab_size,
+            "num_new_merges": num_new_merges,
+            "num_bytes": actual_num_bytes,
+            "do_whitespace_pretokenization": do_whitespace_pretokenization,
+            "num_unique_words": stats.get("num_unique_words"),
+            "train_seconds": train_seconds,
+            "total_seconds": stats["total_seconds"],
+            "merges_per_second": stats["merges_per_second"],
+            "peak_rss_bytes": stats["peak_rss_bytes"],
+            "phases": json.dumps(stats["phases"]),
+        }
+        append_results(results_db, "train_results", [row], files=meta.get("train_files"))
+
+    if hf_dataset and cache_hf_sample:
+        # Record the cached sample so that later stages (and encode.py) can read it from disk
+        sample_dir = get_hf_sample_dir(hf_dataset, num_bytes, text_column, "train", num_readers)
+        # the sample is not written if the word counts were loaded from the cache instead
+        if os.path.exists(sample_dir / "sample.json"):
+            sample_info = read_json(sample_dir / "sample.json")
+            meta["sample"] = {"dir": str(sample_dir), "checksum": sample_info["checksum"]}
+            with open("meta.json", "w") as fo:
+                json.dump(meta, fo, indent=5)
+        else:
+            print(f"No cached sample in {sample_dir}, later stages will stream the dataset again")
     print("Tokenizer info saved to " + str(output_dir), flush=True)
 
     # Delete files that were constructed just for this
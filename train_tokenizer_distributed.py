@@ -0,0 +1,407 @@
+"""
+Train a tokenizer with pretoken counting spread over several nodes that only share a filesystem.
+
+    map     Worker i of num_workers counts the pretokens in its shards of the training data (a
+            manifest from get_manifest, cut into byte ranges that end at line boundaries) and saves a
+            partial count table per shard in job_dir/partials.
+    reduce  Waits for all partial tables, merges them, drops words seen fewer than min_count times,
+            and trains (or, if output_dir contains merges.txt, extends) the tokenizer on the merged
+            counts, like train_tokenizer.
+    local   Runs num_workers map processes and the reducer on this machine, standing in for nodes.
+
+The first process to arrive writes job_dir/job.json with the manifest and the shards, and all other
+processes check that they were started with the same data and pretokenization. Partial tables are
+written under a temporary name and renamed when complete, so a table marks its shard as done, and a
+restarted worker skips the shards it has already counted.
+
+For SuperBPE, run a second job with --do_whitespace_pretokenization false and --meta_path pointing
+at the stage 1 meta.json (so that it counts the same data), and reduce it into a directory with the
+inherited merges.txt, as in scripts/extend_tokenizer.sh.
+"""
+
+import os
+import sys
+import time
+import json
+import socket
+import subprocess
+from pathlib import Path
+
+import click
+import numpy as np
+
+from utils import (
+    WORD_COUNT_BLOCK_SIZE,
+    count_words,
+    ensure_dir,
+    get_line_blocks,
+    get_manifest,
+    get_pretokenizer,
+    get_word_counts_path,
+    iter_word_counts,
+    merge_word_count_runs,
+    prune_word_counts,
+    read_json,
+    read_merges_txt,
+    resolve_data_path,
+    save_word_counts,
+    train_or_extend_tokenizer,
+    TrainingTelemetry,
+)
+
+RANDOM_SEED = 0
+SHARDS_PER_WORKER = 4
+POLL_INTERVAL = 5
+JOB_FILE = "job.json"
+
+
+def get_shards(manifest, num_shards):
+    """
+    Cut the byte ranges of manifest into num_shards lists of [path, start, end] ranges of about the
+    same size, ending at line boundaries, in the order of the manifest.
+    """
+    block_size = max(min(manifest["total_bytes"] // num_shards // 8, WORD_COUNT_BLOCK_SIZE), 1)
+    blocks = []
+    for path, start, end in manifest["files"]:
+        for _, block_start, block_end in get_line_blocks(
+            resolve_data_path(path), block_size, start, end
+        ):
+            blocks.append([path, block_start, block_end])
+
+    shards = [[] for _ in range(num_shards)]
+    total_bytes, num_bytes = sum(end - start for _, start, end in blocks), 0
+    for path, start, end in blocks:
+        shard = shards[min(num_bytes * num_shards // max(total_bytes, 1), num_shards - 1)]
+        if shard and shard[-1][0] == path and shard[-1][2] == start:
+            shard[-1][2] = end  # extend the previous range of the same file
+        else:
+            shard.append([path, start, end])
+        num_bytes += end - start
+    return shards
+
+
+def get_job(job_dir, manifest, do_whitespace_pretokenization, num_workers):
+    """
+    Return the job in job_dir, creating it if this is the first process to arrive. Raises ValueError
+    if the job was created with different data or pretokenization.
+    """
+    job_path = job_dir / JOB_FILE
+    if not os.path.exists(job_path):
+        _, regex_string = get_pretokenizer(do_whitespace_pretokenization)
+        job = {
+            "manifest": manifest,
+            "do_whitespace_pretokenization": do_whitespace_pretokenization,
+            "regex_string": regex_string,
+            "num_workers": num_workers,
+            "shards": get_shards(manifest, num_workers * SHARDS_PER_WORKER),
+        }
+        ensure_dir(job_dir)
+        tmp_path = f"{job_path}.{socket.gethostname()}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as fo:
+            json.dump(job, fo, indent=5)
+        try:
+            # unlike os.replace, this fails if another process created the job first
+            os.link(tmp_path, job_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+
+    job = read_json(job_path)
+    for key, value in [
+        ("manifest_id", manifest["manifest_id"]),
+        ("do_whitespace_pretokenization", do_whitespace_pretokenization),
+        ("num_workers", num_workers),
+    ]:
+        job_value = job["manifest"]["manifest_id"] if key == "manifest_id" else job[key]
+        if job_value != value:
+            raise ValueError(f"{job_path} was created with {key}={job_value}, but got {value}")
+    return job
+
+
+def get_partial_path(job_dir, shard_index):
+    return job_dir / "partials" / f"shard-{shard_index:05d}.npz"
+
+
+def run_map(job_dir, manifest, do_whitespace_pretokenization, num_workers, worker_id, num_processes):
+    job = get_job(job_dir, manifest, do_whitespace_pretokenization, num_workers)
+    ensure_dir(job_dir / "partials")
+    ensure_dir(job_dir / "workers")
+    stats = {"worker_id": worker_id, "host": socket.gethostname(), "shards": []}
+    for shard_index in range(worker_id, len(job["shards"]), num_workers):
+        partial_path = get_partial_path(job_dir, shard_index)
+        if os.path.exists(partial_path):
+            print(f"Shard {shard_index} was already counted, skipping", flush=True)
+            continue
+        shard = [
+            (resolve_data_path(path), start, end) for path, start, end in job["shards"][shard_index]
+        ]
+        start_time = time.time()
+        counts = count_words(shard, do_whitespace_pretokenization, job["regex_string"], num_processes)
+        # sorted by word, so that the reducer can merge the partial tables without loading them all
+        save_word_counts(partial_path, sorted(counts.items()))
+        stats["shards"].append(
+            {
+                "shard": shard_index,
+                "num_bytes": sum(end - start for _, start, end in shard),
+                "num_unique_words": len(counts),
+                "seconds": time.time() - start_time,
+            }
+        )
+        print(f"Saved {len(counts):,} word counts of shard {shard_index} to {partial_path}", flush=True)
+    with open(job_dir / "workers" / f"worker-{worker_id:05d}.json", "w") as fo:
+        json.dump(stats, fo, indent=5)
+
+
+def wait_for_job(job_dir, timeout):
+    """
+    Wait until the job in job_dir exists and the partial tables of all its shards are saved, and
+    return the job. Raises TimeoutError after timeout seconds.
+    """
+    start_time = time.time()
+    while True:
+        if os.path.exists(job_dir / JOB_FILE):
+            job = read_json(job_dir / JOB_FILE)
+            num_shards = len(job["shards"])
+            missing = [i for i in range(num_shards) if not os.path.exists(get_partial_path(job_dir, i))]
+            if not missing:
+                return job
+            status = f"{len(missing)} of {num_shards} shards"
+        else:
+            status = "the first worker to create the job"
+        if timeout is not None and time.time() - start_time > timeout:
+            raise TimeoutError(f"Still waiting for {status} of {job_dir} after {timeout} seconds")
+        print(f"Waiting for {status}", flush=True)
+        time.sleep(POLL_INTERVAL)
+
+
+def iter_partial(path):
+    """Yield the (word, count) pairs of a partial table, checking that they are sorted by word."""
+    previous = None
+    for word, count in iter_word_counts(path):
+        if previous is not None and word <= previous:
+            raise ValueError(f"{path} is not sorted by word, so it cannot be merged. Count it again.")
+        previous = word
+        yield word, count
+
+
+def merge_partials(job_dir, num_shards):
+    """
+    Yield the (word, count) pairs of the sum of the partial tables of all shards, in word order,
+    with a k-way merge that only decodes a chunk of each table at a time.
+    """
+    return merge_word_count_runs(
+        [iter_partial(get_partial_path(job_dir, shard_index)) for shard_index in range(num_shards)]
+    )
+
+
+def run_reduce(job_dir, output_dir, vocab_size, min_count, timeout, cache_word_counts):
+    ensure_dir(output_dir)
+    print(f"We are training a tokenizer for {output_dir} from the counts in {job_dir}", flush=True)
+
+    # We look for merges.txt in the current dir to determine whether we are extending
+    # the tokenizer or training from scratch, so we need to cd into the output directory.
+    os.chdir(output_dir)
+    telemetry = TrainingTelemetry()
+
+    with telemetry.phase("wait_for_workers"):
+        job = wait_for_job(job_dir, timeout)
+    manifest = job["manifest"]
+    num_shards = len(job["shards"])
+    do_whitespace_pretokenization = job["do_whitespace_pretokenization"]
+    totals = {"num_unique_words": 0, "num_words": 0}
+
+    def count_totals(items):
+        for word, count in items:
+            totals["num_unique_words"] += 1
+            totals["num_words"] += count
+            yield word, count
+
+    with telemetry.phase("merge_partials"):
+        merged = merge_partials(job_dir, num_shards)
+        if cache_word_counts:
+            # the same counts get_word_counts would compute on one node, so train_tokenizer and
+            # sweep_transitions can reuse them
+            path = get_word_counts_path(
+                "manifest:" + manifest["manifest_id"], do_whitespace_pretokenization, job["regex_string"]
+            )
+            ensure_dir(path.parent)
+            save_word_counts(path, merged)
+            merged = iter_word_counts(path)
+        # only the words that are kept are held in memory
+        counts = prune_word_counts(count_totals(merged), min_count - 1)
+    words = list(counts)
+    word_counts = np.fromiter(counts.values(), dtype=np.uint64, count=len(counts))
+    del counts
+    distributed = {
+        "job_dir": str(job_dir),
+        "num_workers": job["num_workers"],
+        "num_shards": num_shards,
+        "min_count": min_count,
+        "num_pruned_unique_words": totals["num_unique_words"] - len(words),
+        "pruned_word_fraction": 1 - int(word_counts.sum()) / max(totals["num_words"], 1),
+    }
+    print(
+        f"Merged {totals['num_unique_words']:,} words from {num_shards} shards, kept {len(words):,} "
+        f"seen at least {min_count} times ({1 - distributed['pruned_word_fraction']:.2%} of all words)",
+        flush=True,
+    )
+
+    if os.path.exists("meta.json"):
+        # e.g. copied from stage 1, which has to be the same data
+        meta = read_json("meta.json")
+        if meta.get("manifest", {}).get("manifest_id") != manifest["manifest_id"]:
+            raise ValueError(f"meta.json in {output_dir} describes different data than {job_dir}")
+    else:
+        meta = {"dataset_type": "files", "total_bytes": manifest["total_bytes"], "manifest": manifest}
+    if os.path.exists("merges.txt") and "num_initial_merges" not in meta:
+        os.system("cp merges.txt initial_merges.txt")
+        meta["num_initial_merges"] = sum(1 for line in open("initial_merges.txt")) - 1
+    meta["distributed"] = distributed
+    with open("meta.json", "w") as fo:
+        json.dump(meta, fo, indent=5)
+
+    num_merges_at_start = len(read_merges_txt("merges.txt")) if os.path.exists("merges.txt") else 0
+    telemetry.record(
+        vocab_size=vocab_size,
+        num_bytes=manifest["total_bytes"],
+        do_whitespace_pretokenization=do_whitespace_pretokenization,
+        num_merges_at_start=num_merges_at_start,
+        **distributed,
+    )
+    tokenizer = train_or_extend_tokenizer(
+        None,
+        vocab_size=vocab_size,
+        do_whitespace_pretokenization=do_whitespace_pretokenization,
+        telemetry=telemetry,
+        word_counts=(words, word_counts),
+    )
+    with telemetry.phase("save"):
+        tokenizer.model.save(".")  # saves merges.txt and vocab.json
+        tokenizer.save("tokenizer.json")
+
+    num_new_merges = len(read_merges_txt("merges.txt")) - num_merges_at_start
+    telemetry.record(
+        num_new_merges=num_new_merges,
+        merges_per_second=num_new_merges / max(telemetry.stats["phases"].get("train", 0), 1e-3),
+    )
+    telemetry.save("train_stats.json")
+    print("Tokenizer info saved to " + str(output_dir), flush=True)
+
+
+def get_job_manifest(corpus_dir, num_bytes, meta_path):
+    if meta_path:
+        meta = read_json(meta_path)
+        if "manifest" not in meta:
+            raise ValueError(f"{meta_path} has no manifest (only file-based runs can be distributed)")
+        return meta["manifest"]
+    if not corpus_dir:
+        raise ValueError("Either --corpus_dir or --meta_path must be provided")
+    return get_manifest(os.path.abspath(resolve_data_path(corpus_dir)), num_bytes, seed=RANDOM_SEED)
+
+
+data_options = [
+    click.option("--job_dir", type=str, help="Directory on the shared filesystem for the partial counts."),
+    click.option("--corpus_dir", type=str, default=None, help="Directory containing text files to train on."),
+    click.option("--num_bytes", type=int, default=None, help="The maximum number of bytes to use for tokenizer training."),
+    click.option("--meta_path", type=str, default=None, help="Train on the data of a previous stage instead (its meta.json)."),
+    click.option("--num_workers", type=int, help="Number of map workers (nodes)."),
+    click.option("--do_whitespace_pretokenization", type=bool, default=True, help="Whether to do whitespace pretokenization."),
+    click.option("--num_processes", type=int, default=os.cpu_count(), help="Number of counting processes per worker."),
+]
+reduce_options = [
+    click.option("--output_dir", type=str, help="Where to save the trained tokenizer."),
+    click.option("--vocab_size", type=int, default=100000, help="The number of tokens in the vocabulary."),
+    click.option("--min_count", type=int, default=1, help="Drop words seen fewer than this many times in total before training."),
+    click.option("--timeout", type=float, default=None, help="Seconds to wait for the workers before giving up."),
+    click.option("--cache_word_counts", type=bool, default=True, help="Whether to also save the merged counts in $SUPERBPE_CACHE_DIR/word_counts, where train_tokenizer looks for them."),
+]
+
+
+def add_options(options):
+    def decorator(fn):
+        for option in reversed(options):
+            fn = option(fn)
+        return fn
+    return decorator
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command("map")
+@add_options(data_options)
+@click.option("--worker_id", type=int, help="Index of this worker, from 0 to num_workers - 1.")
+def map_command(
+    job_dir,
+    corpus_dir,
+    num_bytes,
+    meta_path,
+    num_workers,
+    do_whitespace_pretokenization,
+    num_processes,
+    worker_id,
+):
+    manifest = get_job_manifest(corpus_dir, num_bytes, meta_path)
+    run_map(
+        Path(job_dir), manifest, do_whitespace_pretokenization, num_workers, worker_id, num_processes
+    )
+
+
+@cli.command("reduce")
+@click.option("--job_dir", type=str, help="Directory on the shared filesystem for the partial counts.")
+@add_options(reduce_options)
+def reduce_command(job_dir, output_dir, vocab_size, min_count, timeout, cache_word_counts):
+    run_reduce(
+        Path(job_dir).absolute(), Path(output_dir), vocab_size, min_count, timeout, cache_word_counts
+    )
+
+
+@cli.command("local")
+@add_options(data_options)
+@add_options(reduce_options)
+def local_command(
+    job_dir,
+    corpus_dir,
+    num_bytes,
+    meta_path,
+    num_workers,
+    do_whitespace_pretokenization,
+    num_processes,
+    output_dir,
+    vocab_size,
+    min_count,
+    timeout,
+    cache_word_counts,
+):
+    # the workers run in the directory of this script
+    job_dir = os.path.abspath(job_dir)
+    corpus_dir = corpus_dir and os.path.abspath(corpus_dir)
+    meta_path = meta_path and os.path.abspath(meta_path)
+    # create the job first, so the workers do not all cut the manifest into shards
+    manifest = get_job_manifest(corpus_dir, num_bytes, meta_path)
+    get_job(Path(job_dir), manifest, do_whitespace_pretokenization, num_workers)
+
+    cmd = [sys.executable, "-m", "train_tokenizer_distributed", "map", "--job_dir", job_dir]
+    if meta_path:
+        cmd += ["--meta_path", meta_path]
+    else:
+        cmd += ["--corpus_dir", corpus_dir] + (["--num_bytes", str(num_bytes)] if num_bytes else [])
+    cmd += ["--num_workers", str(num_workers), "--num_processes", str(num_processes)]
+    cmd += ["--do_whitespace_pretokenization", str(do_whitespace_pretokenization)]
+    workers = [
+        subprocess.Popen(cmd + ["--worker_id", str(i)], cwd=Path(__file__).parent)
+        for i in range(num_workers)
+    ]
+    for i, worker in enumerate(workers):
+        if worker.wait() != 0:
+            raise SystemExit(f"Worker {i} failed with code {worker.returncode}")
+    run_reduce(
+        Path(job_dir).absolute(), Path(output_dir), vocab_size, min_count, timeout, cache_word_counts
+    )
+
+
+if __name__ == "__main__":
+    cli()
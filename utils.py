@@ -1,16 +1,36 @@
 from __future__ import annotations
 
 import os
+import gc
+import math
 import random
+import mmap
+import shutil
+import hashlib
+import heapq
+import tempfile
+import queue
+import threading
+import time
+import resource
+import sqlite3
+from array import array
+from collections import Counter
+from contextlib import closing, contextmanager
+from itertools import groupby, islice
+from multiprocessing import Pool
 from pathlib import Path
 from filelock import FileLock
 from typing import Union, Optional, Iterator, List
 
+import numpy as np
+import regex as re
 import simdjson as json
 from tqdm import tqdm
+import tokenizers
 from tokenizers.models import BPE, Unigram
 
-from tokenizers import Tokenizer, pre_tokenizers, Regex
+from tokenizers import Tokenizer, pre_tokenizers, decoders, Regex
 from tokenizers.pre_tokenizers import ByteLevel, Split, Digits
 from tokenizers.trainers import BpeTrainer, UnigramTrainer
 from datasets import load_dataset, IterableDataset
@@ -45,20 +65,8 @@ def get_pretokenization_regex(tokenizer_json):
     return pretok_regex
 
 
-def train_or_extend_tokenizer(
-    text_files: Union[str, List[str], Iterator[str]],
-    vocab_size: int = 100000,
-    do_whitespace_pretokenization: bool = True,
-    regex_string: str = None,
-    tokenizer_type: str = "bpe",
-):
-    if tokenizer_type == "bpe":
-        tokenizer = Tokenizer(BPE())
-        trainer = BpeTrainer(show_progress=True, vocab_size=vocab_size)
-    elif tokenizer_type == "unigram":
-        tokenizer = Tokenizer(Unigram())
-        trainer = UnigramTrainer(show_progress=True, vocab_size=vocab_size)
-
+def get_pretokenizer(do_whitespace_pretokenization: bool = True, regex_string: str = None):
+    """Return the pretokenizer used for training, and the regex it splits on."""
     if not regex_string:
         regex_string = "(?=(\d{3})+(?!\d))"  # pretokenize digits in groups of 3 from right to left (from Luca)
 
@@ -82,19 +90,1413 @@ def train_or_extend_tokenizer(
             use_regex=False,
         ),
     ]
-    tokenizer.pre_tokenizer = pre_tokenizers.Sequence(pretokenizers)
-    
-    # Handle different input types
-    if isinstance(text_files, (str, list)):
-        # Traditional file-based training
-        tokenizer.train(text_files, trainer)
+    return pre_tokenizers.Sequence(pretokenizers), regex_string
+
+
+# What the Digits pretokenizer splits off (Rust's char::is_numeric), the digits of the digit grouping,
+# and the GPT-2 part of the regex of get_pretokenizer
+NUMERIC_RUN_PATTERN = re.compile(r"(\p{N}+)")
+DIGIT_RUN_PATTERN = re.compile(r"\d+")
+GPT2_PATTERN = re.compile(r" ?\p{L}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+")
+
+
+def get_unicode_mismatches():
+    """
+    Return the code points whose Unicode properties (\p{L}, \p{N}, \s, \d, or being numeric for
+    Digits) differ between the regex module and the installed tokenizers, typically characters
+    assigned in a newer Unicode version than one of them knows. Found by running both on every code
+    point, and cached in $SUPERBPE_CACHE_DIR/pretokenizer for these versions.
+    """
+    path = get_cache_dir() / "pretokenizer" / f"unicode_mismatches-{tokenizers.__version__}-{re.__version__}.json"
+    if os.path.exists(path):
+        return read_json(path)
+
+    code_points = [c for c in range(0x110000) if not 0xD800 <= c <= 0xDFFF]  # no surrogates
+    text = "".join(map(chr, code_points))
+
+    def get_class(pretokenizer, pattern):
+        """The code points pretokenizer removes (or Digits splits off) but pattern does not match, and vice versa."""
+        is_kept = np.zeros(len(code_points), dtype=bool)
+        for i, (_, (start, end)) in enumerate(pretokenizer.pre_tokenize_str(text)):
+            if pretokenizer is not digits or i % 2 == 0:  # Digits alternates non-numeric, numeric
+                is_kept[start:end] = True
+        expected = {code_points[i] for i in np.flatnonzero(~is_kept)}
+        actual = {c for c in code_points if pattern.match(chr(c))}
+        return expected ^ actual
+
+    digits = Digits(individual_digits=False)
+    mismatches = get_class(digits, re.compile(r"\p{N}"))
+    for char_class in [r"\p{L}", r"\p{N}", r"\s", r"\d"]:
+        pretokenizer = Split(pattern=Regex(char_class), behavior="removed")
+        mismatches |= get_class(pretokenizer, re.compile(char_class))
+
+    ensure_dir(path.parent)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as fo:
+        json.dump(sorted(mismatches), fo)
+    os.replace(tmp_path, path)
+    return sorted(mismatches)
+
+
+class FastPretokenizer:
+    """
+    Split texts into the same byte-level words as get_pretokenizer(do_whitespace_pretokenization),
+    without the lookahead of the digit grouping: numeric runs are split off (Digits) and cut into
+    groups of 3 digits from the right by hand, and the rest is split with the GPT-2 regex (stage 1)
+    or kept whole (stage 2), then mapped to byte-level characters (ByteLevel).
+
+    Texts containing a character on which the regex module and the tokenizers library disagree (see
+    get_unicode_mismatches) are passed to the regular pretokenizer instead. benchmark_pretokenizer
+    checks that the words are always the same.
+    """
+
+    def __init__(self, do_whitespace_pretokenization=True):
+        self.do_whitespace_pretokenization = do_whitespace_pretokenization
+        self.pretokenizer, _ = get_pretokenizer(do_whitespace_pretokenization)
+        # a set, since a regex character class of the (many thousand) mismatches is slow to search
+        self.mismatches = frozenset(map(chr, get_unicode_mismatches()))
+        # ASCII texts skip the search for mismatches, unless one of them is ASCII
+        self.has_ascii_mismatches = any(c.isascii() for c in self.mismatches)
+        self.byte_level_table = str.maketrans({chr(b): c for b, c in bytes_to_unicode().items()})
+
+    def _group_digits(self, numeric_run, words):
+        """
+        Split a numeric run where (?=(\d{3})+(?!\d)) matches: before every digit that is followed by
+        a multiple of 3 digits up to the end of its digits.
+        """
+        if numeric_run.isascii():
+            head = len(numeric_run) % 3
+            if head:
+                words.append(numeric_run[:head])
+            words.extend(numeric_run[i : i + 3] for i in range(head, len(numeric_run), 3))
+            return
+        # numeric characters that are not digits (e.g. "²") end the digits before them
+        cuts = [0]
+        for match in DIGIT_RUN_PATTERN.finditer(numeric_run):
+            start, end = match.span()
+            cuts.extend(range(start + (end - start) % 3, end, 3))
+        cuts.append(len(numeric_run))
+        words.extend(numeric_run[a:b] for a, b in zip(cuts[:-1], cuts[1:]) if a < b)
+
+    def _split_gpt2(self, text, words):
+        """Split text with the GPT-2 regex, keeping the text between matches (isolated)."""
+        matches = GPT2_PATTERN.findall(text)
+        if sum(map(len, matches)) == len(text):
+            words.extend(matches)
+            return
+        start = 0
+        for match in GPT2_PATTERN.finditer(text):
+            if match.start() > start:
+                words.append(text[start : match.start()])
+            words.append(match.group())
+            start = match.end()
+        if start < len(text):
+            words.append(text[start:])
+
+    def __call__(self, text):
+        """Return the words of text."""
+        is_ascii = text.isascii()
+        if (not is_ascii or self.has_ascii_mismatches) and not self.mismatches.isdisjoint(text):
+            return [word for word, _ in self.pretokenizer.pre_tokenize_str(text)]
+
+        words = []
+        # the odd pieces are numeric runs
+        for i, piece in enumerate(NUMERIC_RUN_PATTERN.split(text)):
+            if not piece:
+                continue
+            if i % 2:
+                self._group_digits(piece, words)
+            elif self.do_whitespace_pretokenization:
+                self._split_gpt2(piece, words)
+            else:
+                words.append(piece)
+        if is_ascii:
+            return [word.translate(self.byte_level_table) for word in words]
+        return [
+            word.encode("utf-8").decode("latin-1").translate(self.byte_level_table) for word in words
+        ]
+
+
+def get_fast_pretokenizer(do_whitespace_pretokenization: bool = True, regex_string: str = None):
+    """
+    Return a FastPretokenizer for get_pretokenizer(do_whitespace_pretokenization, regex_string), or
+    None if regex_string is not the default one, or if $SUPERBPE_FAST_PRETOKENIZER is 0.
+    """
+    if os.environ.get("SUPERBPE_FAST_PRETOKENIZER", "1") == "0":
+        return None
+    if regex_string and regex_string != get_pretokenizer(do_whitespace_pretokenization)[1]:
+        return None
+    return FastPretokenizer(do_whitespace_pretokenization)
+
+
+def train_or_extend_tokenizer(
+    text_files: Union[str, List[str], Iterator[str]],
+    vocab_size: int = 100000,
+    do_whitespace_pretokenization: bool = True,
+    regex_string: str = None,
+    tokenizer_type: str = "bpe",
+    data_key: str = None,
+    checkpoint_every: int = None,
+    checkpoint_minutes: float = None,
+    telemetry: TrainingTelemetry = None,
+    word_counts: tuple = None,
+    max_unique_words: int = None,
+):
+    """
+    If data_key is given (an identifier of the training data, such as a manifest id), the word counts
+    after pretokenization are cached under that key and the pretokenizer regex (see
+    get_word_counts), and the trainer is fed the cached counts instead of the text. If word_counts
+    (words, counts) is given, e.g. merged from several nodes, text_files is ignored and the trainer
+    is fed those counts.
+
+    If checkpoint_every or checkpoint_minutes is given, BPE training is split into segments of that
+    many merges (or about that many minutes), and merges.txt is saved after each one (see
+    train_with_checkpoints). Phase timings and word counts are recorded in telemetry, if given.
+
+    If max_unique_words is given, at most that many unique words are kept in memory while counting,
+    and the rarest words are dropped if there are more (see count_words_bounded). This bounds the
+    memory of stage 2, whose words are whole lines. How many words were dropped is recorded in
+    telemetry.
+    """
+    telemetry = telemetry or TrainingTelemetry()
+    if tokenizer_type == "bpe":
+        tokenizer = Tokenizer(BPE())
+        trainer = BpeTrainer(show_progress=True, vocab_size=vocab_size)
+    elif tokenizer_type == "unigram":
+        tokenizer = Tokenizer(Unigram())
+        trainer = UnigramTrainer(show_progress=True, vocab_size=vocab_size)
+
+    pretokenizer, regex_string = get_pretokenizer(do_whitespace_pretokenization, regex_string)
+    checkpointing = tokenizer_type == "bpe" and (checkpoint_every or checkpoint_minutes)
+
+    if word_counts is not None:
+        words, counts = word_counts
+    elif data_key or checkpointing or max_unique_words:
+        with telemetry.phase("word_counts"):
+            if data_key:
+                words, counts = get_word_counts(
+                    text_files,
+                    data_key,
+                    do_whitespace_pretokenization,
+                    regex_string,
+                    max_unique_words=max_unique_words,
+                    telemetry=telemetry,
+                )
+            else:
+                # count once in memory, so that the segments do not read the data again
+                if max_unique_words:
+                    counter, stats = count_words_bounded(
+                        text_files, do_whitespace_pretokenization, regex_string, max_unique_words
+                    )
+                    telemetry.record(pruning=stats)
+                else:
+                    counter = count_words(text_files, do_whitespace_pretokenization, regex_string)
+                words = list(counter)
+                counts = np.fromiter(counter.values(), dtype=np.uint64, count=len(counter))
+
+    if word_counts is not None or data_key or checkpointing or max_unique_words:
+        telemetry.record(num_unique_words=len(words), num_words=int(counts.sum()))
+        if checkpointing:
+            tokenizer = train_with_checkpoints(
+                words, counts, vocab_size, checkpoint_every, checkpoint_minutes, telemetry
+            )
+        else:
+            # The words are already pretokenized, so the trainer only splits them at the separators
+            tokenizer.pre_tokenizer = get_replay_pretokenizer()
+            with telemetry.phase("train"):
+                tokenizer.train_from_iterator(
+                    replay_word_counts(words, counts),
+                    trainer,
+                    length=get_replay_length(words, counts),
+                )
+        tokenizer.pre_tokenizer = pretokenizer
+        return tokenizer
+
+    tokenizer.pre_tokenizer = pretokenizer
+
+    # Handle different input types (the trainer reads and counts the data, then merges)
+    with telemetry.phase("read_count_train"):
+        if isinstance(text_files, (str, list)):
+            # Traditional file-based training
+            tokenizer.train(text_files, trainer)
+        else:
+            # Iterator-based training (for streaming datasets)
+            tokenizer.train_from_iterator(text_files, trainer)
+    if hasattr(trainer, "get_word_count"):
+        telemetry.record(num_unique_words=trainer.get_word_count())
+
+    return tokenizer
+
+
+CHECKPOINT_FILE = "checkpoint.json"
+MIN_CHECKPOINT_MERGES = 100
+# Every segment replays all word counts and reapplies the merges learned so far before it merges,
+# so each segment has at least this fraction of the merges learned so far, which bounds the number
+# of segments (and replays) by about log(vocab_size) instead of vocab_size / checkpoint_every
+MIN_SEGMENT_GROWTH = 0.25
+
+
+def save_checkpoint(tokenizer, vocab_size, num_initial_merges=0):
+    """
+    Save merges.txt and vocab.json of tokenizer in the cwd, replacing the previous ones atomically,
+    and record the progress towards vocab_size (from num_initial_merges inherited merges) in
+    CHECKPOINT_FILE.
+    """
+    tmp_dir = Path(f"checkpoint.{os.getpid()}.tmp")
+    ensure_dir(tmp_dir)
+    tokenizer.model.save(str(tmp_dir))
+    for f in ["vocab.json", "merges.txt"]:
+        os.replace(tmp_dir / f, f)
+    os.rmdir(tmp_dir)
+
+    checkpoint = {
+        "vocab_size": tokenizer.get_vocab_size(),
+        "target_vocab_size": vocab_size,
+        "num_initial_merges": num_initial_merges,
+    }
+    with open(f"{CHECKPOINT_FILE}.tmp", "w") as fo:
+        json.dump(checkpoint, fo, indent=5)
+    os.replace(f"{CHECKPOINT_FILE}.tmp", CHECKPOINT_FILE)
+
+
+def train_with_checkpoints(
+    words, counts, vocab_size, checkpoint_every=None, checkpoint_minutes=None, telemetry=None
+):
+    """
+    Train a BPE tokenizer on pretokenized word counts up to vocab_size in segments, saving merges.txt
+    in the cwd after each one. Each segment extends the merges.txt saved by the previous segment (the
+    same way stage 2 extends the inherited merges), so a run that is interrupted and restarted from
+    the last checkpoint should learn the same merges as an uninterrupted one (benchmark_checkpoints
+    checks this for the installed tokenizers). Segments are checkpoint_every merges long, or as many
+    merges as took about checkpoint_minutes in the previous segment.
+
+    The trainer cannot be paused, so every segment replays all word counts and reapplies the merges
+    learned so far before it merges, and checkpointing multiplies this cost by the number of
+    segments. Segments therefore grow geometrically once they are shorter than MIN_SEGMENT_GROWTH
+    of the merges learned so far (not counting inherited merges).
+    """
+    telemetry = telemetry or TrainingTelemetry()
+    num_merges_done = len(read_merges_txt("merges.txt")) if os.path.exists("merges.txt") else 0
+    if os.path.exists(CHECKPOINT_FILE):
+        checkpoint = read_json(CHECKPOINT_FILE)
+        current_vocab_size = checkpoint["vocab_size"]
+        num_initial_merges = checkpoint.get("num_initial_merges", 0)
+        print(f"Resuming from a checkpoint with {current_vocab_size} tokens", flush=True)
     else:
-        # Iterator-based training (for streaming datasets)
-        tokenizer.train_from_iterator(text_files, trainer)
+        # the trainer's alphabet is the symbols that occur in the words, plus one token per
+        # inherited merge
+        alphabet = set()
+        for word in words:
+            alphabet.update(word)
+        current_vocab_size = len(alphabet) + num_merges_done
+        num_initial_merges = num_merges_done
+    requested_segment = checkpoint_every or MIN_CHECKPOINT_MERGES
+    segment = max(
+        requested_segment, int(MIN_SEGMENT_GROWTH * (num_merges_done - num_initial_merges))
+    )
+
+    while True:
+        target = min(current_vocab_size + segment, vocab_size)
+        print(f"Training up to {target} tokens (checkpointing towards {vocab_size})", flush=True)
+        start_time = time.time()
+        tokenizer = Tokenizer(BPE())
+        tokenizer.pre_tokenizer = get_replay_pretokenizer()
+        trainer = BpeTrainer(show_progress=True, vocab_size=target)
+        with telemetry.phase("train"):
+            tokenizer.train_from_iterator(
+                replay_word_counts(words, counts), trainer, length=get_replay_length(words, counts)
+            )
+        elapsed = time.time() - start_time
+        with telemetry.phase("checkpoint"):
+            save_checkpoint(tokenizer, vocab_size, num_initial_merges)
+
+        num_merges = len(read_merges_txt("merges.txt")) - num_merges_done
+        num_merges_done += num_merges
+        current_vocab_size = tokenizer.get_vocab_size()
+        telemetry.record_segment(current_vocab_size, num_merges, elapsed)
+        if target >= vocab_size or num_merges <= 0:
+            break
+        if checkpoint_minutes:
+            merges_per_second = num_merges / max(elapsed, 1e-3)
+            requested_segment = max(
+                int(merges_per_second * checkpoint_minutes * 60), MIN_CHECKPOINT_MERGES
+            )
+            if checkpoint_every:
+                requested_segment = min(requested_segment, checkpoint_every)
+        segment = max(
+            requested_segment, int(MIN_SEGMENT_GROWTH * (num_merges_done - num_initial_merges))
+        )
 
+    os.remove(CHECKPOINT_FILE)
     return tokenizer
 
 
+def get_rss_bytes():
+    """Return the current resident set size of this process."""
+    with open("/proc/self/statm") as fin:
+        return int(fin.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def get_peak_rss_bytes():
+    """Return the peak resident set size of this process and of its (finished) child processes."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    return own, children
+
+
+class TrainingTelemetry:
+    """
+    Records wall time per phase, memory use and other statistics of a training run. If stream_path
+    is given, events are also appended to it as JSON lines while the run is going, along with a
+    sample of the memory use every sample_interval seconds.
+    """
+
+    def __init__(self, stream_path=None, sample_interval=30):
+        self.start_time = time.time()
+        self.stats = {"phases": {}, "segments": []}
+        self.stream = open(stream_path, "a") if stream_path else None
+        self.current_phase = None
+        self.stop_sampling = threading.Event()
+        if self.stream and sample_interval:
+            threading.Thread(target=self._sample, args=(sample_interval,), daemon=True).start()
+
+    def event(self, name, **fields):
+        if self.stream is None:
+            return
+        record = {
+            "event": name,
+            "time": round(time.time() - self.start_time, 3),
+            "phase": self.current_phase,
+            "rss_bytes": get_rss_bytes(),
+            **fields,
+        }
+        self.stream.write(json.dumps(record) + "\n")
+        self.stream.flush()
+
+    def _sample(self, interval):
+        while not self.stop_sampling.wait(interval):
+            self.event("sample")
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed block as phase name (times of repeated phases add up)."""
+        outer, self.current_phase = self.current_phase, name
+        self.event("phase_start")
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start_time
+            self.stats["phases"][name] = self.stats["phases"].get(name, 0) + elapsed
+            self.event("phase_end", seconds=round(elapsed, 3))
+            self.current_phase = outer
+
+    def add_phase_time(self, name, seconds):
+        """Add the time of a phase that was timed by the caller."""
+        self.stats["phases"][name] = self.stats["phases"].get(name, 0) + seconds
+        self.event("phase_end", phase=name, seconds=round(seconds, 3))
+
+    def record(self, **fields):
+        self.stats.update(fields)
+        self.event("record", **fields)
+
+    def record_segment(self, vocab_size, num_merges, seconds):
+        segment = {
+            "vocab_size": vocab_size,
+            "num_merges": num_merges,
+            "seconds": round(seconds, 3),
+            "merges_per_second": num_merges / max(seconds, 1e-3),
+        }
+        self.stats["segments"].append(segment)
+        self.event("segment", **segment)
+
+    def save(self, path):
+        """Write the statistics collected so far, with the total time and memory use, to path."""
+        peak_rss, peak_rss_children = get_peak_rss_bytes()
+        stats = {
+            **self.stats,
+            "total_seconds": time.time() - self.start_time,
+            "rss_bytes": get_rss_bytes(),
+            "peak_rss_bytes": peak_rss,
+            "peak_rss_children_bytes": peak_rss_children,
+        }
+        with open(path, "w") as fo:
+            json.dump(stats, fo, indent=5)
+
+    def close(self):
+        self.stop_sampling.set()
+        if self.stream is not None:
+            self.event("end")
+            self.stream.close()
+            self.stream = None
+
+
+# Set in each counting process by _init_word_count_worker: a function from a text to its words
+_pretokenize = None
+WORD_COUNT_BLOCK_SIZE = 2**24
+WORD_COUNT_BATCH_SIZE = 1000
+
+
+def _init_word_count_worker(fast_pretokenizer, do_whitespace_pretokenization, regex_string):
+    global _pretokenize
+    _pretokenize = fast_pretokenizer
+    if _pretokenize is None:
+        pretokenizer, _ = get_pretokenizer(do_whitespace_pretokenization, regex_string)
+        _pretokenize = lambda text: [word for word, _ in pretokenizer.pre_tokenize_str(text)]
+
+
+def _read_block_lines(file, start, end):
+    """Return the nonempty lines in bytes [start, end) of file, read like the trainer reads them."""
+    with open(file, "rb") as fin:
+        fin.seek(start)
+        text = fin.read(end - start).decode("utf-8")
+    # the trainer reads files line by line, keeping the line endings
+    lines = [line + "\n" for line in text.split("\n")]
+    lines[-1] = lines[-1][:-1]
+    return [line for line in lines if line]
+
+
+def _count_words_task(args):
+    """
+    Count the pretokens in a list of texts, or in bytes [start, end) of a file read line by line. A
+    file block may come with the packed bits of which of its lines to keep (see _dedup_line_blocks).
+    """
+    if isinstance(args, tuple):
+        texts = _read_block_lines(*args[:3])
+        if len(args) == 4:
+            keep = np.unpackbits(args[3], count=len(texts)).astype(bool)
+            texts = [text for text, k in zip(texts, keep.tolist()) if k]
+    else:
+        texts = args
+
+    counts = Counter()
+    for text in texts:
+        if text:
+            counts.update(_pretokenize(text))
+    return counts
+
+
+def _hash_lines_task(block):
+    """Hash the lines of a block of a file, and find which are the first of their repeats in it."""
+    digests, num_bytes = hash_texts(_read_block_lines(*block))
+    return digests, num_bytes, get_first_digests(digests)
+
+
+def get_line_blocks(file, block_size=WORD_COUNT_BLOCK_SIZE, start=0, end=None):
+    """
+    Split bytes [start, end) of file (the whole file by default) into (file, start, end) blocks of
+    about block_size bytes, ending after a newline.
+    """
+    blocks = []
+    end = os.path.getsize(file) if end is None else end
+    with open(file, "rb") as fin:
+        while start < end:
+            fin.seek(min(start + block_size, end))
+            fin.readline()
+            block_end = min(fin.tell(), end)
+            blocks.append((file, start, block_end))
+            start = block_end
+    return blocks
+
+
+def _iter_block_counts(text_files, do_whitespace_pretokenization, regex_string, num_workers):
+    """Yield the word counts of each block of text_files (see count_words), counted in parallel."""
+    if isinstance(text_files, str):
+        text_files = [text_files]
+    dedup_filter = None
+    if isinstance(text_files, DedupedLines):
+        text_files, dedup_filter = text_files.files, text_files.dedup_filter
+    if isinstance(text_files, list):
+        tasks = []
+        for file in text_files:
+            if isinstance(file, tuple):
+                file, start, end = file
+                tasks.extend(get_line_blocks(file, start=start, end=end))
+            else:
+                tasks.extend(get_line_blocks(file))
+    else:
+        texts = iter(text_files)
+        tasks = iter(lambda: list(islice(texts, WORD_COUNT_BATCH_SIZE)), [])
+
+    # the characters FastPretokenizer leaves to the regex are found once, here, and the workers are
+    # given the pretokenizer (inherited when forked) instead of each looking for them again
+    fast_pretokenizer = get_fast_pretokenizer(do_whitespace_pretokenization, regex_string)
+    with Pool(
+        num_workers,
+        initializer=_init_word_count_worker,
+        initargs=(fast_pretokenizer, do_whitespace_pretokenization, regex_string),
+    ) as pool:
+        if dedup_filter is not None:
+            tasks = _dedup_line_blocks(pool, tasks, dedup_filter)
+        yield from tqdm(pool.imap(_count_words_task, tasks), desc="Counting words")
+
+
+def _dedup_line_blocks(pool, blocks, dedup_filter):
+    """
+    Return the blocks with the packed bits of which of their lines dedup_filter has not seen before.
+    The lines are hashed in parallel, and only their digests are filtered here, in order, so that
+    the first occurrence of each line is kept as when reading the files in one go.
+    """
+    tasks = []
+    for block, (digests, num_bytes, is_first) in zip(
+        blocks,
+        tqdm(pool.imap(_hash_lines_task, blocks), total=len(blocks), desc="Deduplicating lines"),
+    ):
+        keep = dedup_filter.filter_digests(digests, num_bytes, is_first)
+        tasks.append((*block, np.packbits(keep)))
+    return tasks
+
+
+def count_words(
+    text_files: Union[str, List[str], Iterator[str]],
+    do_whitespace_pretokenization: bool = True,
+    regex_string: str = None,
+    num_workers: int = os.cpu_count(),
+) -> Counter:
+    """
+    Count the words (pretokens) the trainer would see in text_files (files, read line by line, or an
+    iterator of texts), in parallel. Files can also be given as (file, start, end) byte ranges, which
+    are read as if they were files of their own.
+    """
+    counts = Counter()
+    for block_counts in _iter_block_counts(
+        text_files, do_whitespace_pretokenization, regex_string, num_workers
+    ):
+        counts.update(block_counts)
+    return counts
+
+
+def _save_word_count_run(path, counts):
+    """Save counts sorted by word, one "word\tcount" per line (byte-level words have no whitespace)."""
+    with open(path, "w", encoding="utf-8") as fo:
+        for word, count in sorted(counts.items()):
+            fo.write(f"{word}\t{count}\n")
+
+
+def _read_word_count_run(path):
+    with open(path, encoding="utf-8") as fin:
+        for line in fin:
+            word, count = line.rstrip("\n").split("\t")
+            yield word, int(count)
+
+
+def merge_word_count_runs(runs):
+    """
+    Yield (word, count) in word order, summing the counts of each word over runs, iterables of
+    (word, count) sorted by word. Only one item of each run is in memory at a time.
+    """
+    runs = heapq.merge(*runs, key=lambda item: item[0])
+    for word, items in groupby(runs, key=lambda item: item[0]):
+        yield word, sum(count for _, count in items)
+
+
+def _get_min_count(count_histogram, max_unique_words):
+    """
+    Return the smallest count of the words to keep so that at most max_unique_words words are kept,
+    and how many of the words seen exactly that often fit in what is left of max_unique_words.
+    """
+    num_words = 0
+    for count in sorted(count_histogram, reverse=True):
+        if num_words + count_histogram[count] > max_unique_words:
+            return count, max_unique_words - num_words
+        num_words += count_histogram[count]
+    return 1, count_histogram[1]
+
+
+def prune_word_counts(items, min_count, num_tied=0):
+    """
+    Keep the words of items (word, count pairs in word order) seen more than min_count times, and
+    the first num_tied of those seen exactly min_count times, so that ties are broken the same way
+    whether or not the counts were spilled to disk.
+    """
+    counts = Counter()
+    for word, count in items:
+        if count > min_count:
+            counts[word] = count
+        elif count == min_count and num_tied > 0:
+            counts[word] = count
+            num_tied -= 1
+    return counts
+
+
+def count_words_bounded(
+    text_files: Union[str, List[str], Iterator[str]],
+    do_whitespace_pretokenization: bool = True,
+    regex_string: str = None,
+    max_unique_words: int = 10**7,
+    num_workers: int = os.cpu_count(),
+    spill_dir: str = None,
+):
+    """
+    Count words like count_words, keeping at most max_unique_words of them in memory. When the
+    table is full, it is written to disk as a run sorted by word and emptied, and at the end the
+    runs are merged. If there are more than max_unique_words words in total, the rarest are dropped:
+    singletons first, then words seen twice, and so on, until the rest fits. Of the words seen as
+    often as the rarest words that are kept, the first in word order are kept until exactly
+    max_unique_words remain. The counts of the words that are kept are exact.
+
+    Returns the counts of the words that are kept, and statistics on what was dropped.
+    """
+    spill_dir = spill_dir or get_cache_dir() / "spill"
+    ensure_dir(spill_dir)
+    run_dir = Path(tempfile.mkdtemp(prefix="word_counts_", dir=spill_dir))
+    run_paths = []
+    counts = Counter()
+    try:
+        for block_counts in _iter_block_counts(
+            text_files, do_whitespace_pretokenization, regex_string, num_workers
+        ):
+            counts.update(block_counts)
+            if len(counts) > max_unique_words:
+                run_paths.append(run_dir / f"run-{len(run_paths):05d}.tsv")
+                _save_word_count_run(run_paths[-1], counts)
+                counts = Counter()
+
+        if run_paths:
+            if counts:
+                run_paths.append(run_dir / f"run-{len(run_paths):05d}.tsv")
+                _save_word_count_run(run_paths[-1], counts)
+                counts = Counter()
+            # the first pass finds the count threshold, the second keeps the words above it
+            runs = [_read_word_count_run(path) for path in run_paths]
+            count_histogram = Counter(count for _, count in merge_word_count_runs(runs))
+            min_count, num_tied = _get_min_count(count_histogram, max_unique_words)
+            runs = [_read_word_count_run(path) for path in run_paths]
+            counts = prune_word_counts(merge_word_count_runs(runs), min_count, num_tied)
+        else:
+            count_histogram = Counter(counts.values())
+            min_count, num_tied = _get_min_count(count_histogram, max_unique_words)
+            if len(counts) > max_unique_words:
+                counts = prune_word_counts(sorted(counts.items()), min_count, num_tied)
+    finally:
+        shutil.rmtree(run_dir)
+
+    num_words = sum(count * n for count, n in count_histogram.items())
+    num_kept_words = sum(counts.values())
+    stats = {
+        "max_unique_words": max_unique_words,
+        "num_spilled_runs": len(run_paths),
+        "min_count": min_count,
+        "num_unique_words_before_pruning": sum(count_histogram.values()),
+        "num_pruned_unique_words": sum(count_histogram.values()) - len(counts),
+        "num_pruned_words": num_words - num_kept_words,
+        "pruned_word_fraction": (num_words - num_kept_words) / max(num_words, 1),
+    }
+    print(
+        f"Kept {len(counts):,} of {stats['num_unique_words_before_pruning']:,} words (seen at "
+        f"least {min_count} times), dropping {stats['pruned_word_fraction']:.2%} of all words",
+        flush=True,
+    )
+    return counts, stats
+
+
+def save_word_counts(path, counts):
+    """
+    Save word counts (a Counter, or an iterable of (word, count) pairs, which is consumed without
+    building a table) as a blob of UTF-8 words, their end offsets and their counts.
+    """
+    blob, ends, values = bytearray(), array("Q"), array("Q")
+    for word, count in counts.items() if isinstance(counts, dict) else counts:
+        blob += word.encode("utf-8")
+        ends.append(len(blob))
+        values.append(count)
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(
+        tmp_path,
+        words=np.frombuffer(blob, dtype=np.uint8),
+        ends=np.frombuffer(ends, dtype=np.uint64),
+        counts=np.frombuffer(values, dtype=np.uint64),
+    )
+    os.replace(tmp_path, path)
+
+
+def load_word_counts(path):
+    """Return the words and counts saved by save_word_counts."""
+    data = np.load(path)
+    blob = data["words"].tobytes()
+    starts = [0] + data["ends"][:-1].tolist()
+    words = [blob[start:end].decode("utf-8") for start, end in zip(starts, data["ends"].tolist())]
+    return words, data["counts"]
+
+
+def iter_word_counts(path, chunk_size=2**16):
+    """
+    Yield the (word, count) pairs saved by save_word_counts, keeping only the packed arrays and one
+    chunk of chunk_size words decoded in memory.
+    """
+    data = np.load(path)
+    blob, ends, counts = data["words"], data["ends"], data["counts"]
+    for i in range(0, len(ends), chunk_size):
+        start = int(ends[i - 1]) if i else 0
+        chunk_ends = (ends[i : i + chunk_size] - start).tolist()
+        chunk = blob[start : start + chunk_ends[-1]].tobytes()
+        for word_start, word_end, count in zip(
+            [0] + chunk_ends[:-1], chunk_ends, counts[i : i + chunk_size].tolist()
+        ):
+            yield chunk[word_start:word_end].decode("utf-8"), count
+
+
+def get_word_counts_path(
+    data_key, do_whitespace_pretokenization=True, regex_string=None, max_unique_words=None
+):
+    """Where get_word_counts caches the word counts of data_key with this pretokenization."""
+    key = {
+        "data_key": data_key,
+        "do_whitespace_pretokenization": do_whitespace_pretokenization,
+        "regex_string": regex_string,
+    }
+    if max_unique_words:
+        key["max_unique_words"] = max_unique_words
+    key_hash = hashlib.sha256(json.dumps(key).encode()).hexdigest()
+    return get_cache_dir() / "word_counts" / f"{key_hash[:16]}.npz"
+
+
+def get_word_counts(
+    text_files,
+    data_key,
+    do_whitespace_pretokenization=True,
+    regex_string=None,
+    num_workers=os.cpu_count(),
+    max_unique_words=None,
+    telemetry=None,
+):
+    """
+    Return the words and counts of text_files, cached in $SUPERBPE_CACHE_DIR/word_counts by data_key
+    and the pretokenizer configuration. The counts only depend on the data and the pretokenizer (not
+    on the merges we start from), so e.g. all transition points of a stage 2 sweep share them.
+
+    If max_unique_words is given, the words are counted with count_words_bounded, and the statistics
+    of the pruned words are saved next to the counts and recorded in telemetry, if given.
+    """
+    path = get_word_counts_path(data_key, do_whitespace_pretokenization, regex_string, max_unique_words)
+    stats_path = path.with_suffix(".json")
+    if os.path.exists(path):
+        print(f"Loading cached word counts from {path}", flush=True)
+        if max_unique_words and telemetry is not None:
+            telemetry.record(pruning=read_json(stats_path))
+        return load_word_counts(path)
+
+    if max_unique_words:
+        counts, stats = count_words_bounded(
+            text_files, do_whitespace_pretokenization, regex_string, max_unique_words, num_workers
+        )
+        if telemetry is not None:
+            telemetry.record(pruning=stats)
+    else:
+        counts = count_words(text_files, do_whitespace_pretokenization, regex_string, num_workers)
+    ensure_dir(path.parent)
+    if max_unique_words:
+        # written first, since the counts mark the cache entry as complete
+        with open(stats_path, "w") as fo:
+            json.dump(stats, fo, indent=5)
+    save_word_counts(path, counts)
+    print(f"Saved {len(counts):,} word counts to {path}", flush=True)
+    return list(counts), np.fromiter(counts.values(), dtype=np.uint64, count=len(counts))
+
+
+# Byte-level words never contain a space (it is written "Ġ"), so repeated words can be joined with
+# spaces and split again by the trainer
+REPLAY_SEPARATOR = " "
+REPLAY_CHUNK_CHARS = 2**20
+
+
+def get_replay_pretokenizer():
+    """The pretokenizer of a tokenizer trained on the output of replay_word_counts."""
+    return Split(REPLAY_SEPARATOR, behavior="removed")
+
+
+def replay_word_counts(words, counts, chunk_chars=REPLAY_CHUNK_CHARS):
+    """
+    Yield texts of about chunk_chars characters in which each word occurs as many times as it was
+    counted, separated by spaces, to train a tokenizer with get_replay_pretokenizer. The trainer
+    cannot take counts, so it still counts every occurrence (the work is proportional to the number
+    of pretokens, not of unique words), but it splits and counts them in Rust, so one string per
+    chunk crosses into the trainer instead of one per occurrence. Only the regex pretokenization of
+    the data is saved.
+    """
+    chunk, chunk_size = [], 0
+    for word, count in zip(words, counts.tolist()):
+        word += REPLAY_SEPARATOR
+        while count > 0:
+            n = min(count, max((chunk_chars - chunk_size) // len(word), 1))
+            chunk.append(word * n)
+            chunk_size += n * len(word)
+            count -= n
+            if chunk_size >= chunk_chars:
+                yield "".join(chunk)
+                chunk, chunk_size = [], 0
+    if chunk:
+        yield "".join(chunk)
+
+
+def get_replay_length(words, counts, chunk_chars=REPLAY_CHUNK_CHARS):
+    """The approximate number of texts replay_word_counts yields, for the progress bar."""
+    word_chars = np.fromiter(map(len, words), dtype=np.int64, count=len(words)) + 1
+    return int(word_chars @ counts.astype(np.int64)) // chunk_chars + 1
+
+
+DEDUP_CAPACITY = 10**8
+DEDUP_FALSE_POSITIVE_RATE = 1e-3
+DEDUP_BATCH_SIZE = 10000
+# assumed average size of a document when sizing a DedupFilter from the number of bytes of a dataset
+DEDUP_DOCUMENT_BYTES = 256
+
+
+def hash_texts(texts):
+    """Return the 128-bit BLAKE2b digests of texts (as pairs of uint64) and their sizes in bytes."""
+    data = [text.encode("utf-8") for text in texts]
+    digests = np.frombuffer(
+        b"".join(hashlib.blake2b(d, digest_size=16).digest() for d in data), dtype=np.uint64
+    ).reshape(-1, 2)
+    return digests, np.array([len(d) for d in data], dtype=np.int64)
+
+
+def get_first_digests(digests):
+    """Return whether each of digests is the first of the equal digests."""
+    # lexsort is stable, so the first of each run of equal sorted digests comes first in digests
+    order = np.lexsort((digests[:, 1], digests[:, 0]))
+    sorted_digests = digests[order]
+    is_new = np.ones(len(digests), dtype=bool)
+    is_new[1:] = np.any(sorted_digests[1:] != sorted_digests[:-1], axis=1)
+    is_first = np.zeros(len(digests), dtype=bool)
+    is_first[order[is_new]] = True
+    return is_first
+
+
+class DedupFilter:
+    """
+    Bloom filter over the texts seen so far, for dropping exact repeats from a stream of texts. It is
+    sized for capacity unique texts at false_positive_rate (about 1.8 GB per billion texts at 0.1%).
+    A false positive drops a text that was not seen before, so a small fraction of unique texts may be
+    dropped, but a repeat is never kept.
+    """
+
+    def __init__(self, capacity=DEDUP_CAPACITY, false_positive_rate=DEDUP_FALSE_POSITIVE_RATE):
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        self.num_bits = max(int(-capacity * math.log(false_positive_rate) / math.log(2) ** 2), 64)
+        self.num_hashes = max(round(self.num_bits / capacity * math.log(2)), 1)
+        self.bits = np.zeros((self.num_bits + 63) // 64, dtype=np.uint64)
+        self.num_texts = 0
+        self.num_dropped = 0
+        self.num_bytes = 0
+        self.num_dropped_bytes = 0
+
+    def filter(self, texts):
+        """Return the texts that were not seen before (in this batch or earlier), in order."""
+        if not texts:
+            return []
+        keep = self.filter_digests(*hash_texts(texts))
+        return [text for text, k in zip(texts, keep.tolist()) if k]
+
+    def filter_digests(self, digests, num_bytes, is_first=None):
+        """
+        Like filter, for texts already hashed with hash_texts (e.g. in other processes): return
+        whether each text was not seen before. is_first (see get_first_digests) may also have been
+        found elsewhere.
+        """
+        if not len(digests):
+            return np.zeros(0, dtype=bool)
+        if is_first is None:
+            is_first = get_first_digests(digests)
+
+        # double hashing: the i-th bit of a text is h1 + i * h2 (mod num_bits)
+        steps = np.arange(self.num_hashes, dtype=np.uint64)
+        positions = (digests[:, :1] + steps * (digests[:, 1:] | np.uint64(1))) % np.uint64(self.num_bits)
+        words, offsets = positions >> np.uint64(6), positions & np.uint64(63)
+        seen = np.all((self.bits[words] >> offsets) & np.uint64(1), axis=1)
+        keep = is_first & ~seen
+        # set the bits with fancy indexing, which keeps only one of the bits that fall in the same
+        # word, so repeat for the bits that were lost (much faster than np.bitwise_or.at)
+        words, masks = words[keep].ravel(), np.uint64(1) << offsets[keep].ravel()
+        while len(words):
+            self.bits[words] |= masks
+            is_unset = (self.bits[words] & masks) == 0
+            words, masks = words[is_unset], masks[is_unset]
+
+        self.num_texts += len(digests)
+        self.num_dropped += int((~keep).sum())
+        self.num_bytes += int(num_bytes.sum())
+        self.num_dropped_bytes += int(num_bytes[~keep].sum())
+        return keep
+
+    def stats(self):
+        num_unique = self.num_texts - self.num_dropped
+        if num_unique > self.capacity:
+            print(
+                f"Warning: {num_unique:,} unique texts exceed the dedup capacity of "
+                f"{self.capacity:,}, so more unique texts were dropped as false positives",
+                flush=True,
+            )
+        return {
+            "capacity": self.capacity,
+            "false_positive_rate": self.false_positive_rate,
+            "num_texts": self.num_texts,
+            "num_dropped": self.num_dropped,
+            "num_bytes": self.num_bytes,
+            "num_dropped_bytes": self.num_dropped_bytes,
+            "dropped_byte_fraction": self.num_dropped_bytes / max(self.num_bytes, 1),
+        }
+
+
+def get_dedup_capacity(num_texts=None, num_bytes=None):
+    """
+    Return the capacity to size a DedupFilter for: num_texts if the number of texts is known, one
+    per DEDUP_DOCUMENT_BYTES of num_bytes if only the size of the data is known, and DEDUP_CAPACITY
+    if neither is.
+    """
+    if num_texts is not None:
+        return max(num_texts, 1)
+    if num_bytes:
+        return max(num_bytes // DEDUP_DOCUMENT_BYTES, 1)
+    return DEDUP_CAPACITY
+
+
+def hash_file(file):
+    """Return the digest and size of the contents of file, like hash_texts does for its text."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file, "rb") as fin:
+        for block in iter(lambda: fin.read(2**24), b""):
+            digest.update(block)
+    return np.frombuffer(digest.digest(), dtype=np.uint64), os.path.getsize(file)
+
+
+def dedup_files(files: List[str], dedup_filter: DedupFilter, pool=None):
+    """
+    Return the files whose contents dedup_filter has not seen before, in order. The files are hashed
+    with pool, if given.
+    """
+    hashes = list((pool.imap if pool is not None else map)(hash_file, files))
+    if not hashes:
+        return []
+    digests = np.stack([digest for digest, _ in hashes])
+    keep = dedup_filter.filter_digests(digests, np.array([size for _, size in hashes], dtype=np.int64))
+    return [file for file, k in zip(files, keep.tolist()) if k]
+
+
+def dedup_texts(texts: Iterator[str], dedup_filter: DedupFilter, batch_size=DEDUP_BATCH_SIZE):
+    """Yield the texts that dedup_filter has not seen before."""
+    texts = iter(texts)
+    for batch in iter(lambda: list(islice(texts, batch_size)), []):
+        yield from dedup_filter.filter(batch)
+
+
+def iter_file_lines(files: List[str]):
+    """Yield the lines of files the way the trainer reads them (split on "\n", keeping it)."""
+    for file in files:
+        with open(file, "rb") as fin:
+            for line in fin:
+                yield line.decode("utf-8")
+
+
+def count_lines(files: List[str]):
+    """Return the number of lines of files, as iter_file_lines reads them."""
+    num_lines = 0
+    for file in files:
+        last = b"\n"
+        with open(file, "rb") as fin:
+            for block in iter(lambda: fin.read(2**24), b""):
+                num_lines += block.count(b"\n")
+                last = block[-1:]
+        num_lines += last != b"\n"
+    return num_lines
+
+
+class DedupedLines:
+    """
+    The lines of files (read the way the trainer reads them) that dedup_filter has not seen before,
+    in order. Iterating over them reads and hashes the files in this process, but count_words and
+    count_words_bounded hash the lines in parallel and only filter their digests in this process
+    (see _iter_block_counts).
+    """
+
+    def __init__(self, files: List[str], dedup_filter: DedupFilter):
+        self.files = files
+        self.dedup_filter = dedup_filter
+
+    def __iter__(self):
+        return dedup_texts(iter_file_lines(self.files), self.dedup_filter)
+
+
+def load_tokenizer(path, do_whitespace_pretokenization=None):
+    """
+    Load a tokenizer from a tokenizer.json file, or from a directory compiled by compile_tokenizer,
+    with a tokenizer.json or with a vocab.json and merges.txt (like those in tokenizer_json/). In the
+    latter case we add the pretokenizer used in training, which has whitespace pretokenization for
+    stage 1 ("pretok") tokenizers and not for SuperBPE ones, unless do_whitespace_pretokenization
+    says otherwise.
+    """
+    path = Path(path)
+    if path.is_file():
+        return Tokenizer.from_file(str(path))
+    if is_compiled_tokenizer(path):
+        return load_compiled_tokenizer(path)
+    if (path / "tokenizer.json").exists():
+        return Tokenizer.from_file(str(path / "tokenizer.json"))
+
+    if do_whitespace_pretokenization is None:
+        do_whitespace_pretokenization = "_pretok_" in path.name
+    tokenizer = Tokenizer(BPE.from_file(str(path / "vocab.json"), str(path / "merges.txt")))
+    tokenizer.pre_tokenizer, _ = get_pretokenizer(do_whitespace_pretokenization)
+    tokenizer.decoder = decoders.ByteLevel()
+    return tokenizer
+
+
+COMPILED_HEADER_FILE = "compiled.json"
+
+
+def is_compiled_tokenizer(path):
+    return (Path(path) / COMPILED_HEADER_FILE).exists()
+
+
+def compile_tokenizer(tokenizer_path, output_dir):
+    """
+    Compile a BPE tokenizer.json into a directory that loads in milliseconds: compiled.json has the
+    tokenizer.json without the vocab and merges, which are stored as packed arrays instead.
+        tokens.npy: the UTF-8 bytes of every token, in order of id
+        token_ends.npy: the end offset (in characters) of each token in the decoded tokens.npy
+        token_bytes.npy: the bytes each token decodes to, in order of id
+        token_byte_ends.npy: the end offset of each token in token_bytes.npy
+        merges.npy: the (left, right) token ids of each merge, in order of rank
+        merge_ids.npy: the token id each merge produces, in order of rank
+        pair_keys.npy: left << 32 | right of each merge, sorted, for looking up merges by pair
+        pair_ranks.npy: the rank of the merge of each pair in pair_keys.npy
+        sorted_token_ids.npy: the token ids in order of token, for looking up tokens by string
+    The arrays are memory-mapped when loading, so processes on the same machine share them.
+    """
+    tokenizer_json = read_json(tokenizer_path)
+    model = tokenizer_json["model"]
+    if model["type"] != "BPE":
+        raise ValueError(f"Tokenizer type {model['type']} not supported for compiling")
+
+    vocab = model["vocab"]
+    tokens = sorted(vocab, key=vocab.get)
+    if [vocab[t] for t in tokens] != list(range(len(tokens))):
+        raise ValueError(f"Token ids in {tokenizer_path} are not 0, ..., {len(tokens) - 1}")
+    merges = [m.split(" ") if isinstance(m, str) else m for m in model["merges"]]
+    try:
+        merge_ids = [vocab[left + right] for left, right in merges]
+    except KeyError as e:
+        raise ValueError(f"Merge result {e} is not in the vocabulary of {tokenizer_path}")
+    merge_pairs = np.array(
+        [(vocab[left], vocab[right]) for left, right in merges], dtype=np.uint32
+    ).reshape(-1, 2)
+
+    # like tokenizers, a pair that is merged more than once keeps the rank of its last merge
+    keys = merge_pairs[:, 0].astype(np.uint64) << np.uint64(32) | merge_pairs[:, 1]
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    is_last = np.append(sorted_keys[1:] != sorted_keys[:-1], True)
+
+    byte_decoder = {c: b for b, c in bytes_to_unicode().items()}
+    token_bytes = [
+        token.encode("utf-8") if any(c not in byte_decoder for c in token)
+        else bytes(byte_decoder[c] for c in token)
+        for token in tokens
+    ]
+
+    output_dir = Path(output_dir)
+    ensure_dir(output_dir)
+    np.save(output_dir / "tokens.npy", np.frombuffer("".join(tokens).encode("utf-8"), dtype=np.uint8))
+    np.save(output_dir / "token_ends.npy", np.cumsum([len(t) for t in tokens], dtype=np.int64))
+    np.save(output_dir / "token_bytes.npy", np.frombuffer(b"".join(token_bytes), dtype=np.uint8))
+    np.save(
+        output_dir / "token_byte_ends.npy", np.cumsum([len(b) for b in token_bytes], dtype=np.int64)
+    )
+    np.save(output_dir / "merges.npy", merge_pairs)
+    np.save(output_dir / "merge_ids.npy", np.array(merge_ids, dtype=np.uint32))
+    np.save(output_dir / "pair_keys.npy", sorted_keys[is_last])
+    np.save(output_dir / "pair_ranks.npy", order[is_last].astype(np.uint32))
+    np.save(
+        output_dir / "sorted_token_ids.npy",
+        np.array(sorted(range(len(tokens)), key=tokens.__getitem__), dtype=np.uint32),
+    )
+
+    unicode_bytes = bytes_to_unicode()
+    header = dict(tokenizer_json)
+    header["model"] = {**model, "vocab": {}, "merges": []}
+    header["compiled"] = {
+        "num_tokens": len(tokens),
+        "num_merges": len(merges),
+        "byte_ids": [vocab.get(unicode_bytes[b], -1) for b in range(256)],
+    }
+    # written last, so a directory with compiled.json is always complete
+    with open(output_dir / COMPILED_HEADER_FILE, "w") as fout:
+        fout.write(json.dumps(header))
+    return output_dir
+
+
+def read_compiled_tokenizer(path, num_merges=None):
+    """
+    Return the header, tokens (in order of id) and merge ids (in order of rank) of a tokenizer
+    compiled by compile_tokenizer, with only the top num_merges merges if given.
+    """
+    path = Path(path)
+    header = read_json(path / COMPILED_HEADER_FILE)
+    text = np.load(path / "tokens.npy", mmap_mode="r").tobytes().decode("utf-8")
+    ends = np.load(path / "token_ends.npy", mmap_mode="r").tolist()
+    tokens = [text[start:end] for start, end in zip([0] + ends[:-1], ends)]
+    merges = np.load(path / "merges.npy", mmap_mode="r")[:num_merges]
+    return header, tokens, merges
+
+
+def load_compiled_tokenizer(path, num_merges=None):
+    """
+    Load a tokenizer compiled by compile_tokenizer as a tokenizers Tokenizer, building its BPE model
+    from the packed arrays. If num_merges is given, only the top num_merges merges are used (and
+    ignore_merges is turned off, as for truncated tokenizers in encode.py). This takes a few tenths
+    of a second for a 200K vocabulary, most of it in tokenizers itself; CompiledTokenizer loads in
+    milliseconds.
+    """
+    # building the merge pairs allocates many small objects that never need collecting
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        header, tokens, merges = read_compiled_tokenizer(path, num_merges)
+        merges = [(tokens[left], tokens[right]) for left, right in merges.tolist()]
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    model = header.pop("model")
+    header.pop("compiled")
+    # added tokens are added after the model, since their ids depend on its vocab
+    added_tokens = header.pop("added_tokens", None) or []
+    tokenizer = Tokenizer.from_str(json.dumps({**header, "model": {**model, "vocab": {}, "merges": []}}))
+
+    params = {
+        k: v for k, v in model.items() if k not in ["type", "vocab", "merges"] and v is not None
+    }
+    if num_merges is not None:
+        params["ignore_merges"] = False
+    tokenizer.model = BPE(dict(zip(tokens, range(len(tokens)))), merges, **params)
+
+    for token in sorted(added_tokens, key=lambda t: t["id"]):
+        add = tokenizer.add_special_tokens if token["special"] else tokenizer.add_tokens
+        add([tokenizers.AddedToken(**{k: v for k, v in token.items() if k != "id"})])
+    added_ids = {i: t.content for i, t in tokenizer.get_added_tokens_decoder().items()}
+    if added_ids != {t["id"]: t["content"] for t in added_tokens}:
+        raise ValueError(f"Added tokens of {path} do not have consecutive ids after the vocab")
+    return tokenizer
+
+
+class CompiledTokenizer:
+    """
+    Encode and decode with a tokenizer compiled by compile_tokenizer directly from its memory-mapped
+    arrays, without building the tokenizers model, so loading takes milliseconds. Encoding gives the
+    same ids as the original tokenizer (compile_tokenizer.py checks this), but the merges are applied
+    in Python, so this is for loading quickly in short jobs; for encoding a corpus, use
+    load_compiled_tokenizer. Only byte-level BPE tokenizers without dropout, an unknown token or
+    subword affixes are supported.
+    """
+
+    CACHE_SIZE = 100_000
+
+    def __init__(self, path):
+        self.path = Path(path)
+        header = read_json(self.path / COMPILED_HEADER_FILE)
+        model = header["model"]
+        for key in ["dropout", "unk_token", "continuing_subword_prefix", "end_of_word_suffix"]:
+            if model.get(key) is not None:
+                raise ValueError(f"{key} is not supported by CompiledTokenizer, use load_compiled_tokenizer")
+        if model.get("byte_fallback"):
+            raise ValueError("byte_fallback is not supported by CompiledTokenizer, use load_compiled_tokenizer")
+        pre_tokenizer = header.get("pre_tokenizer") or {}
+        if pre_tokenizer.get("type") == "Sequence":
+            pre_tokenizer = pre_tokenizer["pretokenizers"][-1]
+        if pre_tokenizer.get("type") != "ByteLevel":
+            raise ValueError("CompiledTokenizer needs a ByteLevel pretokenizer, use load_compiled_tokenizer")
+        if (header.get("decoder") or {}).get("type") != "ByteLevel":
+            raise ValueError("CompiledTokenizer needs a ByteLevel decoder, use load_compiled_tokenizer")
+        if (header.get("post_processor") or {"type": "ByteLevel"})["type"] != "ByteLevel":
+            raise ValueError("CompiledTokenizer only supports ByteLevel post processors")
+        if header.get("truncation") or header.get("padding"):
+            raise ValueError("Truncation and padding are not supported by CompiledTokenizer")
+        added_tokens = header.get("added_tokens") or []
+        for token in added_tokens:
+            if token["single_word"] or token["lstrip"] or token["rstrip"] or (
+                token["normalized"] and header.get("normalizer") is not None
+            ):
+                raise ValueError(f"Added token {token['content']} is not supported by CompiledTokenizer")
+
+        self.ignore_merges = model.get("ignore_merges", False)
+        self.num_tokens = header["compiled"]["num_tokens"]
+        self.char_ids = {c: header["compiled"]["byte_ids"][b] for b, c in bytes_to_unicode().items()}
+        self.arrays = {
+            name: np.load(self.path / f"{name}.npy", mmap_mode="r")
+            for name in [
+                "tokens", "token_ends", "token_bytes", "token_byte_ends", "merge_ids", "pair_keys",
+                "pair_ranks", "sorted_token_ids",
+            ]
+        }
+        # the normalizer and pretokenizer come from a tokenizer with an empty model, which is cheap
+        header.pop("compiled")
+        self.shell = Tokenizer.from_str(json.dumps({**header, "model": {**model, "vocab": {}, "merges": []}}))
+        self.added_tokens = {t["content"]: t["id"] for t in added_tokens}
+        self.special_ids = {t["id"] for t in added_tokens if t["special"]}
+        self.added_token_bytes = {t["id"]: self._decode_token(t["content"]) for t in added_tokens}
+        # longest first, so the alternation matches the longest added token at each position
+        self.added_pattern = re.compile(
+            "(" + "|".join(re.escape(t) for t in sorted(self.added_tokens, key=len, reverse=True)) + ")"
+        ) if added_tokens else None
+        self.pair_cache = {}
+        self.word_cache = {}
+        self.token_text = None
+
+    def get_vocab_size(self):
+        return max([self.num_tokens - 1, *self.added_tokens.values()]) + 1
+
+    @staticmethod
+    def _decode_token(token):
+        byte_decoder = {c: b for b, c in bytes_to_unicode().items()}
+        if any(c not in byte_decoder for c in token):
+            return token.encode("utf-8")
+        return bytes(byte_decoder[c] for c in token)
+
+    def token_to_id(self, token):
+        """
+        Return the id of token, looked up with a binary search over the sorted tokens.
+        """
+        if token in self.added_tokens:
+            return self.added_tokens[token]
+        if self.token_text is None:
+            self.token_text = self.arrays["tokens"].tobytes().decode("utf-8")
+            self.token_starts = np.concatenate([[0], self.arrays["token_ends"][:-1]])
+        ends, sorted_ids = self.arrays["token_ends"], self.arrays["sorted_token_ids"]
+
+        def get_token(i):
+            token_id = sorted_ids[i]
+            return self.token_text[self.token_starts[token_id]:ends[token_id]]
+
+        lo, hi = 0, self.num_tokens
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if get_token(mid) < token:
+                lo = mid + 1
+            else:
+                hi = mid
+        return int(sorted_ids[lo]) if lo < self.num_tokens and get_token(lo) == token else None
+
+    def _get_merge(self, left, right):
+        """
+        Return the (rank, id) of the merge of the pair (left, right), or None if there is none.
+        """
+        key = (left, right)
+        if key not in self.pair_cache:
+            pair_keys = self.arrays["pair_keys"]
+            packed = np.uint64(left << 32 | right)
+            i = int(pair_keys.searchsorted(packed))
+            if i < len(pair_keys) and pair_keys[i] == packed:
+                rank = int(self.arrays["pair_ranks"][i])
+                self.pair_cache[key] = (rank, int(self.arrays["merge_ids"][rank]))
+            else:
+                self.pair_cache[key] = None
+        return self.pair_cache[key]
+
+    def _encode_word(self, word):
+        """
+        Apply the merges to a byte-level pretoken in the same order as tokenizers does: repeatedly
+        merge the pair with the lowest rank, leftmost first.
+        """
+        if self.ignore_merges:
+            token_id = self.token_to_id(word)
+            if token_id is not None:
+                return [token_id]
+        ids = [self.char_ids[c] for c in word]
+        ids = [i for i in ids if i >= 0]
+        if len(ids) < 2:
+            return ids
+
+        # find the merges of the initial pairs with a single search
+        pair_keys = self.arrays["pair_keys"]
+        array = np.array(ids, dtype=np.uint64)
+        keys = array[:-1] << np.uint64(32) | array[1:]
+        positions = np.minimum(pair_keys.searchsorted(keys), len(pair_keys) - 1)
+        found = np.flatnonzero(pair_keys[positions] == keys)
+        ranks = self.arrays["pair_ranks"][positions[found]]
+        merge_ids = self.arrays["merge_ids"][ranks]
+        queue = list(zip(ranks.tolist(), found.tolist(), merge_ids.tolist()))
+        heapq.heapify(queue)
+
+        n = len(ids)
+        prev = list(range(-1, n - 1))
+        next = list(range(1, n)) + [-1]
+        removed = [False] * n
+        while queue:
+            _, pos, new_id = heapq.heappop(queue)
+            right = next[pos]
+            if removed[pos] or right == -1:
+                continue
+            # skip entries whose pair has changed since they were queued
+            merge = self._get_merge(ids[pos], ids[right])
+            if merge is None or merge[1] != new_id:
+                continue
+            ids[pos] = new_id
+            removed[right] = True
+            next[pos] = next[right]
+            if next[right] != -1:
+                prev[next[right]] = pos
+            if prev[pos] >= 0:
+                merge = self._get_merge(ids[prev[pos]], new_id)
+                if merge is not None:
+                    heapq.heappush(queue, (merge[0], prev[pos], merge[1]))
+            if next[pos] != -1:
+                merge = self._get_merge(new_id, ids[next[pos]])
+                if merge is not None:
+                    heapq.heappush(queue, (merge[0], pos, merge[1]))
+        return [token_id for token_id, r in zip(ids, removed) if not r]
+
+    def _encode_text(self, text):
+        if self.shell.normalizer is not None:
+            text = self.shell.normalizer.normalize_str(text)
+        ids = []
+        for word, _ in self.shell.pre_tokenizer.pre_tokenize_str(text):
+            if word not in self.word_cache:
+                if len(self.word_cache) >= self.CACHE_SIZE:
+                    self.word_cache.clear()
+                self.word_cache[word] = self._encode_word(word)
+            ids.extend(self.word_cache[word])
+        return ids
+
+    def encode(self, text):
+        """
+        Return the token ids of text.
+        """
+        if self.added_pattern is None:
+            return self._encode_text(text)
+        ids = []
+        for i, part in enumerate(self.added_pattern.split(text)):
+            if i % 2:
+                ids.append(self.added_tokens[part])
+            elif part:
+                ids.extend(self._encode_text(part))
+        return ids
+
+    def encode_batch(self, texts):
+        return [self.encode(text) for text in texts]
+
+    def decode(self, ids, skip_special_tokens=True):
+        """
+        Return the text of ids, replacing invalid UTF-8 as the ByteLevel decoder does.
+        """
+        data, ends = self.arrays["token_bytes"], self.arrays["token_byte_ends"]
+        parts = []
+        for token_id in ids:
+            if token_id in self.added_token_bytes:
+                if not (skip_special_tokens and token_id in self.special_ids):
+                    parts.append(self.added_token_bytes[token_id])
+            else:
+                start = ends[token_id - 1] if token_id else 0
+                parts.append(data[start:ends[token_id]].tobytes())
+        return b"".join(parts).decode("utf-8", errors="replace")
+
+    def to_tokenizer(self, num_merges=None):
+        """
+        Return the tokenizers Tokenizer (see load_compiled_tokenizer).
+        """
+        return load_compiled_tokenizer(self.path, num_merges)
+
+
 def bytes_to_unicode():
     """
     MJ: STOLEN DIRECTLY FROM https://github.com/openai/gpt-2/blob/master/src/encoder.py#L9
@@ -123,17 +1525,293 @@ def bytes_to_unicode():
     return dict(zip(bs, cs))
 
 
-def is_valid_unicode(data):
-    try:
-        data.decode("utf-8")
-        return True
-    except UnicodeDecodeError:
-        return False
+def get_token_metrics(tokenizer):
+    """
+    Return the number of bytes of each token id, and whether each token is a superword, i.e. spans
+    more than one pretoken under whitespace pretokenization (so it can only be learned in stage 2).
+    """
+    byte_decoder = {c: b for b, c in bytes_to_unicode().items()}
+    pretokenizer, _ = get_pretokenizer(do_whitespace_pretokenization=True)
+    added_tokens = {i: t.content for i, t in tokenizer.get_added_tokens_decoder().items()}
+
+    vocab_size = tokenizer.get_vocab_size()
+    token_bytes = np.zeros(vocab_size, dtype=np.int32)
+    is_superword = np.zeros(vocab_size, dtype=bool)
+    for token, token_id in tokenizer.get_vocab().items():
+        if token_id in added_tokens or any(c not in byte_decoder for c in token):
+            token_bytes[token_id] = len(token.encode("utf-8"))
+            continue
+        data = bytes(byte_decoder[c] for c in token)
+        token_bytes[token_id] = len(data)
+        # drop the partial characters of tokens that end or start inside a multi-byte character
+        pretokens = pretokenizer.pre_tokenize_str(data.decode("utf-8", errors="ignore"))
+        is_superword[token_id] = len(pretokens) > 1
+    return token_bytes, is_superword
+
+
+def save_token_counts(output_dir, tokenizer, file_counts, files):
+    """
+    Add the count of each token id in each of files to token_stats.npz in output_dir, together with
+    per token metrics (see get_token_metrics), and save a summary of all its files in
+    token_stats.json. file_counts holds (token_ids, counts) of the nonzero counts of each file.
+
+    Files already in token_stats.npz (e.g. from an earlier run of encode.py) have their counts
+    replaced, so counts stays the sum over the files it lists. The counts of each file are stored
+    sparsely in file_token_ids and file_token_counts, from file_offsets[i] to file_offsets[i + 1]
+    for the i-th file (see get_file_token_counts).
+    """
+    output_dir = Path(output_dir)
+    ensure_dir(output_dir)
+    path = output_dir / "token_stats.npz"
+    token_bytes, is_superword = get_token_metrics(tokenizer)
+    with FileLock(f"{path}.lock"):
+        rows = {}
+        if os.path.exists(path):
+            stats = load_token_counts(path)
+            counts = stats["counts"]
+            if len(counts) != len(token_bytes):
+                raise ValueError(
+                    f"{path} has counts for {len(counts)} token ids, but the tokenizer has "
+                    f"{len(token_bytes)}"
+                )
+            offsets = stats["file_offsets"]
+            for file, start, end in zip(stats["files"], offsets[:-1], offsets[1:]):
+                rows[str(file)] = (
+                    stats["file_token_ids"][start:end],
+                    stats["file_token_counts"][start:end],
+                )
+        else:
+            counts = np.zeros(len(token_bytes), dtype=np.int64)
+        for file, (token_ids, token_counts) in zip(files, file_counts):
+            if file in rows:
+                old_ids, old_counts = rows[file]
+                counts[old_ids] -= old_counts
+            counts[token_ids] += token_counts
+            rows[file] = (
+                np.asarray(token_ids, dtype=np.int32),
+                np.asarray(token_counts, dtype=np.int64),
+            )
+
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez_compressed(
+            tmp_path,
+            counts=counts,
+            files=np.array(list(rows), dtype=str),
+            file_offsets=np.cumsum([0] + [len(ids) for ids, _ in rows.values()], dtype=np.int64),
+            file_token_ids=np.concatenate([ids for ids, _ in rows.values()]),
+            file_token_counts=np.concatenate([c for _, c in rows.values()]),
+            token_bytes=token_bytes,
+            is_superword=is_superword,
+        )
+        os.replace(tmp_path, path)
+
+    num_tokens = int(counts.sum())
+    num_token_bytes = int(counts @ token_bytes)
+    summary = {
+        "files": list(rows),
+        "vocab_size": len(counts),
+        "num_tokens": num_tokens,
+        "num_token_bytes": num_token_bytes,
+        "bytes_per_token": num_token_bytes / max(num_tokens, 1),
+        "num_token_ids_used": int(np.count_nonzero(counts)),
+        "num_superwords": int(is_superword.sum()),
+        "superword_fraction": float(counts[is_superword].sum() / max(num_tokens, 1)),
+        "superword_byte_fraction": float(counts[is_superword] @ token_bytes[is_superword] / max(num_token_bytes, 1)),
+    }
+    with open(output_dir / "token_stats.json", "w") as fout:
+        fout.write(json.dumps(summary, indent=5))
+    return summary
+
+
+def load_token_counts(path):
+    """
+    Load token_stats.npz saved by encode.py --save_token_stats (from the file or its directory) as a
+    dict of arrays: counts, files, file_offsets, file_token_ids, file_token_counts, token_bytes and
+    is_superword.
+    """
+    path = Path(path)
+    if path.is_dir():
+        path = path / "token_stats.npz"
+    with np.load(path) as stats:
+        return {k: stats[k] for k in stats.files}
+
+
+def get_file_token_counts(stats, file):
+    """The count of each token id in file, as a dense array, from the stats of load_token_counts."""
+    i = list(stats["files"]).index(file)
+    start, end = stats["file_offsets"][i], stats["file_offsets"][i + 1]
+    counts = np.zeros(len(stats["counts"]), dtype=np.int64)
+    counts[stats["file_token_ids"][start:end]] = stats["file_token_counts"][start:end]
+    return counts
+
+
+RESULTS_DB = "results.sqlite"
+RESULTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS corpora (
+    corpus_id TEXT PRIMARY KEY,
+    files TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS encode_results (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    tokenizer TEXT NOT NULL,
+    tokenizer_dir TEXT,
+    eval_dataset TEXT,
+    corpus_id TEXT REFERENCES corpora (corpus_id),
+    num_inherit_merges INTEGER,
+    vocab_size INTEGER,
+    dropout REAL,
+    token_count INTEGER,
+    pretoken_count INTEGER,
+    byte_count INTEGER,
+    bytes_per_token REAL,
+    encode_seconds REAL,
+    num_workers INTEGER
+);
+CREATE INDEX IF NOT EXISTS encode_results_by_tokenizer
+    ON encode_results (tokenizer, eval_dataset, vocab_size);
+CREATE INDEX IF NOT EXISTS encode_results_by_transition
+    ON encode_results (eval_dataset, num_inherit_merges, vocab_size);
+CREATE TABLE IF NOT EXISTS train_results (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    tokenizer TEXT NOT NULL,
+    output_dir TEXT,
+    corpus_id TEXT REFERENCES corpora (corpus_id),
+    num_inherit_merges INTEGER,
+    vocab_size INTEGER,
+    num_new_merges INTEGER,
+    num_bytes INTEGER,
+    do_whitespace_pretokenization INTEGER,
+    num_unique_words INTEGER,
+    train_seconds REAL,
+    total_seconds REAL,
+    merges_per_second REAL,
+    peak_rss_bytes INTEGER,
+    phases TEXT
+);
+CREATE INDEX IF NOT EXISTS train_results_by_tokenizer ON train_results (tokenizer);
+CREATE INDEX IF NOT EXISTS train_results_by_transition
+    ON train_results (num_inherit_merges, vocab_size);
+"""
+# columns identifying a result, so that reruns replace earlier results when querying with latest=True
+RESULTS_KEYS = {
+    "encode_results": ("tokenizer", "eval_dataset", "corpus_id", "vocab_size", "dropout"),
+    "train_results": ("tokenizer", "output_dir"),
+}
+
+
+def connect_results_db(path=RESULTS_DB):
+    """Open the results database at path, creating its tables if needed."""
+    conn = sqlite3.connect(path, timeout=600)
+    # the jobs of a sweep append concurrently, and readers should not block them
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(RESULTS_SCHEMA)
+    return conn
+
+
+def get_corpus_id(files):
+    return hashlib.sha256(json.dumps(list(files)).encode("utf-8")).hexdigest()[:16]
+
+
+def append_results(path, table, rows, files=None):
+    """
+    Append rows (dicts from column to value) to table ("encode_results" or "train_results") of the
+    results database at path. If files is given, the list of files is stored once in the corpora
+    table and rows refer to it by corpus_id.
+    """
+    if table not in RESULTS_KEYS:
+        raise ValueError(f"Unknown results table {table}")
+    with closing(connect_results_db(path)) as conn, conn:
+        corpus_id = None
+        if files is not None:
+            corpus_id = get_corpus_id(files)
+            conn.execute(
+                "INSERT OR IGNORE INTO corpora VALUES (?, ?)", (corpus_id, json.dumps(list(files)))
+            )
+        for row in rows:
+            row = {"created_at": time.time(), "corpus_id": corpus_id, **row}  # row can override both
+            conn.execute(
+                f"INSERT INTO {table} ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                list(row.values()),
+            )
+
+
+def query_results(path=RESULTS_DB, table="encode_results", latest=True, **filters):
+    """
+    Return the rows of table in the results database at path as a list of dicts (e.g. to pass to
+    pandas.DataFrame), keeping the rows whose columns have the given values (a list or tuple matches any of its values), e.g.
+    query_results(eval_dataset="olmo2", vocab_size=200000). Filters on tokenizer, eval_dataset,
+    num_inherit_merges and vocab_size use indexes. If latest, only the last result of each
+    tokenizer and setting (see RESULTS_KEYS) is kept.
+    """
+    if table not in RESULTS_KEYS:
+        raise ValueError(f"Unknown results table {table}")
+    conditions, params = [], []
+    for column, value in filters.items():
+        values = list(value) if isinstance(value, (list, tuple)) else [value]
+        conditions.append(f"{column} IN ({', '.join('?' * len(values))})")
+        params.extend(values)
+    if latest:
+        keys = ", ".join(RESULTS_KEYS[table])
+        # SQLite takes id from the row with the largest created_at in each group
+        latest_ids = f"SELECT id FROM (SELECT id, MAX(created_at) FROM {table} GROUP BY {keys})"
+        conditions.append(f"id IN ({latest_ids})")
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    with closing(connect_results_db(path)) as conn:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(f"SELECT * FROM {table}{where} ORDER BY id", params).fetchall()
+    return [dict(row) for row in rows]
+
+
+def load_corpus_files(path, corpus_id):
+    """Return the files of corpus_id (a column of the results tables) in the results database."""
+    with closing(connect_results_db(path)) as conn:
+        (files,) = conn.execute(
+            "SELECT files FROM corpora WHERE corpus_id = ?", (corpus_id,)
+        ).fetchone()
+    return json.loads(files)
+
+
+def get_utf8_boundary(data, pos):
+    """
+    Return the first position >= pos in data (bytes) where a UTF-8 character starts. Continuation
+    bytes look like 0b10xxxxxx, and a character has at most 3 of them, so this is O(1).
+    """
+    while pos < len(data) and (data[pos] & 0xC0) == 0x80:
+        pos += 1
+    return pos
+
+
+def copy_file_prefix(src, dst, num_bytes):
+    """
+    Copy the first num_bytes of src to dst. The copy happens inside the kernel where possible, so the
+    data is never read into Python (and the rest of src is never read at all).
+    """
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        copied = 0
+        try:
+            while copied < num_bytes:
+                n = os.copy_file_range(fin.fileno(), fout.fileno(), num_bytes - copied)
+                if n == 0:
+                    break
+                copied += n
+        except (AttributeError, OSError):
+            # copy_file_range is Linux-only and not supported by every filesystem
+            fin.seek(copied)
+            fout.seek(copied)
+            while copied < num_bytes:
+                data = fin.read(min(2**24, num_bytes - copied))
+                if not data:
+                    break
+                fout.write(data)
+                copied += len(data)
 
 
 def get_truncated_file(filepath, wanted_filesize):
     """
-    Create a copy of the given file and truncates it to the desired size.
+    Create a copy of the first wanted_filesize bytes of the given file (rounded up to a character
+    boundary) and return its path and size.
     """
     if os.path.getsize(filepath) < wanted_filesize:
         raise ValueError("File is already smaller than desired filesize")
@@ -149,62 +1827,178 @@ def get_truncated_file(filepath, wanted_filesize):
         if not os.path.exists(truncated_filepath):
             print(f"Truncating {filepath} to {wanted_filesize} bytes")
 
-            os.system(f"cp {filepath} {truncated_filepath}")
-
-            # adjust wanted_filesize to the next valid unicode character
-            with open(truncated_filepath, "rb") as f:
+            # adjust wanted_filesize to the start of the next unicode character
+            with open(filepath, "rb") as f:
                 f.seek(wanted_filesize)
-                data = f.read(1)
-                while data and not is_valid_unicode(data):
-                    data = f.read(1)
-                    wanted_filesize += 1
+                wanted_filesize += get_utf8_boundary(f.read(4), 0)
 
-            with open(truncated_filepath, "r+", encoding="utf-8") as fin:
-                fin.truncate(wanted_filesize)
+            # copy to a temporary file first, so an interrupted copy is never mistaken for a complete one
+            tmp_filepath = str(truncated_filepath) + ".tmp"
+            copy_file_prefix(filepath, tmp_filepath, wanted_filesize)
+            os.replace(tmp_filepath, truncated_filepath)
         else:
             print(f"Truncated file already exists: {truncated_filepath}")
+            wanted_filesize = os.path.getsize(truncated_filepath)
 
     return str(truncated_filepath), wanted_filesize
 
 
-def get_files_with_num_bytes(data_dir, num_bytes=None, loop_around=True):
-    """Return a list of files inside data_dir that contain num_bytes worth of data."""
-    file_list, byte_count = [], 0
-    data_dir = Path(data_dir)
+def get_cache_dir():
+    """Directory for cached artifacts shared across runs, set with $SUPERBPE_CACHE_DIR."""
+    return Path(os.environ.get("SUPERBPE_CACHE_DIR", "~/.cache/superbpe")).expanduser()
 
-    all_files = [
+
+def to_data_path(path):
+    """
+    Return path relative to the data root ($SUPERBPE_DATA_ROOT) if it is inside it, so that it can be
+    resolved on machines where the data lives elsewhere. Otherwise return the absolute path.
+    """
+    path = os.path.abspath(path)
+    data_root = os.environ.get("SUPERBPE_DATA_ROOT")
+    if data_root and path.startswith(os.path.abspath(data_root) + os.sep):
+        return os.path.relpath(path, data_root)
+    return path
+
+
+def resolve_data_path(path):
+    """Inverse of to_data_path: resolve a relative path against the data root."""
+    data_root = os.environ.get("SUPERBPE_DATA_ROOT")
+    if os.path.isabs(path) or not data_root:
+        return str(path)
+    return os.path.join(data_root, path)
+
+
+def get_manifest(data_dir, num_bytes=None, loop_around=True, seed=0):
+    """
+    Return a manifest of the text files inside data_dir that contain num_bytes worth of data, as a
+    list of [path, start, end] byte ranges. The last file is cut at a character boundary rather than
+    copied. Manifests are cached by the directory listing (names, sizes and mtimes), num_bytes,
+    loop_around and seed, and files are sampled with their own seeded RNG, so every node gets the
+    same sample.
+    """
+    data_dir = Path(resolve_data_path(str(data_dir)))
+    all_files = sorted(
         f
         for f in os.listdir(data_dir)
         if f.endswith(".txt") and ("truncated" not in f) and ("split" not in f)
-    ]
+    )
+    sizes = {}
+    listing = []
+    for f in all_files:
+        stat = os.stat(data_dir / f)
+        sizes[f] = stat.st_size
+        listing.append([f, stat.st_size, stat.st_mtime_ns])
+
+    key = {
+        "data_dir": to_data_path(data_dir),
+        "num_bytes": num_bytes,
+        "loop_around": loop_around,
+        "seed": seed,
+    }
+    key_hash = hashlib.sha256(json.dumps({**key, "listing": listing}).encode()).hexdigest()
+    manifest_path = get_cache_dir() / "manifests" / f"{key_hash[:16]}.json"
+    if os.path.exists(manifest_path):
+        return read_json(manifest_path)
 
+    files, byte_count = [], 0
     if not num_bytes:  # if num_bytes is not specified, use all text data
-        file_list = [str(data_dir / f) for f in all_files]
-        byte_count = sum(os.path.getsize(data_dir / f) for f in all_files)
-        print(f"Using all {len(file_list)} files in {data_dir}")
+        files = [[to_data_path(data_dir / f), 0, sizes[f]] for f in all_files]
+        byte_count = sum(sizes.values())
+        print(f"Using all {len(files)} files in {data_dir}")
     else:
-        random.shuffle(all_files)
+        random.Random(seed).shuffle(all_files)
         counter = 0
-        tqdm_bar = tqdm(total=num_bytes, desc="Loading text data")
         while byte_count < num_bytes:
             fname = all_files[counter % len(all_files)]
-            filesize = os.path.getsize(data_dir / fname)
+            filesize = sizes[fname]
             if byte_count + filesize <= num_bytes:
-                file_list.append(str(data_dir / fname))
+                files.append([to_data_path(data_dir / fname), 0, filesize])
                 byte_count += filesize
-                tqdm_bar.update(filesize)
             else:
-                wanted_filesize = num_bytes - byte_count
-                truncated_filepath, true_filesize = get_truncated_file(
-                    data_dir / fname, wanted_filesize
-                )
-                file_list.append(truncated_filepath)
-                byte_count += true_filesize
-                tqdm_bar.update(true_filesize)
+                # adjust the end to the start of the next unicode character
+                end = num_bytes - byte_count
+                with open(data_dir / fname, "rb") as f:
+                    f.seek(end)
+                    end += get_utf8_boundary(f.read(4), 0)
+                files.append([to_data_path(data_dir / fname), 0, end])
+                byte_count += end
             counter += 1
             if not loop_around and counter >= len(all_files):
                 break
-    return file_list, byte_count
+
+    manifest = {**key, "manifest_id": key_hash[:16], "total_bytes": byte_count, "files": files}
+    ensure_dir(manifest_path.parent)
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as fout:
+        json.dump(manifest, fout, indent=5)
+    os.replace(tmp_path, manifest_path)
+    return manifest
+
+
+def get_manifest_files(manifest):
+    """
+    Return a list of files covering the byte ranges in manifest, for consumers that need whole files
+    (e.g. tokenizer training). Partial ranges are materialized with get_truncated_file.
+    """
+    file_list = []
+    for path, start, end in manifest["files"]:
+        path = resolve_data_path(path)
+        if start == 0 and end == os.path.getsize(path):
+            file_list.append(path)
+        elif start == 0:
+            file_list.append(get_truncated_file(path, end)[0])
+        else:
+            raise ValueError(f"Only prefixes of files can be materialized, got {path}[{start}:{end}]")
+    return file_list
+
+
+def get_files_with_num_bytes(data_dir, num_bytes=None, loop_around=True, seed=0):
+    """Return a list of files inside data_dir that contain num_bytes worth of data."""
+    manifest = get_manifest(data_dir, num_bytes, loop_around=loop_around, seed=seed)
+    return get_manifest_files(manifest), manifest["total_bytes"]
+
+
+def load_text_dataset(dataset_name: str, split: str = "train", streaming: bool = True):
+    """
+    Load a Hugging Face dataset by name, or a local directory of .parquet or .arrow files (e.g. a
+    downloaded snapshot of the dataset) for offline runs.
+    """
+    if not os.path.isdir(dataset_name):
+        return load_dataset(dataset_name, split=split, streaming=streaming)
+
+    for builder in ["parquet", "arrow"]:
+        data_files = sorted(str(p) for p in Path(dataset_name).rglob(f"*.{builder}"))
+        if data_files:
+            return load_dataset(builder, data_files=data_files, split="train", streaming=streaming)
+    raise ValueError(f"No .parquet or .arrow files found in {dataset_name}")
+
+
+def _read_text_batches(dataset, text_column, batch_size, out_queue, stop):
+    """
+    Read dataset in batches of batch_size and put (texts, byte lengths) on out_queue, skipping empty
+    texts, until the dataset is exhausted or stop is set. Put None when done.
+    """
+    import pyarrow.compute as pc
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    try:
+        for table in dataset.with_format("arrow").iter(batch_size=batch_size):
+            column = table.column(text_column)
+            lengths = pc.fill_null(pc.binary_length(column), 0)
+            keep = pc.greater(lengths, 0)
+            put((column.filter(keep).to_pylist(), lengths.filter(keep).to_numpy()))
+            if stop.is_set():
+                return
+    except Exception as e:
+        put(e)
+    put(None)
 
 
 def get_hf_dataset_iterator(
@@ -214,66 +2008,230 @@ def get_hf_dataset_iterator(
     split: str = "train",
     streaming: bool = True,
     batch_size: int = 1000,
+    num_readers: int = 8,
+    prefetch_batches: int = 8,
 ) -> Iterator[str]:
     """
     Create an iterator over text from a Hugging Face dataset.
-    
+
+    The dataset shards are split between num_readers background threads, which read ahead in
+    batches so that the consumer (e.g. the tokenizer trainer) does not wait on the download and
+    decoding. Batches are taken from the readers in round-robin order, so the order of texts only
+    depends on num_readers and batch_size, and a stage 2 run sees the same texts as stage 1.
+
     Args:
-        dataset_name: Name of the dataset on Hugging Face
+        dataset_name: Name of the dataset on Hugging Face, or a local directory of .parquet or
+            .arrow files
         num_bytes: Maximum number of bytes to process (None for all)
         text_column: Column name containing text data
         split: Dataset split to use
         streaming: Whether to use streaming mode
-        batch_size: Number of examples to yield at once
-    
+        batch_size: Number of examples read at once
+        num_readers: Number of threads reading dataset shards concurrently (capped at the number of
+            shards in the dataset)
+        prefetch_batches: Number of batches each reader may read ahead
+
     Yields:
         Text strings from the dataset
     """
     print(f"Loading dataset: {dataset_name}")
-    
+
     # Load the dataset
-    dataset = load_dataset(dataset_name, split=split, streaming=streaming)
-    
+    dataset = load_text_dataset(dataset_name, split=split, streaming=streaming)
+    if isinstance(dataset, IterableDataset):
+        num_readers = max(min(num_readers, dataset.n_shards), 1)
+    else:
+        num_readers = 1
+    shards = [dataset] if num_readers == 1 else [
+        dataset.shard(num_shards=num_readers, index=i) for i in range(num_readers)
+    ]
+
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=prefetch_batches) for _ in shards]
+    readers = [
+        threading.Thread(
+            target=_read_text_batches,
+            args=(shard, text_column, batch_size, q, stop),
+            daemon=True,
+        )
+        for shard, q in zip(shards, queues)
+    ]
+    for reader in readers:
+        reader.start()
+
     total_bytes = 0
-    batch = []
-    
+
     # Create progress bar if num_bytes is specified
     pbar = tqdm(total=num_bytes, desc="Processing dataset", unit="B", unit_scale=True) if num_bytes else None
-    
+
     try:
-        for example in dataset:
-            # Get text from the example
-            text = example.get(text_column, "")
-            if not text:
-                continue
-            
-            # Track bytes
-            text_bytes = len(text.encode("utf-8"))
-            
-            # Check byte limit
-            if num_bytes and total_bytes + text_bytes > num_bytes:
-                # Yield any remaining batch
-                if batch:
-                    yield from batch
-                break
-            
-            batch.append(text)
-            total_bytes += text_bytes
-            
-            if pbar:
-                pbar.update(text_bytes)
-            
-            # Yield batch when it's full
-            if len(batch) >= batch_size:
-                yield from batch
-                batch = []
-        
-        # Yield any remaining texts
-        if batch:
-            yield from batch
-    
+        active = list(queues)
+        while active:
+            for q in list(active):
+                item = q.get()
+                if item is None:
+                    active.remove(q)
+                    continue
+                if isinstance(item, Exception):
+                    raise item
+                texts, lengths = item
+
+                # Check byte limit: stop before the first text that does not fit
+                ends = total_bytes + np.cumsum(lengths)
+                n = int(np.searchsorted(ends, num_bytes, side="right")) if num_bytes else len(texts)
+                if n > 0:
+                    yield from texts[:n]
+                    if pbar:
+                        pbar.update(int(ends[n - 1]) - total_bytes)
+                    total_bytes = int(ends[n - 1])
+                if n < len(texts):
+                    active = []
+                    break
+
     finally:
+        stop.set()
         if pbar:
             pbar.close()
-    
+
     print(f"Processed {total_bytes:,} bytes from dataset")
+
+
+# Texts in a cached sample are separated by this, so the shards can also be read as a corpus_dir
+SAMPLE_SEPARATOR = b"\n\n"
+SAMPLE_SHARD_BYTES = 2**30
+
+
+def get_hf_sample_dir(
+    dataset_name: str,
+    num_bytes: Optional[int] = None,
+    text_column: str = "text",
+    split: str = "train",
+    num_readers: int = 8,
+) -> Path:
+    """Return the cache directory for a sample of a Hugging Face dataset."""
+    key = {
+        "dataset_name": dataset_name,
+        "num_bytes": num_bytes,
+        "text_column": text_column,
+        "split": split,
+        "num_readers": num_readers,
+    }
+    key_hash = hashlib.sha256(json.dumps(key).encode()).hexdigest()
+    return get_cache_dir() / "samples" / key_hash[:16]
+
+
+def write_sample(texts: Iterator[str], sample_dir: Path, shard_bytes: int = SAMPLE_SHARD_BYTES) -> Iterator[str]:
+    """
+    Yield texts while writing them to shards in sample_dir. Each shard is a part-XXXXX.txt file of
+    texts followed by SAMPLE_SEPARATOR, with the end position of each text in part-XXXXX.ends.npy.
+    The sample is written to a temporary directory and only moved to sample_dir once all texts were
+    consumed, together with sample.json recording the shards and their checksum.
+    """
+    tmp_dir = Path(f"{sample_dir}.{os.getpid()}.tmp")
+    ensure_dir(tmp_dir)
+    checksum = hashlib.sha256()
+    shards, fout = [], None
+
+    def close_shard():
+        fout.close()
+        np.save((tmp_dir / shards[-1]["path"]).with_suffix(".ends.npy"), np.array(ends, dtype=np.uint64))
+        shards[-1].update(num_documents=len(ends), num_bytes=pos)
+
+    try:
+        for text in texts:
+            if fout is None:
+                shards.append({"path": f"part-{len(shards):05d}.txt"})
+                fout = open(tmp_dir / shards[-1]["path"], "wb")
+                ends, pos = [], 0
+            data = text.encode("utf-8") + SAMPLE_SEPARATOR
+            fout.write(data)
+            checksum.update(data)
+            pos += len(data)
+            ends.append(pos - len(SAMPLE_SEPARATOR))
+            yield text
+            if pos >= shard_bytes:
+                close_shard()
+                fout = None
+        if fout is not None:
+            close_shard()
+            fout = None
+
+        info = {
+            "num_documents": sum(shard["num_documents"] for shard in shards),
+            "num_bytes": sum(shard["num_bytes"] for shard in shards),
+            "checksum": checksum.hexdigest(),
+            "shards": shards,
+        }
+        with open(tmp_dir / "sample.json", "w") as fo:
+            json.dump(info, fo, indent=5)
+        if os.path.exists(sample_dir):  # written concurrently by another run
+            shutil.rmtree(tmp_dir)
+        else:
+            os.replace(tmp_dir, sample_dir)
+        print(f"Cached {info['num_documents']:,} texts in {sample_dir}")
+    finally:
+        if fout is not None:
+            fout.close()
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+
+
+def read_sample(sample_dir: Path, checksum: Optional[str] = None, use_mmap: bool = True) -> Iterator[str]:
+    """
+    Yield the texts of a sample written by write_sample. The shards are hashed as they are read, and
+    a ValueError is raised at the end if they do not match the checksum in sample.json (or the given
+    checksum, e.g. the one recorded in meta.json by a previous stage).
+    """
+    info = read_json(Path(sample_dir) / "sample.json")
+    if checksum and info["checksum"] != checksum:
+        raise ValueError(f"Sample in {sample_dir} has checksum {info['checksum']}, expected {checksum}")
+
+    actual_checksum = hashlib.sha256()
+    for shard in info["shards"]:
+        path = Path(sample_dir) / shard["path"]
+        ends = np.load(path.with_suffix(".ends.npy"))
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if use_mmap else f.read()
+            try:
+                start = 0
+                for end in ends.tolist():
+                    yield data[start:end].decode("utf-8")
+                    start = end + len(SAMPLE_SEPARATOR)
+                actual_checksum.update(data)
+            finally:
+                if use_mmap:
+                    data.close()
+
+    if actual_checksum.hexdigest() != info["checksum"]:
+        raise ValueError(f"Sample in {sample_dir} is corrupted, its checksum does not match sample.json")
+
+
+def get_hf_dataset_sample(
+    dataset_name: str,
+    num_bytes: Optional[int] = None,
+    text_column: str = "text",
+    split: str = "train",
+    num_readers: int = 8,
+    checksum: Optional[str] = None,
+) -> Iterator[str]:
+    """
+    Like get_hf_dataset_iterator, but the sampled texts are cached on disk the first time they are
+    streamed (see get_hf_sample_dir), and read from the cache afterwards.
+    """
+    sample_dir = get_hf_sample_dir(dataset_name, num_bytes, text_column, split, num_readers)
+    if os.path.exists(sample_dir / "sample.json"):
+        print(f"Reading cached sample of {dataset_name} from {sample_dir}")
+        yield from read_sample(sample_dir, checksum=checksum)
+        return
+
+    texts = get_hf_dataset_iterator(
+        dataset_name=dataset_name,
+        num_bytes=num_bytes,
+        text_column=text_column,
+        split=split,
+        streaming=True,
+        num_readers=num_readers,
+    )
+    yield from write_sample(texts, sample_dir)
+    if checksum and read_json(sample_dir / "sample.json")["checksum"] != checksum:
+        raise ValueError(f"{dataset_name} has changed since the sample with checksum {checksum} was taken")